@@ -0,0 +1,167 @@
+"""
+benchmark for pygamerts.py: frame time of the single parts of a frame
+for different map sizes and numbers of units, without opening a window.
+
+usage: python3 benchmark.py --sizes 128 1024 8192 --units 100 1000 --output results.json
+
+every run uses the same random seed, so results of different program versions can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import numpy
+import pygame
+
+import pygamerts
+
+
+def make_heightmap(size, seed):
+    """returns a size x size uint8 array of smooth random hills: the sum of random grids with growing resolution"""
+    rng = numpy.random.RandomState(seed)
+    heights = numpy.zeros((size, size))
+    cells = 4
+    weight = 1.0
+    while cells <= size:
+        grid = rng.random_sample((cells, cells))
+        repeat = -(-size // cells) # rounded up
+        heights += weight * numpy.kron(grid, numpy.ones((repeat, repeat)))[:size, :size]
+        cells *= 4
+        weight /= 2
+    heights -= heights.min()
+    heights *= 255 / max(heights.max(), 1e-9)
+    return heights.astype(numpy.uint8)
+
+
+def statistics(times):
+    """times in seconds -> dict with milliseconds"""
+    ms = numpy.array(times) * 1000
+    return {"count": len(ms),
+            "mean": float(ms.mean()),
+            "p50": float(numpy.percentile(ms, 50)),
+            "p90": float(numpy.percentile(ms, 90)),
+            "p99": float(numpy.percentile(ms, 99)),
+            "max": float(ms.max())}
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def clear_world(viewer):
+    """kills all sprites and particles of the previous run and empties the sprite pools"""
+    for s in list(viewer.allgroup):
+        s.kill()
+    viewer.particles.count = 0
+    # ---- the pools and their counters start empty, so that every run reuses the same sprites ----
+    for name in pygamerts.VectorSprite.pool_stats():
+        cls = getattr(pygamerts, name)
+        cls.enable_pool(cls.pool_size)
+
+
+def populate(viewer, units, seed):
+    """creates units tents, swordgoblins, javelins and explosions at random places of the visible
+       part of the map: sprites are bounced or killed at the screen edges (also in the headless viewer)"""
+    random.seed(seed)
+    viewer.seed_random(seed) # the random streams of the simulation (units, sparks)
+    rows, columns = viewer.rawmap.shape
+    width = min(columns * viewer.tilesize, viewer.width)
+    height = min(rows * viewer.tilesize, viewer.height)
+
+    def randompos():
+        return pygame.math.Vector2(random.uniform(0, width), -random.uniform(0, height))
+
+    tents = [pygamerts.Tent(pos=randompos()) for i in range(max(1, units // 10))]
+    for i in range(units):
+        pygamerts.Swordgoblin(pos=randompos(), bossnumber=random.choice(tents).number, zoom=1)
+    for i in range(units):
+        m = pygame.math.Vector2(150, 0)
+        angle = random.randint(0, 360)
+        m.rotate_ip(angle)
+        pygamerts.Javelin(pos=randompos(), move=m, max_distance=1000, angle=angle,
+                          start_z=random.randint(0, 255), zoom=1)
+    for i in range(max(1, units // 10)):
+        pygamerts.Explosion(posvector=randompos())
+
+
+def bench(viewer, size, units, frames, seed, folder):
+    """returns the result dict of one map size / unit count combination"""
+    clear_world(viewer)
+    mapfile = os.path.join(folder, "bench{}.map".format(size))
+    pygamerts.save_heightmap(mapfile, make_heightmap(size, seed))
+    viewer.world_offset_x = viewer.world_offset_y = 0
+    result = {"size": size, "units": units, "frames": frames}
+    result["load_map"] = statistics([timed(viewer.load_map, mapfile)])
+    # ---- terrain: first picture renders all visible chunks, later pictures come from the cache ----
+    result["make_worldmap_cold"] = statistics([timed(viewer.make_worldmap)])
+    result["make_worldmap"] = statistics([timed(viewer.make_worldmap) for i in range(frames)])
+    populate(viewer, units, seed)
+    result["sprites"] = len(viewer.allgroup)
+    phases = {"update": [], "bullets_vs_terrain": [], "draw": []}
+    for i in range(frames):
+        seconds = viewer.timestep
+        start = time.perf_counter()
+        viewer.move_stored_sprites(seconds)
+        viewer.allgroup.update(seconds)
+        viewer.particles.update(seconds, viewer.world_offset_x, viewer.world_offset_y, viewer.width, viewer.height)
+        viewer.collide_units()
+        viewer.pathfinder.update(viewer.path_budget) # queued path searches and flow fields, like Viewer.step
+        phases["update"].append(time.perf_counter() - start)
+        phases["bullets_vs_terrain"].append(timed(viewer.bullets_vs_terrain))
+        start = time.perf_counter()
+        for s in viewer.worldgroup:
+            s.worldrect(viewer.world_offset_x, viewer.world_offset_y, viewer.worldzoom)
+        viewer.render()
+        phases["draw"].append(time.perf_counter() - start)
+    for name, times in phases.items():
+        result[name] = statistics(times)
+    result["alive"] = len(viewer.allgroup) # after the last frame, compare with sprites
+    result["particles"] = viewer.particles.count
+    result["pools"] = {name: {"hits": hits, "misses": misses, "free": free}
+                       for name, (hits, misses, free) in pygamerts.VectorSprite.pool_stats().items()}
+    os.remove(mapfile)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless benchmark for pygamerts")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[128, 512, 2048, 8192],
+                        help="side length of the synthetic square maps")
+    parser.add_argument("--units", type=int, nargs="+", default=[100, 1000],
+                        help="number of swordgoblins and of javelins (a tenth of it for tents and explosions)")
+    parser.add_argument("--frames", type=int, default=60, help="measured frames per combination")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for maps and units")
+    parser.add_argument("--output", default="benchmark.json", help="json file for the results")
+    args = parser.parse_args()
+
+    viewer = pygamerts.Viewer(1430, 800, headless=True)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            for units in args.units:
+                result = bench(viewer, size, units, args.frames, args.seed, folder)
+                results.append(result)
+                print("map {0}x{0}, {1} units: update {2:.2f} ms, bullets {3:.2f} ms, draw {4:.2f} ms, worldmap {5:.2f} ms (p99 ms), "
+                      "sprites alive {6} of {7}".format(
+                      size, units, result["update"]["p99"], result["bullets_vs_terrain"]["p99"],
+                      result["draw"]["p99"], result["make_worldmap"]["p99"], result["alive"], result["sprites"]))
+    report = {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "seed": args.seed,
+              "python": platform.python_version(),
+              "pygame": pygame.version.ver,
+              "numpy": numpy.__version__,
+              "machine": platform.machine(),
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("results written to", args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,68 @@ idea: python3/pygame 3d vector rts game
 import pygame
 import random
 import os
+import select
+import socket
+import struct
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import multiprocessing
+import contextlib
+import json
+import threading
+import time
+import zlib
+import numpy
+
+# ------ binary heightmap format (.map) ------
+# header: magic, version, bytes per sample (1=uint8, 2=uint16), reserved, width, height
+# followed by width*height little-endian samples, row by row (top row first)
+HEIGHTMAP_MAGIC = b"PRTM"
+HEIGHTMAP_VERSION = 1
+HEIGHTMAP_HEADER = struct.Struct("<4sBBHII")
+HEIGHTMAP_DTYPES = {1: numpy.dtype("<u1"), 2: numpy.dtype("<u2")}
+TEXTMAP_PARALLEL_BYTES = 64 * 1024 * 1024 # bigger text maps are parsed by several processes
+# ------ paged heightmap format (also .map), for maps bigger than memory ------
+# header: magic, version, bytes per sample, compression (0 = raw, 1 = zlib), pyramid reduce (0 = max, 1 = mean),
+#         reserved, page size, number of pyramid levels, file offset of the level table
+# pages: pagesize x pagesize samples (smaller at the right and bottom edge), raw or zlib compressed, any order
+# level table (at the end): width, height and file offset of the page index of each pyramid level
+# page index: file offset and length of every page of the level, page row by page row
+PAGEMAP_MAGIC = b"PRTP"
+PAGEMAP_VERSION = 1
+PAGEMAP_HEADER = struct.Struct("<4sBBBBIIIQ")
+PAGEMAP_LEVEL = struct.Struct("<IIQ")
+PAGEMAP_INDEX = numpy.dtype([("offset", "<u8"), ("length", "<u4")])
+PAGEMAP_REDUCE = {"max": 0, "mean": 1}
+# ------ lockstep protocol (TCP, little-endian) ------
+# welcome (server -> each player, starts the game): player number, number of players, seed
+# turn (player -> server -> all other players), one per player and tick: tick, player,
+#   checksum of the state after tick - delay (0 = not checked), number of commands, then the commands
+LOCKSTEP_WELCOME = struct.Struct("<BBI")
+LOCKSTEP_TURN = struct.Struct("<IBIB")
+LOCKSTEP_COMMAND = struct.Struct("<Bii") # kind, a, b
+# ------ commands: everything a player does that changes the game (see Viewer.apply_command) ------
+COMMAND_CATAPULT = 1 # new selected catapult at world position a, b
+COMMAND_FIRE = 2     # the selected catapults of the player shoot a cannonball
+COMMAND_MOVE = 3     # the selected ballistas of the player go to world position a, b
+COMMAND_ZOOM = 4     # worldzoom(a). Zooming scales all world positions, so it is part of the game
+COMMAND_WATER = 5    # water height + a
+# ------ replay files (.replay) ------
+# header: magic, version, compression (0 = raw, 1 = zlib), seed, timestep, tile size, world zoom, water height,
+#         window width and height, size and crc32 of the first 64 KiB of the map file, length of the map file name,
+#         followed by the map file name (utf-8)
+# records (one zlib stream if compressed): ticks since the record before, kind, player, then for commands
+#   (COMMAND_...) and REPLAY_VIEW two int32 a, b, for REPLAY_KEYFRAME the checksum of the game state (uint32)
+REPLAY_MAGIC = b"PRTR"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<4sBBIddiiIIQIH")
+REPLAY_RECORD = struct.Struct("<HBB")
+REPLAY_VALUES = struct.Struct("<ii")
+REPLAY_CHECKSUM = struct.Struct("<I")
+REPLAY_VIEW = 16     # the camera moved to world offset a, b (not part of the game)
+REPLAY_KEYFRAME = 17 # checksum of the game state at this tick, see Viewer.checksum
 
 def mouseVector():
     return pygame.math.Vector2(pygame.mouse.get_pos()[0],
@@ -21,12 +83,35 @@ def randomize_color(color, delta=50):
     color = max(0, color)
     return color
 
+# ------ font and text cache ------
+fonts = {} # { (fontname, fontsize, bold): Font }
+texts = collections.OrderedDict() # { (text, color, fontsize, fontname, bold): Surface }
+max_texts = 512 # rendered text surfaces kept in texts
+
+def get_font(fontname=None, fontsize=24, bold=False):
+    """returns the SysFont for fontname, fontsize and bold. Each font is created only once."""
+    key = (fontname, fontsize, bold)
+    if key not in fonts:
+        fonts[key] = pygame.font.SysFont(fontname, fontsize, bold=bold)
+    return fonts[key]
+
+def render_text(text, color, fontsize=24, fontname="mono", bold=True):
+    """returns a (shared, do not draw on it!) Surface with text. The max_texts last used texts are cached."""
+    key = (text, tuple(color), fontsize, fontname, bold)
+    if key in texts:
+        texts.move_to_end(key)
+        return texts[key]
+    surface = get_font(fontname, fontsize, bold).render(text, True, color)
+    if pygame.display.get_surface() is not None:
+        surface = surface.convert_alpha()
+    texts[key] = surface
+    while len(texts) > max_texts:
+        texts.popitem(last=False)
+    return surface
+
 def make_text(msg="pygame is cool", fontcolor=(255, 0, 255), fontsize=42, font=None):
     """returns pygame surface with text. You still need to blit the surface."""
-    myfont = pygame.font.SysFont(font, fontsize)
-    mytext = myfont.render(msg, True, fontcolor)
-    mytext = mytext.convert_alpha()
-    return mytext
+    return render_text(msg, fontcolor, fontsize, font, bold=False)
 
 def write(background, text="bla", pos=None, color=(0,0,0),
           fontsize=None, center=False, x=None, y=None):
@@ -40,9 +125,8 @@ def write(background, text="bla", pos=None, color=(0,0,0),
             y = -pos.y
         if fontsize is None:
             fontsize = 24
-        font = pygame.font.SysFont('mono', fontsize, bold=True)
-        fw, fh = font.size(text)
-        surface = font.render(text, True, color)
+        surface = render_text(text, color, fontsize, 'mono', bold=True)
+        fw, fh = surface.get_size()
         if center: # center text around x,y
             background.blit(surface, (x-fw//2, y-fh//2))
         else:      # topleft corner is x,y
@@ -100,6 +184,48 @@ def get_height_color(number):
         color = (236+number-240,236+number-240 ,236+number-240 ) 
     return color
 
+def make_height_palette(size=256, colorfunction=get_height_color):
+    """returns a (size, 3) uint8 array with the color of every possible height value.
+       For 16-bit maps (size 65536) the 256 colors of colorfunction are spread over the whole range."""
+    shift = max(0, (size - 1).bit_length() - 8)
+    colors = numpy.array([colorfunction(number) for number in range(256)], dtype=numpy.uint8)
+    return colors[numpy.arange(size) >> shift]
+
+def load_palette(filename, size=256):
+    """reads a palette image: the pixels of the top row are the colors for the heights 0,1,2....
+       The colors are stretched to size entries."""
+    pic = pygame.image.load(filename)
+    colors = pygame.surfarray.array3d(pic)[:, 0, :] # (width, 3)
+    index = numpy.arange(size) * len(colors) // size
+    return colors[index].astype(numpy.uint8)
+
+def water_palette(palette, waterheight, watercolor=(0,0,255)):
+    """returns a copy of palette where all heights below waterheight have watercolor"""
+    colors = palette.copy()
+    colors[:max(0, int(waterheight))] = watercolor
+    return colors
+
+def heights_to_surface(heights, palette):
+    """colors a 2d array (rows, columns) of heights with one palette lookup.
+       Returns a Surface with one pixel per height value."""
+    rgb = palette[heights] # (rows, columns, 3)
+    return pygame.surfarray.make_surface(rgb.transpose(1, 0, 2))
+
+def halve_heights(heights, reduce="max"):
+    """one cell for each 2x2 block of heights (the highest or the mean), for the height pyramid.
+       An odd last row or column stays a cell of its own."""
+    rows, columns = heights.shape
+    row_starts = numpy.arange(0, rows, 2)
+    column_starts = numpy.arange(0, columns, 2)
+    if reduce == "max":
+        smaller = numpy.maximum.reduceat(heights, row_starts, axis=0)
+        return numpy.maximum.reduceat(smaller, column_starts, axis=1)
+    sums = numpy.add.reduceat(heights.astype(numpy.uint32), row_starts, axis=0)
+    sums = numpy.add.reduceat(sums, column_starts, axis=1)
+    counts = numpy.outer(numpy.diff(numpy.append(row_starts, rows)),
+                         numpy.diff(numpy.append(column_starts, columns)))
+    return (sums // counts).astype(heights.dtype)
+
 def elastic_collision(sprite1, sprite2):
         """elasitc collision between 2 VectorSprites (calculated as disc's).
            The function alters the dx and dy movement vectors of both sprites.
@@ -118,8 +244,8 @@ def elastic_collision(sprite1, sprite2):
         cbdys = sprite1.move.y - sy
         distancesquare = dirx * dirx + diry * diry
         if distancesquare == 0:
-            dirx = random.randint(0,11) - 5.5
-            diry = random.randint(0,11) - 5.5
+            dirx = VectorSprite.rng.randint(0,11) - 5.5
+            diry = VectorSprite.rng.randint(0,11) - 5.5
             distancesquare = dirx * dirx + diry * diry
         dp = (bdxs * dirx + bdys * diry) # scalar product
         dp /= distancesquare # divide by distance * distance.
@@ -133,16 +259,358 @@ def elastic_collision(sprite1, sprite2):
                 sprite1.move.x -= 2 * dirx * cdp
                 sprite1.move.y -= 2 * diry * cdp
 
+def is_binary_heightmap(filename):
+    """True if filename starts with the binary heightmap header, False for old comma-separated text maps"""
+    with open(filename, "rb") as f:
+        return f.read(len(HEIGHTMAP_MAGIC)) == HEIGHTMAP_MAGIC
+
+def save_heightmap(filename, heights):
+    """writes a 2d array (rows, columns) of heights as binary .map file.
+       values up to 255 are stored as uint8, bigger values as uint16"""
+    heights = numpy.asarray(heights)
+    if heights.ndim != 2:
+        raise ValueError("heightmap must be a 2d array, not {}d".format(heights.ndim))
+    itemsize = 1 if heights.size == 0 or heights.max() < 256 else 2
+    if heights.size > 0 and (heights.min() < 0 or heights.max() > 65535):
+        raise ValueError("heights must be between 0 and 65535")
+    height, width = heights.shape
+    with open(filename, "wb") as f:
+        f.write(HEIGHTMAP_HEADER.pack(HEIGHTMAP_MAGIC, HEIGHTMAP_VERSION, itemsize, 0, width, height))
+        numpy.ascontiguousarray(heights, dtype=HEIGHTMAP_DTYPES[itemsize]).tofile(f)
+
+def load_heightmap(filename):
+    """memory-maps a binary .map file and returns a 2d numpy array (rows, columns).
+       The array is copy-on-write: changes stay in memory and never touch the file."""
+    with open(filename, "rb") as f:
+        header = f.read(HEIGHTMAP_HEADER.size)
+    if len(header) < HEIGHTMAP_HEADER.size:
+        raise ValueError("{} is too short for a heightmap header".format(filename))
+    magic, version, itemsize, _, width, height = HEIGHTMAP_HEADER.unpack(header)
+    if magic != HEIGHTMAP_MAGIC:
+        raise ValueError("{} is not a binary heightmap (old text map? use upgrade_textmap)".format(filename))
+    if version != HEIGHTMAP_VERSION or itemsize not in HEIGHTMAP_DTYPES:
+        raise ValueError("{}: unsupported heightmap version {} / sample size {}".format(filename, version, itemsize))
+    return numpy.memmap(filename, dtype=HEIGHTMAP_DTYPES[itemsize], mode="c",
+                        offset=HEIGHTMAP_HEADER.size, shape=(height, width))
+
+def is_paged_heightmap(filename):
+    """True if filename is a paged heightmap (see save_paged_heightmap)"""
+    with open(filename, "rb") as f:
+        return f.read(len(PAGEMAP_MAGIC)) == PAGEMAP_MAGIC
+
+def save_paged_heightmap(filename, heights, pagesize=256, compression=1, reduce="max", progress=None):
+    """writes heights (anything 2d that can be sliced in bands of rows, like the memmap of a big
+       .map file) as paged heightmap with all levels of the height pyramid, for PagedHeightmap.
+       Only one band of pagesize rows per level is in memory at a time.
+       compression is the zlib level of the pages, 0 stores them raw. Samples are uint8 if
+       heights has a 1 byte dtype, else uint16. progress(fraction) is called after each band."""
+    if len(heights.shape) != 2:
+        raise ValueError("heightmap must be a 2d array, not {}d".format(len(heights.shape)))
+    if pagesize < 2 or pagesize % 2:
+        raise ValueError("pagesize must be even, not {}".format(pagesize))
+    itemsize = 1 if numpy.dtype(heights.dtype).itemsize == 1 else 2
+    dtype = HEIGHTMAP_DTYPES[itemsize]
+    shapes = [tuple(heights.shape)]
+    while max(shapes[-1]) > 1:
+        shapes.append(((shapes[-1][0] + 1) // 2, (shapes[-1][1] + 1) // 2))
+    indexes = [numpy.zeros((-(-rows // pagesize), -(-columns // pagesize)), dtype=PAGEMAP_INDEX)
+               for rows, columns in shapes]
+    written = [0] * len(shapes)  # page rows written per level
+    waiting = [[] for level in shapes] # halved bands not yet a whole page row
+    with open(filename, "wb") as f:
+        f.write(b"\0" * PAGEMAP_HEADER.size)
+
+        def write_band(level, band, last):
+            """writes one page row of level and passes the band on to the next level"""
+            py = written[level]
+            written[level] += 1
+            for px in range(indexes[level].shape[1]):
+                data = numpy.ascontiguousarray(band[:, px*pagesize:(px+1)*pagesize], dtype=dtype).tobytes()
+                if compression:
+                    data = zlib.compress(data, compression)
+                indexes[level][py, px] = (f.tell(), len(data))
+                f.write(data)
+            if level + 1 < len(shapes):
+                waiting[level+1].append(halve_heights(band, reduce))
+                if last or sum(len(b) for b in waiting[level+1]) >= pagesize:
+                    write_band(level + 1, numpy.concatenate(waiting[level+1]), last)
+                    waiting[level+1] = []
+
+        rows = shapes[0][0]
+        for row in range(0, rows, pagesize):
+            band = numpy.asarray(heights[row:row+pagesize])
+            if band.size and (band.min() < 0 or band.max() > numpy.iinfo(dtype).max):
+                raise ValueError("heights must be between 0 and {}".format(numpy.iinfo(dtype).max))
+            write_band(0, band, row + pagesize >= rows)
+            if progress is not None:
+                progress(min(1.0, (row + pagesize) / rows))
+        # ---- index of each level, level table, then the header that points to it ----
+        offsets = []
+        for index in indexes:
+            offsets.append(f.tell())
+            f.write(index.tobytes())
+        table = f.tell()
+        for (level_rows, level_columns), offset in zip(shapes, offsets):
+            f.write(PAGEMAP_LEVEL.pack(level_columns, level_rows, offset))
+        f.seek(0)
+        f.write(PAGEMAP_HEADER.pack(PAGEMAP_MAGIC, PAGEMAP_VERSION, itemsize, 1 if compression else 0,
+                                    PAGEMAP_REDUCE[reduce], 0, pagesize, len(shapes), table))
+
+def page_heightmap(filename, target=None, pagesize=256, compression=1, progress=None):
+    """converts a binary .map file into a paged heightmap, without reading it into memory.
+       Without target, the paged map is written next to it as name.paged.map. Returns the target filename."""
+    if target is None:
+        target = os.path.splitext(filename)[0] + ".paged.map"
+    save_paged_heightmap(target, load_heightmap(filename), pagesize, compression, progress=progress)
+    return target
+
+def parse_textmap_block(text):
+    """values of some whole lines of a text map as 1d array"""
+    return numpy.fromstring(text.replace("\n", ""), dtype=numpy.int64, sep=",")
+
+def read_textmap(filename, workers=None, progress=None):
+    """parses an old comma-separated text map (one line per row, every value followed by a comma)
+       into a 2d numpy array, without creating a python object per value.
+       Texts bigger than TEXTMAP_PARALLEL_BYTES are cut into blocks of whole lines that are
+       parsed by workers processes (default: one per core). progress(fraction) is called after each block."""
+    with open(filename, "r") as f:
+        text = f.read()
+    lines = text.split("\n", 1)
+    width = len([n for n in lines[0].split(",") if n.strip() != ""])
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(text) <= TEXTMAP_PARALLEL_BYTES:
+        values = parse_textmap_block(text)
+    else:
+        # ---- blocks end at a line end ----
+        starts = [0]
+        for i in range(1, workers * 4):
+            end = text.find("\n", max(starts[-1], len(text) * i // (workers * 4)))
+            if end == -1:
+                break
+            starts.append(end + 1)
+        blocks = [text[a:b] for a, b in zip(starts, starts[1:] + [len(text)])]
+        del text
+        parts = []
+        # spawn: forking a process with running threads (SDL, job workers) is not safe
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for part in pool.map(parse_textmap_block, blocks):
+                parts.append(part)
+                if progress is not None:
+                    progress(len(parts) / len(blocks))
+        values = numpy.concatenate(parts)
+    if width == 0 or values.size % width != 0:
+        raise ValueError("{}: rows of the text map have different lengths".format(filename))
+    return values.reshape(-1, width)
+
+def upgrade_textmap(filename, target=None, workers=None, progress=None):
+    """converts an old comma-separated text map into the binary format.
+       Without target, the file is upgraded in place. Returns the target filename."""
+    heights = read_textmap(filename, workers, progress)
+    if target is None:
+        target = filename
+    save_heightmap(target, heights)
+    return target
+
+def convert_png(filename, target=None):
+    """converts a png into a binary .map file. The red value of each pixel is the height.
+       Needs no display: the red channel is copied in one bulk operation.
+       Without target, the .map file is written next to the png. Returns the target filename."""
+    if target is None:
+        target = os.path.splitext(filename)[0] + ".map"
+    pic = pygame.image.load(filename)
+    red = pygame.surfarray.array_red(pic) # (columns, rows)
+    save_heightmap(target, red.T)
+    return target
+
+def convert_png_folder(folder="maps"):
+    """converts every .png file in folder (not in subfolders) into a .map file. Returns the list of written .map files"""
+    written = []
+    for f in sorted(os.listdir(folder)):
+        if f[-4:].lower() == ".png":
+            written.append(convert_png(os.path.join(folder, f)))
+    return written
+
+def prepare_map(job, filename, view=None, radar=(256, 0.25)):
+    """job function (also called directly): all the slow parts of loading a map, without display calls.
+       view (offset_x, offset_y, tilesize, grid, width, height) is the first screen, its chunks are
+       rendered ahead. radar is (size, interval) of the Minimap.
+       Returns a dict for Viewer.use_map."""
+    pages = None
+    upgraded = False
+    if is_paged_heightmap(filename):
+        # ---- paged map: the pyramid is in the file too, nothing is read before it is needed ----
+        pages = PagedHeightmap(filename)
+        rawmap = pages.levels[0]
+        terrain = TerrainCache(rawmap, reduce=pages.reduce, levels=pages.levels)
+    else:
+        upgraded = not is_binary_heightmap(filename)
+        if upgraded:
+            # old comma-separated text map
+            job.report(0.0, "parsing text map")
+            upgrade_textmap(filename, progress=lambda fraction: job.report(0.5 * fraction))
+        job.report(0.5, "building height pyramid")
+        rawmap = load_heightmap(filename)
+        terrain = TerrainCache(rawmap)
+    # ---- optional own colors for this map ----
+    palettename = filename[:-4] + ".palette.png"
+    if os.path.isfile(palettename):
+        terrain.set_palette(load_palette(palettename, terrain.max_height + 1))
+    job.report(0.7, "building radar")
+    minimap = Minimap(terrain, *radar)
+    if view is not None:
+        # ---- the terrain is not shared yet, so the chunks can go straight into its cache ----
+        offset_x, offset_y, tilesize, grid, width, height = view
+        keys = terrain.missing_chunks(pygame.Rect(0, 0, width, height), offset_x, offset_y, tilesize, grid)
+        for number, key in enumerate(keys):
+            job.report(0.75 + 0.25 * number / len(keys), "painting terrain")
+            terrain.get_chunk(key[4], key[5], tilesize, grid)
+    job.report(1.0, "")
+    return {"filename": filename, "upgraded": upgraded, "rawmap": rawmap, "pages": pages,
+            "terrain": terrain, "minimap": minimap}
+
+def encode_turn(tick, player, checksum, commands):
+    """bytes of a lockstep turn, commands are (kind, a, b)"""
+    return LOCKSTEP_TURN.pack(tick, player, checksum, len(commands)) + b"".join(
+        LOCKSTEP_COMMAND.pack(kind, a, b) for kind, a, b in commands)
+
+def decode_turn(message):
+    """(tick, player, checksum, [ (kind, a, b) ]) of the bytes of one turn"""
+    tick, player, checksum, count = LOCKSTEP_TURN.unpack_from(message)
+    return tick, player, checksum, [LOCKSTEP_COMMAND.unpack_from(message, LOCKSTEP_TURN.size + i * LOCKSTEP_COMMAND.size)
+                                    for i in range(count)]
 
-class VectorSprite(pygame.sprite.Sprite):
-    """base class for sprites. this class inherits from pygames sprite class"""
+def split_turns(data):
+    """cuts received bytes into whole turns. Returns ([ bytes of a turn ], bytes of an unfinished turn)"""
+    turns = []
+    start = 0
+    while len(data) - start >= LOCKSTEP_TURN.size:
+        count = data[start + LOCKSTEP_TURN.size - 1]
+        end = start + LOCKSTEP_TURN.size + count * LOCKSTEP_COMMAND.size
+        if end > len(data):
+            break
+        turns.append(data[start:end])
+        start = end
+    return turns, data[start:]
+
+def map_fingerprint(filename):
+    """(size, crc32 of the first 64 KiB) of a map file: cheap, also for paged maps bigger than memory"""
+    with open(filename, "rb") as f:
+        return os.path.getsize(filename), zlib.crc32(f.read(64 * 1024))
+
+def random_color():
+    return (random.randint(0,255), random.randint(0,255), random.randint(0,255))
+
+def random_startpos():
+    return pygame.math.Vector2(random.randint(0, Viewer.width),-50)
+
+
+class VectorSprite(pygame.sprite.DirtySprite):
+    """base class for sprites. this class inherits from pygames (dirty) sprite class.
+       The named arguments a sprite class accepts are its defaults table (merged with the
+       tables of its parent classes once per class). The defaults are class attributes,
+       a sprite stores only its arguments and what it changes later. Callable defaults are
+       called for each sprite (new Vector2, random color). Unknown arguments raise a TypeError."""
+    defaults = {
+        "layer": 4,
+        "zoom": 1,
+        "name": None,       # name of the image in Viewer.images
+        "static": False,
+        "selected": False,
+        "pos": random_startpos,
+        "move": pygame.math.Vector2,
+        "fontsize": 22,
+        "friction": 1.0,    # no friction
+        "radius": 5,
+        "width": None,      # None: 2 * radius
+        "height": None,     # None: 2 * radius
+        "hitpoints": 100,
+        "mass": 15,
+        "damage": 10,
+        "bounce_on_edge": False,
+        "kill_on_edge": False,
+        "angle": 0,         # facing right?
+        "max_age": None,
+        "max_distance": None,
+        "picture": None,
+        "bossnumber": None,
+        "owner": None,      # number of the player who made the sprite with a command
+        "kill_with_boss": False,
+        "sticky_with_boss": False,
+        "upkey": None,
+        "downkey": None,
+        "rightkey": None,
+        "leftkey": None,
+        "speed": 0,
+        "age": 0,           # age in seconds
+        "warp_on_edge": False,
+        "gravity": None,
+        "survive_north": False,
+        "survive_south": False,
+        "survive_west": False,
+        "survive_east": False,
+        "color": random_color,
+        }
     number = 0
     numbers = {} # { number, Sprite }
+    spatialhash = None # SpatialHash for neighbour queries, set per class like .groups
+    pathfinder = None  # PathFinder for units that walk around mountains and water, set per class
+    rng = random.Random() # random stream of the game rules, seeded by the Viewer (same seed, same game)
+    synced = True # False: the sprite exists only on this computer (texts, sparks, cursor), see Viewer.checksum
+    solid = False # True: bounces off other solid sprites
+    motion = None # MotionStore for all StoredSprites, None = every sprite moves itself
+    rotations = None # RotationCache for named images, None = rotate every time
+    slot = None   # index in the MotionStore (only StoredSprites)
+    old_pos = None # pos of the last simulation step, for drawing between two steps
+    drawn_rect = None  # rect and image at the last draw, see DirtyGroup
+    drawn_image = None
+    image0 = None
+    pool = None   # killed sprites of this class for reuse, set per class with enable_pool
+    pool_size = 0 # longest pool
+    pool_hits = 0   # sprites taken from the pool
+    pool_misses = 0 # sprites created new because the pool was empty
+    kept_attributes = ("image", "image0", "rect") # survive in the pool, create_image can reuse them
+
+    def __new__(cls, **kwargs):
+        """takes a killed sprite from the pool of the class if there is one (then __init__ runs again on it)"""
+        pool = cls.__dict__.get("pool")
+        if pool is None:
+            return pygame.sprite.DirtySprite.__new__(cls)
+        if not pool:
+            cls.pool_misses += 1
+            return pygame.sprite.DirtySprite.__new__(cls)
+        cls.pool_hits += 1
+        sprite = pool.pop()
+        # ---- forget everything of the last life except the Surfaces ----
+        kept = {name: sprite.__dict__[name] for name in cls.kept_attributes if name in sprite.__dict__}
+        sprite.__dict__.clear()
+        sprite.__dict__.update(kept)
+        return sprite
+
+    @classmethod
+    def enable_pool(cls, size=500):
+        """killed sprites of this class are kept (up to size) and reused for new sprites.
+           A killed sprite of a pooled class must not be used anymore."""
+        cls.pool = [] if size > 0 else None
+        cls.pool_size = size
+        cls.pool_hits = 0
+        cls.pool_misses = 0
+
+    @staticmethod
+    def pool_stats():
+        """returns { class name: (hits, misses, sprites in the pool) } for all pooled classes"""
+        stats = {}
+        classes = [VectorSprite]
+        while classes:
+            cls = classes.pop()
+            classes.extend(cls.__subclasses__())
+            if cls.__dict__.get("pool") is not None:
+                stats[cls.__name__] = (cls.pool_hits, cls.pool_misses, len(cls.pool))
+        return stats
 
     def __init__(self, **kwargs):
         self._default_parameters(**kwargs)
         self._overwrite_parameters()
-        pygame.sprite.Sprite.__init__(self, self.groups) #call parent class. NEVER FORGET !
+        pygame.sprite.DirtySprite.__init__(self, self.groups) #call parent class. NEVER FORGET !
         self.number = VectorSprite.number # unique number for each sprite
         VectorSprite.number += 1
         VectorSprite.numbers[self.number] = self
@@ -152,122 +620,88 @@ class VectorSprite(pygame.sprite.Sprite):
         if self.angle != 0:
             self.set_angle(self.angle)
         self.tail = [] 
+        if self.spatialhash is not None:
+            if self.solid:
+                self.spatialhash.note_radius(self.radius)
+            self.spatialhash.update(self)
 
     def _overwrite_parameters(self):
         """change parameters before create_image is called""" 
         pass
 
-    def _default_parameters(self, **kwargs):    
-        """get unlimited named arguments and turn them into attributes
-           default values for missing keywords"""
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.resolve_defaults()
 
-        for key, arg in kwargs.items():
-            setattr(self, key, arg)
-        if "layer" not in kwargs:
-            self._layer = 4
-        else:
-            self._layer = self.layer
-        if "zoom" not in kwargs:
-            self.zoom = 1
-        self.old_zoom = self.zoom # make copy!
-        if "name" not in kwargs:
-            self.name = None
-        if "static" not in kwargs:
-            self.static = False
-        if "selected" not in kwargs:
-            self.selected = False
-        if "pos" not in kwargs:
-            self.pos = pygame.math.Vector2(random.randint(0, Viewer.width),-50)
-        if "move" not in kwargs:
-            self.move = pygame.math.Vector2(0,0)
-        if "fontsize" not in kwargs:
-            self.fontsize = 22
-        if "friction" not in kwargs:
-            self.friction = 1.0 # no friction
-        if "radius" not in kwargs:
-            self.radius = 5
-        if "width" not in kwargs:
+    @classmethod
+    def resolve_defaults(cls):
+        """merges the defaults tables of cls and all parent classes (once per class)
+           and turns the own defaults of cls into class attributes"""
+        table = {}
+        for c in reversed(cls.__mro__):
+            table.update(c.__dict__.get("defaults", {}))
+        cls.all_defaults = table
+        cls.default_factories = [(name, value) for name, value in table.items() if callable(value)]
+        for name, value in cls.__dict__.get("defaults", {}).items():
+            if not callable(value) and name != "layer":
+                setattr(cls, name, value)
+
+    def _default_parameters(self, **kwargs):    
+        """get named arguments and turn them into attributes,
+           default values (from the defaults tables) for missing keywords"""
+        cls = self.__class__
+        if not kwargs.keys() <= cls.all_defaults.keys():
+            raise TypeError("{}() got unexpected keyword argument(s): {}".format(
+                            cls.__name__, ", ".join(sorted(kwargs.keys() - cls.all_defaults.keys()))))
+        for name, factory in cls.default_factories:
+            if name not in kwargs:
+                setattr(self, name, factory())
+        for name, value in kwargs.items():
+            if name != "layer": # pygame's Sprite.layer works only after Sprite.__init__
+                setattr(self, name, value)
+        self._layer = kwargs.get("layer", 4)
+        if self.width is None:
             self.width = self.radius * 2
-        if "height" not in kwargs:
+        if self.height is None:
             self.height = self.radius * 2
-        
-        if "hitpoints" not in kwargs:
-            self.hitpoints = 100
         self.hitpointsfull = self.hitpoints # makes a copy
-        if "mass" not in kwargs:
-            self.mass = 10
-        if "damage" not in kwargs:
-            self.damage = 10
-        if "bounce_on_edge" not in kwargs:
-            self.bounce_on_edge = False
-        if "kill_on_edge" not in kwargs:
-            self.kill_on_edge = False
-        if "angle" not in kwargs:
-            self.angle = 0 # facing right?
-        if "max_age" not in kwargs:
-            self.max_age = None
-        if "max_distance" not in kwargs:
-            self.max_distance = None
-        if "picture" not in kwargs:
-            self.picture = None
-        if "bossnumber" not in kwargs:
-            self.bossnumber = None
-        if "kill_with_boss" not in kwargs:
-            self.kill_with_boss = False
-        if "sticky_with_boss" not in kwargs:
-            self.sticky_with_boss = False
-        if "mass" not in kwargs:
-            self.mass = 15
-        if "upkey" not in kwargs:
-            self.upkey = None
-        if "downkey" not in kwargs:
-            self.downkey = None
-        if "rightkey" not in kwargs:
-            self.rightkey = None
-        if "leftkey" not in kwargs:
-            self.leftkey = None
-        if "speed" not in kwargs:
-            self.speed = None
-        if "age" not in kwargs:
-            self.age = 0 # age in seconds
-        if "warp_on_edge" not in kwargs:
-            self.warp_on_edge = False
-        if "gravity" not in kwargs:
-            self.gravity = None
-        if "survive_north" not in kwargs:
-            self.survive_north = False
-        if "survive_south" not in kwargs:
-            self.survive_south = False
-        if "survive_west" not in kwargs:
-            self.survive_west = False
-        if "survive_east" not in kwargs:
-            self.survive_east = False
-        if "speed" not in kwargs:
-            self.speed = 0
-        if "color" not in kwargs:
-            self.color = (random.randint(0,255), random.randint(0,255), random.randint(0,255))
+        self.old_zoom = self.zoom
 
     def kill(self):
         if self.number in self.numbers:
            del VectorSprite.numbers[self.number] # remove Sprite from numbers dict
+        if self.spatialhash is not None:
+            self.spatialhash.remove(self)
+        was_alive = self.alive()
         pygame.sprite.Sprite.kill(self)
+        pool = self.__class__.__dict__.get("pool")
+        if was_alive and pool is not None and len(pool) < self.pool_size:
+            pool.append(self)
     
    
     
     def create_image(self):
         if self.picture is not None:
             self.image = self.picture.copy()
+            self.image0 = self.image.copy()
         elif self.name is not None:
+            # shared zoomed image, never painted on: no copy needed
             self.image = Viewer.zoom_images[self.name][self.zoom]
-            self.image0 = self.image.copy()
+            self.image0 = self.image
         else:
             self.image = pygame.Surface((self.width,self.height))
             self.image.fill((self.color))
-            self.image = self.image.convert_alpha()
-        self.image0 = self.image.copy()
+            if pygame.display.get_surface() is not None:
+                self.image = self.image.convert_alpha()
+            self.image0 = self.image.copy()
         self.rect= self.image.get_rect()
         self.width = self.rect.width
         self.height = self.rect.height
+        if self.name is not None:
+            # collision radius follows the (zoomed) image
+            self.radius = max(self.width, self.height) / 2
+            if self.solid and self.spatialhash is not None:
+                self.spatialhash.note_radius(self.radius)
     
 
     
@@ -280,12 +714,17 @@ class VectorSprite(pygame.sprite.Sprite):
             return
         
         
+    def rotated_image(self):
+        """image0 rotated by self.angle. Sprites with a named image get it from the shared RotationCache"""
+        if self.rotations is not None and self.name is not None and self.picture is None:
+            return self.rotations.get(self.name, self.zoom, self.angle)
+        return pygame.transform.rotate(self.image0, self.angle)
+
     def rotate(self, by_degree):
         """rotates a sprite and changes it's angle by by_degree"""
         self.angle += by_degree
         oldcenter = self.rect.center
-        self.image = pygame.transform.rotate(self.image0, self.angle)
-        self.image.convert_alpha()
+        self.image = self.rotated_image()
         self.rect = self.image.get_rect()
         self.rect.center = oldcenter
 
@@ -293,9 +732,8 @@ class VectorSprite(pygame.sprite.Sprite):
         """rotates a sprite and changes it's angle to degree"""
         self.angle = degree
         oldcenter = self.rect.center
-        self.image = pygame.transform.rotate(self.image0, self.angle)
+        self.image = self.rotated_image()
         #self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
         self.rect = self.image.get_rect()
         self.rect.center = oldcenter
 
@@ -304,10 +742,12 @@ class VectorSprite(pygame.sprite.Sprite):
         # ----- kill because... ------
         if self.hitpoints <= 0:
             self.kill()
-        if self.max_age is not None and self.age > self.max_age:
-            self.kill()
-        if self.max_distance is not None and self.distance_traveled > self.max_distance:
-            self.kill()
+        if self.slot is None:
+            # (StoredSprites are checked all together in MotionStore.step)
+            if self.max_age is not None and self.age > self.max_age:
+                self.kill()
+            if self.max_distance is not None and self.distance_traveled > self.max_distance:
+                self.kill()
         # ---- movement with/without boss ----
         if self.bossnumber is not None:
             if self.kill_with_boss:
@@ -317,16 +757,24 @@ class VectorSprite(pygame.sprite.Sprite):
                 boss = VectorSprite.numbers[self.bossnumber]
                 self.pos = pygame.math.Vector2(boss.pos.x, boss.pos.y)
                 self.set_angle(boss.angle)
-        self.pos += self.move * seconds
-        self.move *= self.friction 
-        self.distance_traveled += self.move.length() * seconds
-        self.age += seconds
-        self.wallbounce()
+        if self.slot is None:
+            # (StoredSprites are moved all together in MotionStore.step)
+            self.pos += self.move * seconds
+            self.move *= self.friction 
+            self.distance_traveled += self.move.length() * seconds
+            self.age += seconds
+            self.wallbounce()
         self.rect.center = ( round(self.pos.x, 0), -round(self.pos.y, 0) )
+        if self.spatialhash is not None and self.alive():
+            self.spatialhash.update(self)
         
-    def worldrect(self, offset_x, offset_y, zoom):
-        x = self.pos.x + offset_x
-        y = self.pos.y - offset_y
+    def worldrect(self, offset_x, offset_y, zoom, alpha=1.0):
+        """screen position. alpha between 0 and 1 draws between the position of the last simulation step (old_pos) and pos"""
+        pos = self.pos
+        if alpha < 1.0 and self.old_pos is not None:
+            pos = self.old_pos.lerp(pos, alpha)
+        x = pos.x + offset_x
+        y = pos.y - offset_y
         self.rect.center = ( round(x,0), -round(y,0))
 
 
@@ -371,10 +819,195 @@ class VectorSprite(pygame.sprite.Sprite):
             elif self.warp_on_edge:
                 self.pos.y = 0
 
+VectorSprite.resolve_defaults()
+
+
+class RotationCache(object):
+    """rotated images shared by all sprites, key: (image name, zoom, angle step).
+       Angles are rounded to steps directions. Images are rotated when first needed
+       (or all at once with prefill) and the least recently used are forgotten above max_bytes."""
+
+    def __init__(self, zoom_images, steps=64, max_bytes=64*1024*1024):
+        self.zoom_images = zoom_images # { name: { zoom: Surface } }
+        self.steps = steps
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.images = collections.OrderedDict() # { (name, zoom, step): Surface }
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, zoom, angle):
+        step = int(round(angle * self.steps / 360.0)) % self.steps
+        key = (name, zoom, step)
+        if key in self.images:
+            self.hits += 1
+            self.images.move_to_end(key)
+            return self.images[key]
+        self.misses += 1
+        image = pygame.transform.rotate(self.zoom_images[name][zoom], step * 360.0 / self.steps)
+        self.images[key] = image
+        self.bytes += image.get_width() * image.get_height() * image.get_bytesize()
+        while self.bytes > self.max_bytes and len(self.images) > 1:
+            old_key, old_image = self.images.popitem(last=False)
+            self.bytes -= old_image.get_width() * old_image.get_height() * old_image.get_bytesize()
+        return image
+
+    def prefill(self, names=None, zooms=None):
+        """rotates all images in advance (as long as max_bytes allows)"""
+        for name in (names or self.zoom_images):
+            for zoom in (zooms or self.zoom_images[name]):
+                for step in range(self.steps):
+                    self.get(name, zoom, step * 360.0 / self.steps)
+
+
+class MotionStore(object):
+    """structure of arrays with the movement of many StoredSprites.
+       step() moves all of them together with a few numpy operations per frame.
+       last_pos is pos before the last step (or the new pos after a jump), for swept collision tests."""
+    vectors = ("pos", "move")
+    numbers = ("friction", "age", "max_age", "max_distance", "distance_traveled")
+    flags = ("bounce_on_edge", "kill_on_edge", "warp_on_edge", "survive_north")
+    optional = ("max_age", "max_distance") # None is stored as nan
+    attributes = vectors + numbers + flags
+
+    def __init__(self, capacity=256):
+        self.capacity = 0
+        self.sprites = [] # { slot: sprite }
+        self.free = []    # unused slots
+        self.used = numpy.zeros(0, dtype=bool)
+        for name in self.vectors:
+            setattr(self, name, numpy.zeros((0, 2)))
+        for name in self.numbers:
+            setattr(self, name, numpy.zeros(0))
+        for name in self.flags:
+            setattr(self, name, numpy.zeros(0, dtype=bool))
+        self.last_pos = numpy.zeros((0, 2))
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        extra = capacity - self.capacity
+        for name in self.attributes:
+            old = getattr(self, name)
+            setattr(self, name, numpy.concatenate((old, numpy.zeros((extra,) + old.shape[1:], dtype=old.dtype))))
+        self.used = numpy.concatenate((self.used, numpy.zeros(extra, dtype=bool)))
+        self.last_pos = numpy.concatenate((self.last_pos, numpy.zeros((extra, 2))))
+        self.sprites.extend([None] * extra)
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1)) # lowest slot is used first
+        self.capacity = capacity
+
+    def add(self, sprite, values):
+        """stores sprite with values (a dict with all attributes), returns the slot number"""
+        if not self.free:
+            self.grow(self.capacity * 2)
+        slot = self.free.pop()
+        for name, value in values.items():
+            self.set(slot, name, value)
+        self.used[slot] = True
+        self.sprites[slot] = sprite
+        return slot
+
+    def remove(self, slot):
+        self.used[slot] = False
+        self.sprites[slot] = None
+        self.free.append(slot)
+
+    def get(self, slot, name):
+        value = getattr(self, name)[slot]
+        if name in self.vectors:
+            return pygame.math.Vector2(float(value[0]), float(value[1]))
+        if name in self.flags:
+            return bool(value)
+        if name in self.optional and numpy.isnan(value):
+            return None
+        return float(value)
+
+    def set(self, slot, name, value):
+        if value is None:
+            value = numpy.nan
+        if name in self.vectors:
+            getattr(self, name)[slot] = (value[0], value[1])
+            if name == "pos":
+                self.last_pos[slot] = (value[0], value[1]) # a jump, not a flight
+        else:
+            getattr(self, name)[slot] = value
+
+    def step(self, seconds, width, height):
+        """moves all stored sprites like VectorSprite.update and wallbounce do.
+           Returns the list of sprites that must be killed."""
+        # ----- kill because of age or distance (nan compares always False) ------
+        kill = (self.age > self.max_age) | (self.distance_traveled > self.max_distance)
+        # ---- movement (unused slots are moved too, that is cheaper than selecting) ----
+        self.last_pos[:] = self.pos
+        self.pos += self.move * seconds
+        self.move *= self.friction[:, numpy.newaxis]
+        self.distance_traveled += numpy.hypot(self.move[:, 0], self.move[:, 1]) * seconds
+        self.age += seconds
+        # ---- bounce / warp / kill on screen edge, same order as wallbounce ----
+        x, y = self.pos[:, 0], self.pos[:, 1]
+        move_x, move_y = self.move[:, 0], self.move[:, 1]
+        warped = numpy.zeros(self.capacity, dtype=bool)
+        for coordinate, movement, edge, border, warp_to, killing in (
+                (x, move_x, x < 0, 0, width, self.kill_on_edge),                                      # left
+                (y, move_y, y > 0, 0, -height, self.kill_on_edge & ~self.survive_north),             # upper
+                (x, move_x, x > width, width, 0, self.kill_on_edge),                                 # right
+                (y, move_y, y < -height, -height, 0, self.kill_on_edge)):                            # lower
+            edge = edge.copy()
+            kill |= edge & killing
+            bounce = edge & ~killing & self.bounce_on_edge
+            coordinate[bounce] = border
+            movement[bounce] *= -1
+            warp = edge & ~killing & ~self.bounce_on_edge & self.warp_on_edge
+            coordinate[warp] = warp_to
+            warped |= warp
+        self.last_pos[warped] = self.pos[warped]
+        return [self.sprites[slot] for slot in numpy.flatnonzero(kill & self.used)]
+
+
+def stored_attribute(name):
+    """property for StoredSprite: reads and writes attribute name in the MotionStore while the sprite has a slot there,
+       otherwise as normal attribute (with the class default)"""
+    def getter(self):
+        if self.slot is None:
+            return self.__dict__.get(name, self.all_defaults.get(name))
+        return VectorSprite.motion.get(self.slot, name)
+    def setter(self, value):
+        if self.slot is None:
+            self.__dict__[name] = value
+        else:
+            VectorSprite.motion.set(self.slot, name, value)
+    return property(getter, setter)
+
+
+class StoredSprite(VectorSprite):
+    """VectorSprite whose movement lives in the MotionStore VectorSprite.motion (if there is one).
+       pos and move return copies: change them by assignment (self.move = ...), not in place (rotate_ip)."""
+
+    def __init__(self, **kwargs):
+        VectorSprite.__init__(self, **kwargs)
+        if VectorSprite.motion is not None and self.alive():
+            values = {name: getattr(self, name) for name in MotionStore.attributes}
+            self.slot = VectorSprite.motion.add(self, values)
+
+    def kill(self):
+        if self.slot is not None:
+            # ---- keep the last values as normal attributes ----
+            for name in MotionStore.attributes:
+                self.__dict__[name] = VectorSprite.motion.get(self.slot, name)
+            VectorSprite.motion.remove(self.slot)
+            self.slot = None
+        VectorSprite.kill(self)
+
+for attribute in MotionStore.attributes:
+    setattr(StoredSprite, attribute, stored_attribute(attribute))
+
+
 class Wall(VectorSprite):
+    solid = True
+    defaults = {"z": 0} # terrain height
     
     def _overwrite_parameters(self):
         self.name = "wall"
+        self.static = True
         self._layer = 3
         #self.z = int(self.z)
         
@@ -384,9 +1017,12 @@ class Wall(VectorSprite):
         self.old_zoom = self.zoom
     
 class Turret(VectorSprite):
+    solid = True
+    defaults = {"z": 0}
     
     def _overwrite_parameters(self):
         self.name = "tower"
+        self.static = True
         self._layer = 3
         #self.z = int(self.z)
        
@@ -406,7 +1042,8 @@ class Turret(VectorSprite):
       
 
 
-class Javelin(VectorSprite):
+class Javelin(StoredSprite):
+    defaults = {"start_z": 0} # height at launch
     
     def _overwrite_parameters(self):
         self.speed = 150
@@ -420,7 +1057,8 @@ class Javelin(VectorSprite):
         VectorSprite.update(self, seconds)
 
 
-class Rock(VectorSprite):
+class Rock(StoredSprite):
+    defaults = {"start_z": 0}
     
     def _overwrite_parameters(self):
         self.speed = 150
@@ -447,14 +1085,17 @@ class Cannonball(VectorSprite):
         
     
     def create_image(self):
-        self.image = pygame.surface.Surface((20,20))    
+        # ---- paint again on the old image (also of a pooled Cannonball) instead of a new Surface ----
+        if self.image0 is None:
+            self.image0 = pygame.surface.Surface((20,20))
+            self.image0.set_colorkey((0,0,0))
+        self.image = self.image0
+        self.image.fill((0,0,0))
         z = min(255, self.pos3.z)
         z= max(0, self.pos3.z)
         pygame.draw.circle(self.image, (0,0,z), (10,10),10)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.image0 = self.image.copy()
         self.rect = self.image.get_rect()
+        self.dirty = 1 # same Surface, new picture
         
     def update(self, seconds):
         VectorSprite.update(self, seconds)
@@ -472,6 +1113,7 @@ class Cannonball(VectorSprite):
         #print(self.pos3, self.move3)
 
 class TileCursor(VectorSprite):
+    synced = False
     
     def _overwrite_parameters(self):
         pass
@@ -496,33 +1138,50 @@ class Ballista(VectorSprite):
     
     def _overwrite_parameters(self):
         self.speed = 3
+        self.wanted = None # (start tile, goal tile) of the path search
+        self.path = None   # tiles still to go, None while the search is running
+        self.target = None # world position of the last move command (Vector2)
     
     def create_image(self):
         self.image=Viewer.images["ballista1"]
         self.image0 = self.image.copy()
         self.rect = self.image.get_rect()
         
+    def waypoint(self, target):
+        """middle of the next tile on the path to target, or target itself while there is no path"""
+        if self.pathfinder is None:
+            return target
+        goal = self.pathfinder.tile_of(target)
+        if self.wanted is None or self.wanted[1] != goal:
+            self.wanted = (self.pathfinder.tile_of(self.pos), goal)
+            self.path = None
+        if self.path is None:
+            path = self.pathfinder.request_path(*self.wanted)
+            if path is None:
+                return target # still searching
+            self.path = list(path)
+        here = self.pathfinder.tile_of(self.pos)
+        if here in self.path:
+            del self.path[:self.path.index(here) + 1]
+        if not self.path:
+            return target
+        return self.pathfinder.center_of(self.path[0])
+        
     def update(self,seconds):
         VectorSprite.update(self,seconds)
-        # - - - - - - go to mouse cursor ------ #
-        target = mouseVector()
-        dist =target - self.pos
-        try:
-            dist.normalize_ip() #schrupmft ihn zur länge 1
-        except:
-            print("i could not normalize", dist)
-            return
-        dist *= self.speed  
-        rightvector = pygame.math.Vector2(1,0)
-        angle = -dist.angle_to(rightvector)
-        #print(angle)
-        #if self.angle == round(angle, 0):
-        if self.selected:
-            self.move = dist
-            self.set_angle(angle)
-            pygame.draw.rect(self.image, (0,200,0), (0,0,self.rect.width, self.rect.height),1)
+        # - - - - - - go to the target of the last move command (the same on all computers, not the own mouse) ------ #
+        if self.selected and self.target is not None:
+            dist = self.waypoint(self.target) - self.pos
+            if dist.length_squared() > 0:
+                dist.normalize_ip() #schrupmft ihn zur länge 1
+                dist *= self.speed  
+                rightvector = pygame.math.Vector2(1,0)
+                angle = -dist.angle_to(rightvector)
+                self.move = dist
+                self.set_angle(angle)
+                pygame.draw.rect(self.image, (0,200,0), (0,0,self.rect.width, self.rect.height),1)
         # ------ fire sometimes ----
-        if random.random() < 0.01:
+        if self.rng.random() < 0.01:
             p = pygame.math.Vector2(self.pos.x, self.pos.y)
             m = pygame.math.Vector2(1,0)
             m.rotate_ip(self.angle)
@@ -530,6 +1189,7 @@ class Ballista(VectorSprite):
             Javelin(pos=p,move=m, angle= self.angle, bossnumber=self.number)
 
 class Tile(VectorSprite):
+    defaults = {"tilesize": lambda: Viewer.tilesize}
     
     #def _overwrite_parameters(self):
     #    
@@ -549,6 +1209,8 @@ class Tile(VectorSprite):
          
 
 class Catapult(VectorSprite):
+    solid = True
+    defaults = {"z": 0}
     
     def _overwrite_parameters(self):
         self.name = "catapult"
@@ -562,10 +1224,10 @@ class Catapult(VectorSprite):
         if self.old_zoom != self.zoom:
             self.create_image()
         self.old_zoom = self.zoom
-        if random.random() < 0.01:
-            self.rotate(random.choice((-3,-2,-1,-1,0,1,1,2,3)))
+        if self.rng.random() < 0.01:
+            self.rotate(self.rng.choice((-3,-2,-1,-1,0,1,1,2,3)))
         VectorSprite.update(self, seconds)
-        if random.random() < 0.01:
+        if self.rng.random() < 0.01:
             m = pygame.math.Vector2(100,0)
             m.rotate_ip(self.angle)
             Rock(pos=pygame.math.Vector2(self.pos.x, self.pos.y), move=m, max_distance=1000, angle=self.angle, start_z=self.z+20, bossnumber=self.number, zoom=self.zoom)
@@ -574,7 +1236,7 @@ class Catapult(VectorSprite):
 
 
 class Swordgoblin(VectorSprite):
-    
+    solid = True
     
     def _overwrite_parameters(self):
         self._layer = 6
@@ -589,8 +1251,8 @@ class Swordgoblin(VectorSprite):
 
 
     def new_move(self):
-        self.angle = random.randint(0,360)
-        self.speed = random.randint(40,140)
+        self.angle = self.rng.randint(0,360)
+        self.speed = self.rng.randint(40,140)
         self.move = pygame.math.Vector2(self.speed, 0)
         self.move.rotate_ip(self.angle)
         self.set_angle(self.angle)
@@ -604,11 +1266,16 @@ class Swordgoblin(VectorSprite):
         bosspos = VectorSprite.numbers[self.bossnumber].pos
         dist =  self.pos - bosspos
         if dist.length() > self.guarding_range:
-            # rotate move vector to boss
-            angle = dist.angle_to(pygame.math.Vector2(1,0))
+            # rotate move vector to boss, around mountains and water along the flow field of the tent
+            way = None
+            if self.pathfinder is not None:
+                way = self.pathfinder.direction(self.pos, bosspos)
+            if way is None:
+                way = -dist # straight
+            angle = pygame.math.Vector2(1,0).angle_to(way)
             self.move = pygame.math.Vector2(100, 0)
-            self.move.rotate_ip(-angle+180)
-            self.set_angle(-angle+180)
+            self.move.rotate_ip(angle)
+            self.set_angle(angle)
         
     
     def update(self,seconds):
@@ -618,9 +1285,9 @@ class Swordgoblin(VectorSprite):
         self.old_zoom = self.zoom
 
         VectorSprite.update(self,seconds)
-        if random.random() < 0.002:
+        if self.rng.random() < 0.002:
             self.new_move()
-        if random.random() < 0.01:
+        if self.rng.random() < 0.01:
             m = pygame.math.Vector2(100,0)
             m.rotate_ip(self.angle)
             Javelin(pos=pygame.math.Vector2(self.pos.x, self.pos.y), move=m, max_distance=1000, angle=self.angle, start_z=self.z+20, bossnumber=self.number, zoom=self.zoom)
@@ -628,9 +1295,11 @@ class Swordgoblin(VectorSprite):
 
             
 class Tent(VectorSprite):
+    solid = True
     
     def _overwrite_parameters(self):
         self._layer = 7
+        self.static = True
         self.spawntime = 5.0
         self.spawn = 0
         self.name = "tent"
@@ -651,7 +1320,9 @@ class Tent(VectorSprite):
             self.spawn = 0
 
 
-class Flytext(VectorSprite):
+class Flytext(StoredSprite):
+    defaults = {"text": ""}
+    synced = False
     
     def _overwrite_parameters(self):
         self._layer = 7  # order of sprite layers (before / behind other sprites)
@@ -665,7 +1336,8 @@ class Flytext(VectorSprite):
         self.rect = self.image.get_rect()
         
 
-class Spark(VectorSprite):
+class Spark(StoredSprite):
+    synced = False
     
     def _overwrite_parameters(self):
         self._layer = 9
@@ -676,42 +1348,1852 @@ class Spark(VectorSprite):
         r = randomize_color(r,50)
         g = randomize_color(g,50)
         b = randomize_color(b,50)
-        self.image = pygame.Surface((10,10))
-        pygame.draw.line(self.image, (r,g,b), 
+        # ---- paint again on the image of a pooled Spark instead of a new Surface ----
+        if self.image0 is None:
+            self.image0 = pygame.Surface((10,10))
+            self.image0.set_colorkey((0,0,0))
+        self.image0.fill((0,0,0))
+        pygame.draw.line(self.image0, (r,g,b), 
                          (10,5), (5,5), 3)
-        pygame.draw.line(self.image, (r,g,b),
+        pygame.draw.line(self.image0, (r,g,b),
                           (5,5), (2,5), 1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        self.image = self.image0
         self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()                          
         
 
 class Explosion():
-    """emits a lot of sparks, for Explosion or Player engine"""
+    """emits a lot of sparks, for Explosion or Player engine.
+       The sparks go into the ParticleSystem Explosion.particles, or become Spark sprites if there is none."""
+    particles = None
+    rng = random.Random() # random stream of the sparks, seeded by the Viewer
+
     def __init__(self, posvector, minangle=0, maxangle=360, maxlifetime=3,
                  minspeed=5, maxspeed=150, red=255, red_delta=0, 
                  green=225, green_delta=25, blue=0, blue_delta=0,
                  minsparks=5, maxsparks=20):
-        for s in range(random.randint(minsparks,maxsparks)):
+        for s in range(Explosion.rng.randint(minsparks,maxsparks)):
             v = pygame.math.Vector2(1,0) # vector aiming right (0°)
-            a = random.randint(minangle,maxangle)
+            a = Explosion.rng.randint(minangle,maxangle)
             v.rotate_ip(a)
-            speed = random.randint(minspeed, maxspeed)
-            duration = random.random() * maxlifetime # in seconds
+            speed = Explosion.rng.randint(minspeed, maxspeed)
+            duration = Explosion.rng.random() * maxlifetime # in seconds
             red   = randomize_color(red, red_delta)
             green = randomize_color(green, green_delta)
             blue  = randomize_color(blue, blue_delta)
-            Spark(pos=pygame.math.Vector2(posvector.x, posvector.y),
-                  angle= a, move=v*speed, max_age = duration, 
-                  color=(red,green,blue), kill_on_edge = True)
+            if Explosion.particles is not None:
+                # same color variation as Spark.create_image
+                color = (randomize_color(red, 50), randomize_color(green, 50), randomize_color(blue, 50))
+                Explosion.particles.emit(posvector.x, posvector.y, v.x * speed, v.y * speed, duration, color, a)
+            else:
+                Spark(pos=pygame.math.Vector2(posvector.x, posvector.y),
+                      angle= a, move=v*speed, max_age = duration, 
+                      color=(red,green,blue), kill_on_edge = True)
 
 
-            
+class ParticleSystem(object):
+    """many short-lived sparks without sprites. Position, movement and age of all particles
+       are flat numpy arrays. Each particle is drawn with one of a few prerendered spark stamps
+       (the color is rounded to colorsteps, the angle to directions)."""
+
+    def __init__(self, max_particles=5000, directions=16, colorsteps=32):
+        self.max_particles = max_particles
+        self.directions = directions
+        self.colorsteps = colorsteps
+        self.count = 0 # particles 0...count-1 are alive
+        self.x = numpy.zeros(max_particles)
+        self.y = numpy.zeros(max_particles)
+        self.dx = numpy.zeros(max_particles)
+        self.dy = numpy.zeros(max_particles)
+        self.age = numpy.zeros(max_particles)
+        self.max_age = numpy.zeros(max_particles)
+        self.stamp = numpy.zeros(max_particles, dtype=numpy.int32)
+        self.stamps = []      # Surfaces
+        self.stamp_half = []  # half width and height of each stamp, to center it on the particle
+        self.stamp_keys = {}  # { (r, g, b, direction): index in self.stamps }
+        self.dropped = 0      # particles not emitted because max_particles were alive
+
+    def get_stamp(self, color, angle):
+        """returns the index of the prerendered spark image for color and angle, renders it if necessary"""
+        step = self.colorsteps
+        r, g, b = [min(255, int(c) // step * step + step // 2) for c in color]
+        direction = int(round(angle * self.directions / 360.0)) % self.directions
+        key = (r, g, b, direction)
+        if key not in self.stamp_keys:
+            # ---- same picture as Spark.create_image ----
+            image = pygame.Surface((10,10))
+            pygame.draw.line(image, (r,g,b), (10,5), (5,5), 3)
+            pygame.draw.line(image, (r,g,b), (5,5), (2,5), 1)
+            image = pygame.transform.rotate(image, direction * 360.0 / self.directions)
+            image.set_colorkey((0,0,0))
+            self.stamp_keys[key] = len(self.stamps)
+            self.stamps.append(image)
+            self.stamp_half.append((image.get_width() // 2, image.get_height() // 2))
+        return self.stamp_keys[key]
+
+    def emit(self, x, y, dx, dy, max_age, color, angle=0):
+        """adds one particle at world position x, y with movement dx, dy (pixel per second)"""
+        if self.count >= self.max_particles:
+            self.dropped += 1
+            return
+        i = self.count
+        self.x[i], self.y[i], self.dx[i], self.dy[i] = x, y, dx, dy
+        self.age[i] = 0
+        self.max_age[i] = max_age
+        self.stamp[i] = self.get_stamp(color, angle)
+        self.count += 1
+
+    def scale(self, factor):
+        """zooming: all positions and movements are multiplied by factor"""
+        n = self.count
+        for array in (self.x, self.y, self.dx, self.dy):
+            array[:n] *= factor
+
+    def update(self, seconds, offset_x, offset_y, width, height):
+        """moves all particles, removes old particles and particles outside the screen"""
+        n = self.count
+        self.x[:n] += self.dx[:n] * seconds
+        self.y[:n] += self.dy[:n] * seconds
+        self.age[:n] += seconds
+        screen_x = self.x[:n] + offset_x
+        screen_y = -self.y[:n] + offset_y
+        alive = ((self.age[:n] <= self.max_age[:n]) & (screen_x >= 0) & (screen_x <= width) &
+                 (screen_y >= 0) & (screen_y <= height))
+        if alive.all():
+            return
+        # ---- move the living particles to the front ----
+        keep = numpy.flatnonzero(alive)
+        for array in (self.x, self.y, self.dx, self.dy, self.age, self.max_age, self.stamp):
+            array[:len(keep)] = array[keep]
+        self.count = len(keep)
+
+    def draw(self, surface, offset_x, offset_y, cellsize=32):
+        """blits all particles in one batch (world position + offset, like VectorSprite.worldrect).
+           returns the changed screen area as a few rects: each cellsize x cellsize cell touched by a particle"""
+        n = self.count
+        if n == 0:
+            return []
+        half = numpy.array(self.stamp_half)[self.stamp[:n]]
+        screen_x = (self.x[:n] + offset_x).round().astype(int) - half[:, 0]
+        screen_y = (-self.y[:n] + offset_y).round().astype(int) - half[:, 1]
+        stamps = self.stamps
+        surface.blits([(stamps[i], (x, y)) for i, x, y in
+                       zip(self.stamp[:n].tolist(), screen_x.tolist(), screen_y.tolist())], False)
+        # ---- stamps are smaller than a cell: each particle touches the cells of its 4 corners ----
+        right = screen_x + half[:, 0] * 2
+        bottom = screen_y + half[:, 1] * 2
+        cells = numpy.unique(numpy.concatenate([(ys // cellsize + 1) * 65536 + xs // cellsize + 1
+                                                for xs in (screen_x, right) for ys in (screen_y, bottom)]))
+        return [pygame.Rect((cell % 65536 - 1) * cellsize, (cell // 65536 - 1) * cellsize, cellsize, cellsize)
+                for cell in cells.tolist()]
+
+
+class SpatialHash(object):
+    """uniform grid for fast neighbour queries between VectorSprites.
+       Each sprite is stored in the cell (cellsize x cellsize pixel) of its pos.
+       The sprites of a cell are kept in the order they came in (a dict, not a set), so that
+       pairs and queries come out in the same order in every run of the same game."""
+
+    def __init__(self, cellsize=32):
+        self.cellsize = cellsize
+        self.cells = {}        # { (cx, cy): { sprite: None } }
+        self.sprite_cells = {} # { sprite: (cx, cy) }
+        self.solid_radius = 0  # largest radius of the solid sprites (noted by the sprites), for pairs
+
+    def cell_of(self, pos):
+        return (int(pos.x // self.cellsize), int(pos.y // self.cellsize))
+
+    def note_radius(self, radius):
+        """keeps solid_radius at least as big as the radius of a solid sprite"""
+        if radius > self.solid_radius:
+            self.solid_radius = radius
+
+    def update(self, sprite):
+        """insert sprite or move it into the cell of its current pos"""
+        cell = self.cell_of(sprite.pos)
+        old = self.sprite_cells.get(sprite)
+        if old == cell:
+            return
+        if old is not None:
+            del self.cells[old][sprite]
+            if not self.cells[old]:
+                del self.cells[old]
+        self.cells.setdefault(cell, {})[sprite] = None
+        self.sprite_cells[sprite] = cell
+
+    def remove(self, sprite):
+        cell = self.sprite_cells.pop(sprite, None)
+        if cell is not None:
+            del self.cells[cell][sprite]
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def rebuild(self, cellsize=None):
+        """sort all sprites again, for example after zooming (all positions changed)"""
+        if cellsize is not None:
+            self.cellsize = cellsize
+        sprites = list(self.sprite_cells)
+        self.cells = {}
+        self.sprite_cells = {}
+        for sprite in sprites:
+            self.update(sprite)
+
+    def query_radius(self, pos, radius, condition=None):
+        """returns a list of all sprites within radius around pos (a Vector2)"""
+        cx0, cy0 = int((pos.x - radius) // self.cellsize), int((pos.y - radius) // self.cellsize)
+        cx1, cy1 = int((pos.x + radius) // self.cellsize), int((pos.y + radius) // self.cellsize)
+        radius2 = radius * radius
+        found = []
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                for sprite in self.cells.get((cx, cy), ()):
+                    if (sprite.pos - pos).length_squared() <= radius2:
+                        if condition is None or condition(sprite):
+                            found.append(sprite)
+        return found
+
+    def nearest(self, pos, max_radius, condition=None):
+        """returns the nearest sprite to pos within max_radius (for which condition(sprite) is True) or None.
+           Searches ring by ring of cells, starting with the cell of pos."""
+        cx, cy = self.cell_of(pos)
+        best, best_distance2 = None, max_radius * max_radius
+        rings = int(max_radius // self.cellsize) + 1
+        for ring in range(rings + 1):
+            # every sprite in a further ring is at least (ring-1) cells away
+            if best is not None and ((ring - 1) * self.cellsize) ** 2 > best_distance2:
+                break
+            for x in range(cx - ring, cx + ring + 1):
+                for y in range(cy - ring, cy + ring + 1):
+                    if max(abs(x - cx), abs(y - cy)) != ring:
+                        continue # inner cells are already done
+                    for sprite in self.cells.get((x, y), ()):
+                        distance2 = (sprite.pos - pos).length_squared()
+                        if distance2 <= best_distance2 and (condition is None or condition(sprite)):
+                            best, best_distance2 = sprite, distance2
+        return best
+
+    def pairs(self, condition=None, distance=0):
+        """yields every pair of sprites (for which condition(sprite) is True) whose cells are near enough
+           that the sprites can be up to distance pixel apart (at least the neighbouring cells), once"""
+        if condition is None:
+            members = {cell: list(sprites) for cell, sprites in self.cells.items()}
+        else:
+            members = {}
+            for cell, sprites in self.cells.items():
+                selected = [s for s in sprites if condition(s)]
+                if selected:
+                    members[cell] = selected
+        # ---- only half of the near cells, so that each pair of cells is visited once ----
+        reach = max(1, int(-(-distance // self.cellsize))) # rounded up
+        offsets = [(dx, dy) for dy in range(reach + 1) for dx in range(-reach, reach + 1) if dy > 0 or dx > 0]
+        for (cx, cy), sprites in members.items():
+            for i, a in enumerate(sprites):
+                for b in sprites[i+1:]:
+                    yield a, b
+            for dx, dy in offsets:
+                for b in members.get((cx + dx, cy + dy), ()):
+                    for a in sprites:
+                        yield a, b
+
+
+class PagedLevel(object):
+    """one level of the height pyramid of a PagedHeightmap, usable like a 2d numpy array
+       (rows, columns) of heights: shape, dtype, [slice, slice], [row, column] and
+       [row array, column array]. Only the pages touched by an index are read.
+       Single heights can be changed ([row, column] = height), they stay in memory."""
+
+    ndim = 2
+
+    def __init__(self, heightmap, level, shape):
+        self.heightmap = heightmap
+        self.level = level
+        self.shape = shape
+        self.size = shape[0] * shape[1]
+        self.dtype = heightmap.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        heights = self[:, :]
+        return heights if dtype is None else heights.astype(dtype)
+
+    def span(self, index, axis):
+        """(start, stop) of a slice along axis, like numpy clamped to the array"""
+        start, stop, step = index.indices(self.shape[axis])
+        if step != 1:
+            raise IndexError("PagedLevel slices can not have a step")
+        return start, max(start, stop)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index, slice(None))
+        rows, columns = index
+        if isinstance(rows, slice) and isinstance(columns, slice):
+            return self.block(*self.span(rows, 0), *self.span(columns, 1))
+        if isinstance(rows, slice) or isinstance(columns, slice):
+            raise IndexError("PagedLevel can not mix slices and numbers, use [a:b, c:d]")
+        if (isinstance(rows, (int, numpy.integer)) and isinstance(columns, (int, numpy.integer)) and
+                0 <= rows < self.shape[0] and 0 <= columns < self.shape[1]):
+            size = self.heightmap.pagesize
+            return self.heightmap.get_page(self.level, rows // size, columns // size)[rows % size, columns % size]
+        rows, columns = self.check(rows, columns)
+        if rows.ndim == 0:
+            size = self.heightmap.pagesize
+            return self.heightmap.get_page(self.level, rows // size, columns // size)[rows % size, columns % size]
+        return self.gather(rows, columns)
+
+    def __setitem__(self, index, height):
+        rows, columns = self.check(*index)
+        if rows.ndim != 0:
+            raise IndexError("PagedLevel can only change single heights")
+        self.heightmap.set_height(self.level, int(rows), int(columns), height)
+
+    def check(self, rows, columns):
+        """row and column index arrays, negative numbers count from the end like in numpy"""
+        rows, columns = numpy.broadcast_arrays(numpy.asarray(rows, dtype=numpy.intp),
+                                               numpy.asarray(columns, dtype=numpy.intp))
+        rows = numpy.where(rows < 0, rows + self.shape[0], rows)
+        columns = numpy.where(columns < 0, columns + self.shape[1], columns)
+        if ((rows < 0) | (rows >= self.shape[0]) | (columns < 0) | (columns >= self.shape[1])).any():
+            raise IndexError("index out of bounds for PagedLevel of shape {}".format(self.shape))
+        return rows, columns
+
+    def block(self, row0, row1, column0, column1):
+        """copy of rows row0..row1-1, columns column0..column1-1"""
+        result = numpy.empty((row1 - row0, column1 - column0), dtype=self.dtype)
+        if row0 >= row1 or column0 >= column1:
+            return result
+        size = self.heightmap.pagesize
+        for py in range(row0 // size, -(-row1 // size)):
+            top, bottom = max(row0, py * size), min(row1, (py + 1) * size)
+            for px in range(column0 // size, -(-column1 // size)):
+                left, right = max(column0, px * size), min(column1, (px + 1) * size)
+                page = self.heightmap.get_page(self.level, py, px)
+                result[top-row0:bottom-row0, left-column0:right-column0] = \
+                    page[top-py*size:bottom-py*size, left-px*size:right-px*size]
+        return result
+
+    def gather(self, rows, columns):
+        """heights of index arrays, each page is visited once"""
+        size = self.heightmap.pagesize
+        page_columns = -(-self.shape[1] // size)
+        rows = rows.ravel()
+        columns = columns.ravel()
+        pages, inverse = numpy.unique((rows // size) * page_columns + columns // size, return_inverse=True)
+        order = numpy.argsort(inverse, kind="stable")
+        bounds = numpy.searchsorted(inverse[order], numpy.arange(len(pages) + 1))
+        result = numpy.empty(rows.shape, dtype=self.dtype)
+        for number, page_number in enumerate(pages):
+            chosen = order[bounds[number]:bounds[number+1]]
+            page = self.heightmap.get_page(self.level, int(page_number) // page_columns, int(page_number) % page_columns)
+            result[chosen] = page[rows[chosen] % size, columns[chosen] % size]
+        return result
+
+
+class PagedHeightmap(object):
+    """heightmap in a paged file (see save_paged_heightmap) that is read page by page when used.
+       levels are the height pyramid as PagedLevel arrays, levels[0] is the map itself.
+       At most max_bytes of pages are kept: the pages farthest away from the focus (a row and
+       column of the map, usually the screen center) are forgotten first, of equally far pages
+       the least recently used. Pages with changed heights are never forgotten (the file is
+       never written). Thread safe: the job threads read pages too."""
+
+    def __init__(self, filename, max_bytes=64*1024*1024):
+        with open(filename, "rb") as f:
+            header = f.read(PAGEMAP_HEADER.size)
+            if len(header) < PAGEMAP_HEADER.size:
+                raise ValueError("{} is too short for a paged heightmap header".format(filename))
+            magic, version, itemsize, compressed, reduce, _, pagesize, count, table = PAGEMAP_HEADER.unpack(header)
+            if magic != PAGEMAP_MAGIC:
+                raise ValueError("{} is not a paged heightmap".format(filename))
+            if version != PAGEMAP_VERSION or itemsize not in HEIGHTMAP_DTYPES:
+                raise ValueError("{}: unsupported paged heightmap version {} / sample size {}".format(filename, version, itemsize))
+            f.seek(table)
+            entries = [PAGEMAP_LEVEL.unpack(f.read(PAGEMAP_LEVEL.size)) for level in range(count)]
+        self.filename = filename
+        self.dtype = HEIGHTMAP_DTYPES[itemsize]
+        self.compressed = bool(compressed)
+        self.reduce = {number: name for name, number in PAGEMAP_REDUCE.items()}[reduce]
+        self.pagesize = pagesize
+        # ---- the page indexes stay on disk too ----
+        self.indexes = [numpy.memmap(filename, dtype=PAGEMAP_INDEX, mode="r", offset=offset,
+                                     shape=(-(-height // pagesize), -(-width // pagesize)))
+                        for width, height, offset in entries]
+        self.levels = [PagedLevel(self, level, (height, width)) for level, (width, height, offset) in enumerate(entries)]
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.pages = collections.OrderedDict() # { (level, py, px): 2d array }
+        self.changed = set() # keys of pages with changed heights
+        self.focus = (0, 0)  # row, column of level 0
+        self.reads = 0 # pages read from the file
+        self.lock = threading.Lock()
+
+    def get_page(self, level, py, px):
+        """the heights of page py, px of level, read from the file if they are not in memory"""
+        key = (level, py, px)
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+                return page
+        page = self.read_page(key) # outside the lock: other threads go on meanwhile
+        with self.lock:
+            return self.add_page(key, page)
+
+    def read_page(self, key):
+        level, py, px = key
+        offset, length = self.indexes[level][py, px]
+        with open(self.filename, "rb") as f:
+            f.seek(int(offset))
+            data = f.read(int(length))
+        if self.compressed:
+            data = zlib.decompress(data)
+        rows, columns = self.levels[level].shape
+        shape = (min(self.pagesize, rows - py * self.pagesize), min(self.pagesize, columns - px * self.pagesize))
+        return numpy.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    def add_page(self, key, page):
+        """puts a page into memory (the lock must be held), returns the page kept for key"""
+        if key in self.pages:
+            return self.pages[key] # read by another thread meanwhile
+        self.pages[key] = page
+        self.bytes += page.nbytes
+        self.reads += 1
+        while self.bytes > self.max_bytes and len(self.pages) > len(self.changed) + 1:
+            self.forget_farthest()
+        return page
+
+    def distance(self, key):
+        """distance of the page center from the focus, in rows / columns of level 0"""
+        level, py, px = key
+        span = self.pagesize * 2 ** level
+        return max(abs((py + 0.5) * span - self.focus[0]), abs((px + 0.5) * span - self.focus[1]))
+
+    def forget_farthest(self):
+        keys = [key for key in itertools.islice(self.pages, len(self.pages) - 1) if key not in self.changed]
+        key = max(keys, key=self.distance) # the first of equally far keys is the least recently used
+        self.bytes -= self.pages.pop(key).nbytes
+
+    def set_height(self, level, row, column, height):
+        key = (level, row // self.pagesize, column // self.pagesize)
+        page = self.get_page(*key)
+        with self.lock:
+            if key not in self.changed:
+                # pages from the file are read-only
+                page = self.pages[key] = page.copy()
+                self.changed.add(key)
+            page[row % self.pagesize, column % self.pagesize] = height
+
+    def set_focus(self, row, column):
+        """pages near row, column (of level 0) are forgotten last"""
+        self.focus = (row, column)
+
+    def missing(self, level, row0, row1, column0, column1):
+        """keys of the pages of level with rows row0..row1-1, columns column0..column1-1 that are not in memory"""
+        rows, columns = self.levels[level].shape
+        row0, row1 = max(row0, 0), min(row1, rows)
+        column0, column1 = max(column0, 0), min(column1, columns)
+        size = self.pagesize
+        with self.lock:
+            return [(level, py, px) for py in range(row0 // size, -(-row1 // size))
+                    for px in range(column0 // size, -(-column1 // size)) if (level, py, px) not in self.pages]
+
+    def read_pages(self, job, keys):
+        """job function for JobPool: reads the pages of keys into memory"""
+        for number, key in enumerate(keys):
+            self.get_page(*key)
+            job.report((number + 1) / len(keys))
+        return len(keys)
+
+    def loaded(self, rows, columns):
+        """True for each row, column (arrays, of level 0) whose page is in memory.
+           Positions off the map count as loaded: there is nothing to read for them."""
+        rows = numpy.asarray(rows, dtype=numpy.intp)
+        columns = numpy.asarray(columns, dtype=numpy.intp)
+        height, width = self.levels[0].shape
+        inside = (rows >= 0) & (rows < height) & (columns >= 0) & (columns < width)
+        page_columns = -(-width // self.pagesize)
+        numbers = numpy.where(inside, (rows // self.pagesize) * page_columns + columns // self.pagesize, -1)
+        pages, inverse = numpy.unique(numbers, return_inverse=True)
+        with self.lock:
+            flags = numpy.array([number < 0 or (0, int(number) // page_columns, int(number) % page_columns) in self.pages
+                                 for number in pages], dtype=bool)
+        return flags[inverse.reshape(numbers.shape)]
+
+
+class TerrainCache(object):
+    """prerendered terrain. The heightmap is split into chunks of chunksize x chunksize tiles.
+       Each chunk is rendered only once per tilesize (and grid setting) and kept as Surface.
+       The least recently used chunks are forgotten when the cache grows over max_bytes.
+       For tilesizes below 1 pixel the chunks are painted from a smaller level of a
+       height pyramid (each level half as wide and high as the level before), so that
+       every painted cell is at least one pixel big. A ready pyramid (like the levels of
+       a PagedHeightmap) can be given as levels."""
+
+    def __init__(self, heights, chunksize=32, max_bytes=256*1024*1024, palette=None,
+                 reduce="max", max_chunk_pixels=512, levels=None):
+        self.heights = heights # 2d array (rows, columns)
+        self.chunksize = chunksize # power of 2
+        self.max_bytes = max_bytes
+        self.max_chunk_pixels = max_chunk_pixels # smaller chunks when zoomed in
+        self.bytes = 0
+        self.chunks = collections.OrderedDict() # { (tilesize, grid, level, cells, cx, cy): Surface }
+        # ---- lowest and highest height of each rendered chunk, to find chunks touched by water level changes ----
+        self.ranges = {} # { key of self.chunks: (lowest, highest) }
+        self.waterheight = 0
+        # ---- one color for each possible height value ----
+        self.max_height = 255 if heights.dtype.itemsize == 1 else 65535
+        if palette is None:
+            palette = make_height_palette(self.max_height + 1)
+        self.palette = palette
+        self.colors = water_palette(self.palette, self.waterheight)
+        # ---- height pyramid: level 0 is the map, level 1 has half the width and height... ----
+        self.reduce = reduce # "max" (mountains stay visible) or "mean"
+        if levels is None:
+            levels = [heights]
+            while max(levels[-1].shape) > 1:
+                levels.append(self.halve(levels[-1]))
+        self.levels = levels
+
+    def halve(self, heights):
+        """returns the next pyramid level: one cell for each 2x2 block of heights"""
+        return halve_heights(heights, self.reduce)
+
+    def level_for(self, tilesize):
+        """returns (level, cells): the pyramid level used for tilesize and the number of cells per chunk side"""
+        level = 0
+        while tilesize * 2 ** level < 1 and level < len(self.levels) - 1:
+            level += 1
+        cellpixels = tilesize * 2 ** level
+        cells = self.chunksize
+        while cells > 1 and cells * cellpixels > self.max_chunk_pixels:
+            cells //= 2
+        return level, cells
+
+    def get_chunk(self, cx, cy, tilesize, grid=False):
+        """returns the Surface of chunk (cx, cy), renders it if it is not in the cache"""
+        level, cells = self.level_for(tilesize)
+        key = (tilesize, grid, level, cells, cx, cy)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        chunk = self.render_chunk(cx, cy, tilesize, grid, level, cells)
+        self.add_chunk(key, chunk)
+        return chunk
+
+    def add_chunk(self, key, chunk, colors=None):
+        """puts a rendered chunk into the cache. colors are the colors it was rendered with: a chunk
+           rendered in the background is dropped if the water level or palette changed meanwhile.
+           Returns True if the chunk was added."""
+        if (colors is not None and colors is not self.colors) or key in self.chunks:
+            return False
+        tilesize, grid, level, cells, cx, cy = key
+        heights = self.levels[level][cy*cells:(cy+1)*cells, cx*cells:(cx+1)*cells]
+        self.ranges[key] = (int(heights.min()), int(heights.max())) if heights.size else (0, 0)
+        self.chunks[key] = chunk
+        self.bytes += chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+        while self.bytes > self.max_bytes and len(self.chunks) > 1:
+            # ---- forget least recently used chunk ----
+            old_key, old_chunk = self.chunks.popitem(last=False)
+            del self.ranges[old_key]
+            self.bytes -= old_chunk.get_width() * old_chunk.get_height() * old_chunk.get_bytesize()
+        return True
+
+    def missing_chunks(self, rect, offset_x, offset_y, tilesize, grid=False):
+        """keys of the chunks inside rect (screen pixel) that are not rendered yet"""
+        level, cells = self.level_for(tilesize)
+        return [(tilesize, grid, level, cells, cx, cy)
+                for cx, cy, x, y in self.visible_chunks(rect, offset_x, offset_y, tilesize)
+                if (tilesize, grid, level, cells, cx, cy) not in self.chunks]
+
+    def render_chunks(self, job, keys, colors):
+        """job function for JobPool: renders the chunks of keys with colors (without touching the cache),
+           returns [ (key, Surface) ] for add_chunk in the main thread"""
+        rendered = []
+        for key in keys:
+            tilesize, grid, level, cells, cx, cy = key
+            rendered.append((key, self.render_chunk(cx, cy, tilesize, grid, level, cells, colors)))
+            job.report(len(rendered) / len(keys))
+        return rendered
+
+    def render_chunk(self, cx, cy, tilesize, grid, level, cells, colors=None):
+        if colors is None:
+            colors = self.colors
+        heights = self.levels[level][cy*cells:(cy+1)*cells, cx*cells:(cx+1)*cells]
+        rows, columns = heights.shape
+        cellpixels = tilesize * 2 ** level
+        # cell borders are rounded in screen pixels, so that non-integer sizes leave no gaps between chunks
+        x0 = int(round(cx * cells * cellpixels))
+        y0 = int(round(cy * cells * cellpixels))
+        xs = [int(round((cx * cells + x) * cellpixels)) - x0 for x in range(columns+1)]
+        ys = [int(round((cy * cells + y) * cellpixels)) - y0 for y in range(rows+1)]
+        chunk = heights_to_surface(heights, colors) # one pixel per cell
+        chunk = pygame.transform.scale(chunk, (max(1, xs[-1]), max(1, ys[-1])))
+        if grid and level == 0:
+            for x in xs:
+                pygame.draw.line(chunk, (255,255,255), (x, 0), (x, ys[-1]))
+            for y in ys:
+                pygame.draw.line(chunk, (255,255,255), (0, y), (xs[-1], y))
+        return chunk
+
+    def forget(self, keys):
+        for key in keys:
+            chunk = self.chunks.pop(key)
+            del self.ranges[key]
+            self.bytes -= chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+
+    def invalidate(self, x0, y0, x1, y1):
+        """forget all rendered chunks (of all zoom levels) showing a tile from (x0, y0) to (x1, y1), including both"""
+        touched = []
+        for key in self.chunks:
+            tilesize, grid, level, cells, cx, cy = key
+            span = cells * 2 ** level # tiles per chunk side
+            if cx * span <= x1 and (cx + 1) * span > x0 and cy * span <= y1 and (cy + 1) * span > y0:
+                touched.append(key)
+        self.forget(touched)
+
+    def set_height(self, x, y, number):
+        """changes the height of tile x, y and forgets only the chunks containing it"""
+        self.heights[y, x] = number
+        self.invalidate(x, y, x, y)
+        for level in range(len(self.levels)):
+            if level > 0:
+                # ---- recalculate the pyramid cell above ----
+                x, y = x // 2, y // 2
+                block = self.levels[level-1][y*2:y*2+2, x*2:x*2+2]
+                self.levels[level][y, x] = self.halve(block)[0, 0]
+
+    def set_waterheight(self, waterheight):
+        """changes the water level and forgets only the chunks with cells between old and new water level"""
+        if waterheight == self.waterheight:
+            return
+        low, high = sorted((self.waterheight, waterheight))
+        self.waterheight = waterheight
+        self.colors = water_palette(self.palette, self.waterheight)
+        # a cell changes its color if low <= height < high
+        self.forget([key for key, (lowest, highest) in self.ranges.items() if highest >= low and lowest < high])
+
+    def set_palette(self, palette):
+        """changes the colors of all heights (a (max_height+1, 3) uint8 array) and forgets all chunks"""
+        self.palette = palette
+        self.colors = water_palette(self.palette, self.waterheight)
+        self.chunks.clear()
+        self.ranges.clear()
+        self.bytes = 0
+
+    def visible_chunks(self, rect, offset_x, offset_y, tilesize):
+        """[ (cx, cy, x, y) ] for the chunks inside rect (screen pixel) and their screen positions.
+           offset_x, offset_y is the screen position (pixel) of tile 0,0"""
+        level, cells = self.level_for(tilesize)
+        rows, columns = self.levels[level].shape
+        chunkpixels = cells * tilesize * 2 ** level
+        # round the offset first, so that strips painted after a scroll fit pixel exact to the old picture
+        offset_x = int(round(offset_x))
+        offset_y = int(round(offset_y))
+        cx0 = max(0, int((rect.left - offset_x) // chunkpixels))
+        cy0 = max(0, int((rect.top - offset_y) // chunkpixels))
+        cx1 = min(-(-columns // cells) - 1, int((rect.right - 1 - offset_x) // chunkpixels))
+        cy1 = min(-(-rows // cells) - 1, int((rect.bottom - 1 - offset_y) // chunkpixels))
+        return [(cx, cy, int(round(cx * chunkpixels)) + offset_x, int(round(cy * chunkpixels)) + offset_y)
+                for cy in range(cy0, cy1 + 1) for cx in range(cx0, cx1 + 1)]
+
+    def draw(self, surface, offset_x, offset_y, tilesize, grid=False):
+        """blits all chunks visible inside the clip area of surface.
+           offset_x, offset_y is the screen position (pixel) of tile 0,0"""
+        for cx, cy, x, y in self.visible_chunks(surface.get_clip(), offset_x, offset_y, tilesize):
+            surface.blit(self.get_chunk(cx, cy, tilesize, grid), (x, y))
+
+
+class TerrainQuery(object):
+    """height questions about the map for world positions in pixel (like VectorSprite.pos:
+       x grows to the right, y is 0 at the top of the map and negative below it).
+       The tile in column c and row r covers c*tilesize <= x < (c+1)*tilesize and
+       r*tilesize <= -y < (r+1)*tilesize. Positions outside the map are answered with
+       the outside value (exact and smooth heights) or as if the border tiles went on
+       forever (slope and normal); no query raises an exception for them."""
+
+    def __init__(self, heights, tilesize=32, outside=-1):
+        self.heights = heights # 2d array (rows, columns)
+        self.rows, self.columns = heights.shape
+        self.tilesize = tilesize # pixel per tile, follows the zoom
+        self.outside = outside
+
+    def tile_of(self, x, y):
+        """(column, row) of the tile under a world position, also outside the map"""
+        return int(x // self.tilesize), int(-y // self.tilesize)
+
+    def inside(self, x, y):
+        column, row = self.tile_of(x, y)
+        return 0 <= column < self.columns and 0 <= row < self.rows
+
+    def height_at(self, x, y):
+        """height of the tile under a world position, or outside"""
+        column, row = self.tile_of(x, y)
+        if 0 <= column < self.columns and 0 <= row < self.rows:
+            return int(self.heights[row, column])
+        return self.outside
+
+    def smooth_height_at(self, x, y):
+        """bilinear interpolation between the centers of the four nearest tiles, or outside"""
+        if not self.inside(x, y):
+            return self.outside
+        return self._bilinear(x / self.tilesize - 0.5, -y / self.tilesize - 0.5)
+
+    def slope_at(self, x, y):
+        """Vector2 (dz/dx, dz/dy) of the smooth surface in height units per tile.
+           Like the world y axis, dz/dy is positive when the ground rises towards the top of the map"""
+        u = x / self.tilesize - 0.5
+        v = -y / self.tilesize - 0.5
+        return pygame.math.Vector2(self._bilinear(u + 0.5, v) - self._bilinear(u - 0.5, v),
+                                   self._bilinear(u, v - 0.5) - self._bilinear(u, v + 0.5))
+
+    def normal_at(self, x, y, height_scale=1.0):
+        """upward unit Vector3 of the smooth surface. height_scale is the size of one height unit in tiles"""
+        slope = self.slope_at(x, y) * height_scale
+        return pygame.math.Vector3(-slope.x, -slope.y, 1).normalize()
+
+    def heights_at(self, xs, ys, smooth=False):
+        """heights for whole arrays of world positions in one call (e.g. all projectiles).
+           Exact heights come as int32 array, smooth heights as float array; outside where off the map"""
+        u = numpy.asarray(xs, dtype=numpy.float64) / self.tilesize
+        v = numpy.asarray(ys, dtype=numpy.float64) / -self.tilesize
+        columns = numpy.floor(u).astype(numpy.intp)
+        rows = numpy.floor(v).astype(numpy.intp)
+        inside = (columns >= 0) & (columns < self.columns) & (rows >= 0) & (rows < self.rows)
+        if smooth:
+            result = numpy.full(u.shape, self.outside, dtype=numpy.float64)
+            result[inside] = self._bilinear_array(u[inside] - 0.5, v[inside] - 0.5)
+        else:
+            result = numpy.full(u.shape, self.outside, dtype=numpy.int32)
+            result[inside] = self.heights[rows[inside], columns[inside]]
+        return result
+
+    def sweep_hits(self, xs0, ys0, xs1, ys1, z):
+        """swept heights_at: walks every line (xs0, ys0) -> (xs1, ys1) (1d arrays) tile by tile
+           (a DDA, for all lines together) and finds the first tile higher than z (array or number).
+           Returns (hit, hit_xs, hit_ys): which lines hit a tile, and the world position where
+           they enter it (their start if they start inside it). Tiles off the map are never hit.
+           One numpy round per crossed tile of the longest line that is still flying."""
+        xs0 = numpy.asarray(xs0, dtype=numpy.float64)
+        ys0 = numpy.asarray(ys0, dtype=numpy.float64)
+        dx = numpy.asarray(xs1, dtype=numpy.float64) - xs0
+        dy = numpy.asarray(ys1, dtype=numpy.float64) - ys0
+        hit_t = numpy.full(xs0.shape, numpy.nan) # 0 at the start, 1 at the end of the line
+        # ---- in tile coordinates: u to the right, v down the rows ----
+        u = xs0 / self.tilesize
+        v = ys0 / -self.tilesize
+        du = dx / self.tilesize
+        dv = dy / -self.tilesize
+        column = numpy.floor(u).astype(numpy.intp)
+        row = numpy.floor(v).astype(numpy.intp)
+        tiles = (numpy.abs(numpy.floor(u + du).astype(numpy.intp) - column) +
+                 numpy.abs(numpy.floor(v + dv).astype(numpy.intp) - row)) # tile borders crossed
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            # ---- line parameter t of the next column / row border, and between two borders ----
+            delta_u = numpy.where(du != 0, 1 / numpy.abs(du), numpy.inf)
+            delta_v = numpy.where(dv != 0, 1 / numpy.abs(dv), numpy.inf)
+            next_u = numpy.where(du > 0, column + 1 - u, u - column) * delta_u
+            next_v = numpy.where(dv > 0, row + 1 - v, v - row) * delta_v
+        next_u[du == 0] = numpy.inf
+        next_v[dv == 0] = numpy.inf
+        step_u = numpy.sign(du).astype(numpy.intp)
+        step_v = numpy.sign(dv).astype(numpy.intp)
+        z = numpy.broadcast_to(numpy.asarray(z, dtype=numpy.float64), xs0.shape)
+        t = numpy.zeros(xs0.shape)
+        index = numpy.arange(xs0.size)
+        crossed = 0
+        while index.size:
+            inside = (column >= 0) & (column < self.columns) & (row >= 0) & (row < self.rows)
+            heights = numpy.full(index.shape, -numpy.inf)
+            heights[inside] = self.heights[row[inside], column[inside]]
+            hit = heights > z
+            hit_t[index[hit]] = t[hit]
+            flying = ~hit & (tiles > crossed)
+            index, column, row, tiles, z, t = (a[flying] for a in (index, column, row, tiles, z, t))
+            next_u, next_v, delta_u, delta_v, step_u, step_v = (
+                a[flying] for a in (next_u, next_v, delta_u, delta_v, step_u, step_v))
+            # ---- into the next tile, over the nearer border ----
+            along_u = next_u < next_v
+            t = numpy.where(along_u, next_u, next_v)
+            column += step_u * along_u
+            row += step_v * ~along_u
+            next_u = numpy.where(along_u, next_u + delta_u, next_u)
+            next_v = numpy.where(along_u, next_v, next_v + delta_v)
+            crossed += 1
+        hit = ~numpy.isnan(hit_t)
+        return hit, xs0 + hit_t * dx, ys0 + hit_t * dy
+
+    def _bilinear(self, u, v):
+        """smooth height at tile coordinates (u, v) = (0, 0) in the center of the first tile.
+           Points beyond the border use the border tiles."""
+        c0 = int(u // 1)
+        r0 = int(v // 1)
+        fu = u - c0
+        fv = v - r0
+        c1 = min(max(c0 + 1, 0), self.columns - 1)
+        r1 = min(max(r0 + 1, 0), self.rows - 1)
+        c0 = min(max(c0, 0), self.columns - 1)
+        r0 = min(max(r0, 0), self.rows - 1)
+        h = self.heights
+        top = float(h[r0, c0]) * (1 - fu) + float(h[r0, c1]) * fu
+        bottom = float(h[r1, c0]) * (1 - fu) + float(h[r1, c1]) * fu
+        return top * (1 - fv) + bottom * fv
+
+    def _bilinear_array(self, u, v):
+        """_bilinear for arrays of tile coordinates"""
+        c0 = numpy.floor(u)
+        r0 = numpy.floor(v)
+        fu = u - c0
+        fv = v - r0
+        c0 = c0.astype(numpy.intp)
+        r0 = r0.astype(numpy.intp)
+        c1 = numpy.clip(c0 + 1, 0, self.columns - 1)
+        r1 = numpy.clip(r0 + 1, 0, self.rows - 1)
+        numpy.clip(c0, 0, self.columns - 1, out=c0)
+        numpy.clip(r0, 0, self.rows - 1, out=r0)
+        h = self.heights
+        top = h[r0, c0] * (1 - fu) + h[r0, c1] * fu
+        bottom = h[r1, c0] * (1 - fu) + h[r1, c1] * fu
+        return top * (1 - fv) + bottom * fv
+
+
+class FlowField(object):
+    """directions towards one goal tile for all tiles of a square window around it.
+       Made once by PathFinder (in the background of update) and shared by every unit with the same goal."""
+
+    def __init__(self, goal, row0, column0, directions, distances):
+        self.goal = goal # (row, column)
+        self.row0 = row0 # first row and column of the window
+        self.column0 = column0
+        self.directions = directions # 2d array: index into PathFinder.neighbours, -1 = no way / arrived
+        self.distances = distances   # 2d array: path cost to the goal, inf = no way
+
+    def direction_at(self, tile):
+        """(row step, column step) of the cheapest way on from tile, or None (outside the window, no way, at the goal)"""
+        row = tile[0] - self.row0
+        column = tile[1] - self.column0
+        rows, columns = self.directions.shape
+        if not (0 <= row < rows and 0 <= column < columns):
+            return None
+        index = self.directions[row, column]
+        if index < 0:
+            return None
+        return PathFinder.neighbours[index][:2]
+
+
+class PathFinder(object):
+    """terrain aware paths over the heightmap. All tiles are (row, column) tuples.
+       Walking onto a tile costs 1 + slope_cost * slope (highest height difference to the four
+       neighbours); tiles steeper than max_slope and tiles under the water are blocked.
+       Single units get hierarchical A* (HPA*) paths: the map is cut into clusters of cluster x cluster
+       tiles, and the entrances between clusters and the costs between the entrances of one cluster
+       are found when a search needs them first, then cached. Many units with the same goal share a FlowField.
+       Searches and flow fields that units ask for are made a little per update, never all at once.
+       Costs, paths and flow fields are forgotten when the terrain under them changes."""
+    # ---- (row step, column step, length) to the 8 neighbours ----
+    neighbours = ((-1, 0, 1.0), (1, 0, 1.0), (0, -1, 1.0), (0, 1, 1.0),
+                  (-1, -1, 2 ** 0.5), (-1, 1, 2 ** 0.5), (1, -1, 2 ** 0.5), (1, 1, 2 ** 0.5))
+
+    def __init__(self, ground, waterheight=0, cluster=16, slope_cost=0.1, max_slope=40,
+                 max_paths=1000, flow_radius=32, expansions=64, greed=1.0, max_fields=200):
+        self.ground = ground # TerrainQuery: heights and conversion of world positions
+        self.rows, self.columns = ground.heights.shape
+        self.waterheight = waterheight
+        self.cluster = cluster
+        self.slope_cost = slope_cost
+        self.max_slope = max_slope
+        self.max_paths = max_paths
+        self.max_fields = max_fields
+        self.expansions = expansions # entrances a search visits before it yields
+        self.greed = greed # weight of the distance estimate: above 1 searches much less for slightly longer paths
+        self.flow_radius = flow_radius # flow fields cover (2 * flow_radius + 1) tiles square
+        self.costs = {}     # { cluster (cy, cx): tile costs as nested lists }
+        self.ranges = {}    # { cluster: (lowest, highest) height } of the cached costs
+        self.entrances = {} # { border: { tile: tile on the other side } }
+        self.edges = {}     # { entrance tile: { other entrance of its cluster: cost } }
+        self.paths = collections.OrderedDict()    # { (start, goal): (tiles, clusters) }, [] = no way
+        self.searches = collections.OrderedDict() # { (start, goal): generator } waiting for update
+        self.fields = collections.OrderedDict()         # { goal: FlowField }
+        self.field_searches = collections.OrderedDict() # { goal: generator } waiting for update
+
+    # ---------- tiles and world positions ----------
+    def tile_of(self, pos):
+        column, row = self.ground.tile_of(pos.x, pos.y)
+        return (row, column)
+
+    def center_of(self, tile):
+        """world position of the middle of a tile"""
+        tilesize = self.ground.tilesize
+        return pygame.math.Vector2((tile[1] + 0.5) * tilesize, -(tile[0] + 0.5) * tilesize)
+
+    def cluster_of(self, tile):
+        return (tile[0] // self.cluster, tile[1] // self.cluster)
+
+    # ---------- costs ----------
+    def tile_costs(self, row0, row1, column0, column1):
+        """2d array with the costs of rows row0..row1-1 and columns column0..column1-1.
+           The rectangle may reach over the map, tiles outside are blocked (inf)."""
+        result = numpy.full((row1 - row0, column1 - column0), numpy.inf)
+        top, bottom = max(row0, 0), min(row1, self.rows)
+        left, right = max(column0, 0), min(column1, self.columns)
+        if top >= bottom or left >= right:
+            return result
+        # ---- one more tile around it for the slope ----
+        r0, r1 = max(top - 1, 0), min(bottom + 1, self.rows)
+        c0, c1 = max(left - 1, 0), min(right + 1, self.columns)
+        h = numpy.asarray(self.ground.heights[r0:r1, c0:c1], dtype=numpy.float64)
+        slope = numpy.zeros_like(h)
+        for axis in (0, 1):
+            difference = numpy.abs(numpy.diff(h, axis=axis))
+            before = [slice(None), slice(None)]
+            after = [slice(None), slice(None)]
+            before[axis] = slice(None, -1)
+            after[axis] = slice(1, None)
+            numpy.maximum(slope[tuple(before)], difference, out=slope[tuple(before)])
+            numpy.maximum(slope[tuple(after)], difference, out=slope[tuple(after)])
+        cost = 1 + self.slope_cost * slope
+        cost[(slope > self.max_slope) | (h < self.waterheight)] = numpy.inf
+        result[top - row0:bottom - row0, left - column0:right - column0] = cost[top - r0:bottom - r0, left - c0:right - c0]
+        return result
+
+    def cluster_costs(self, cluster):
+        costs = self.costs.get(cluster)
+        if costs is None:
+            size = self.cluster
+            top, left = cluster[0] * size, cluster[1] * size
+            costs = self.costs[cluster] = self.tile_costs(top, top + size, left, left + size).tolist()
+            block = self.ground.heights[max(top, 0):top + size, max(left, 0):left + size]
+            self.ranges[cluster] = (int(block.min()), int(block.max())) if block.size else (0, 0)
+        return costs
+
+    def cost_of(self, tile):
+        if not (0 <= tile[0] < self.rows and 0 <= tile[1] < self.columns):
+            return numpy.inf
+        return self.cluster_costs(self.cluster_of(tile))[tile[0] % self.cluster][tile[1] % self.cluster]
+
+    # ---------- the abstract graph ----------
+    def borders(self, cluster):
+        """keys of the (up to four) borders of a cluster to its neighbours inside the map"""
+        cy, cx = cluster
+        result = []
+        if cx > 0:
+            result.append(("v", cy, cx - 1))
+        if (cx + 1) * self.cluster < self.columns:
+            result.append(("v", cy, cx))
+        if cy > 0:
+            result.append(("h", cy - 1, cx))
+        if (cy + 1) * self.cluster < self.rows:
+            result.append(("h", cy, cx))
+        return result
+
+    def border_entrances(self, border):
+        """{ tile: tile on the other side } for the entrances over a border (both directions).
+           ("v", cy, cx) is the border right of cluster (cy, cx), ("h", cy, cx) the border below it.
+           Every run of open tile pairs gets one entrance in its middle, long runs one at each end."""
+        entrances = self.entrances.get(border)
+        if entrances is not None:
+            return entrances
+        kind, cy, cx = border
+        size = self.cluster
+        if kind == "v":
+            column = (cx + 1) * size - 1
+            pairs = [((row, column), (row, column + 1)) for row in range(cy * size, min((cy + 1) * size, self.rows))]
+        else:
+            row = (cy + 1) * size - 1
+            pairs = [((row, column), (row + 1, column)) for column in range(cx * size, min((cx + 1) * size, self.columns))]
+        entrances = self.entrances[border] = {}
+        run = []
+        for a, b in pairs + [(None, None)]:
+            if a is not None and self.cost_of(a) < numpy.inf and self.cost_of(b) < numpy.inf:
+                run.append((a, b))
+                continue
+            if len(run) >= 6:
+                chosen = (run[0], run[-1])
+            elif run:
+                chosen = (run[len(run) // 2],)
+            else:
+                chosen = ()
+            for a2, b2 in chosen:
+                entrances[a2] = b2
+                entrances[b2] = a2
+            run = []
+        return entrances
+
+    def cluster_nodes(self, cluster):
+        """entrance tiles on the inside of a cluster"""
+        return [tile for border in self.borders(cluster) for tile in self.border_entrances(border)
+                if self.cluster_of(tile) == cluster]
+
+    def dijkstra(self, source, cluster, target=None):
+        """cheapest costs from source to all tiles of cluster (or until target), walking only inside the cluster.
+           returns ({ tile: cost }, { tile: previous tile })"""
+        size = self.cluster
+        costs = self.cluster_costs(cluster)
+        top, left = cluster[0] * size, cluster[1] * size
+        inf = numpy.inf
+        best = {source: 0.0}
+        came_from = {source: None}
+        heap = [(0.0, source)]
+        while heap:
+            distance, tile = heapq.heappop(heap)
+            if tile == target:
+                break
+            if distance > best[tile]:
+                continue
+            r, c = tile[0] - top, tile[1] - left
+            here = costs[r][c]
+            for dr, dc, length in self.neighbours:
+                rr, cc = r + dr, c + dc
+                if not (0 <= rr < size and 0 <= cc < size):
+                    continue
+                there = costs[rr][cc]
+                if there == inf:
+                    continue
+                if dr and dc and (costs[r][cc] == inf or costs[rr][c] == inf):
+                    continue # no cutting of blocked corners
+                new = distance + length * (here + there) * 0.5
+                other = (tile[0] + dr, tile[1] + dc)
+                if new < best.get(other, inf):
+                    best[other] = new
+                    came_from[other] = tile
+                    heapq.heappush(heap, (new, other))
+        return best, came_from
+
+    def node_edges(self, node):
+        """{ other entrance: cost } inside the cluster of an entrance tile.
+           The edges of all entrances of the cluster are found together, in one numpy relaxation"""
+        edges = self.edges.get(node)
+        if edges is None:
+            cluster = self.cluster_of(node)
+            nodes = self.cluster_nodes(cluster)
+            top, left = cluster[0] * self.cluster, cluster[1] * self.cluster
+            distances = numpy.full((len(nodes), self.cluster, self.cluster), numpy.inf)
+            for layer, (row, column) in enumerate(nodes):
+                distances[layer, row - top, column - left] = 0.0
+            self.relax(distances, self.steps(numpy.array(self.cluster_costs(cluster))))
+            for layer, a in enumerate(nodes):
+                self.edges[a] = {b: float(distances[layer, b[0] - top, b[1] - left]) for b in nodes
+                                 if b != a and distances[layer, b[0] - top, b[1] - left] < numpy.inf}
+            edges = self.edges[node]
+        return edges
+
+    # ---------- searching ----------
+    def search(self, start, goal):
+        """generator for one HPA* search. Yields after every Dijkstra inside a cluster (the expensive part)
+           and every expansions entrances, returns the list of tiles from start to goal (both included),
+           or [] if there is no way"""
+        if self.cost_of(start) == numpy.inf or self.cost_of(goal) == numpy.inf:
+            return []
+        start_costs, start_from = self.dijkstra(start, self.cluster_of(start))
+        yield
+        goal_costs, goal_from = self.dijkstra(goal, self.cluster_of(goal))
+        yield
+        start_edges = {n: start_costs[n] for n in self.cluster_nodes(self.cluster_of(start)) if n in start_costs}
+        if goal in start_costs:
+            start_edges[goal] = start_costs[goal]
+        goal_edges = {n: goal_costs[n] for n in self.cluster_nodes(self.cluster_of(goal)) if n in goal_costs}
+
+        def estimate(tile):
+            # octile distance: every step costs at least its length
+            dr, dc = abs(tile[0] - goal[0]), abs(tile[1] - goal[1])
+            return (max(dr, dc) + (2 ** 0.5 - 1) * min(dr, dc)) * self.greed
+
+        # ---- A* over the entrances ----
+        best = {start: 0.0}
+        came_from = {start: None}
+        heap = [(estimate(start), start)]
+        done = set()
+        while heap:
+            node = heapq.heappop(heap)[1]
+            if node == goal:
+                break
+            if node in done:
+                continue
+            done.add(node)
+            if len(done) % self.expansions == 0:
+                yield
+            if node == start:
+                edges = list(start_edges.items())
+            else:
+                if node not in self.edges:
+                    self.node_edges(node)
+                    yield
+                edges = list(self.node_edges(node).items())
+                if node in goal_edges:
+                    edges.append((goal, goal_edges[node]))
+            for border in self.borders(self.cluster_of(node)):
+                other = self.border_entrances(border).get(node)
+                if other is not None:
+                    edges.append((other, (self.cost_of(node) + self.cost_of(other)) * 0.5))
+            for other, cost in edges:
+                new = best[node] + cost
+                if new < best.get(other, numpy.inf):
+                    best[other] = new
+                    came_from[other] = node
+                    heapq.heappush(heap, (new + estimate(other), other))
+        else:
+            return []
+        route = [goal]
+        while route[-1] != start:
+            route.append(came_from[route[-1]])
+        route.reverse()
+        # ---- refine: the tiles between two entrances of a cluster come from a Dijkstra again ----
+        tiles = [start]
+        for a, b in zip(route, route[1:]):
+            if self.cluster_of(a) != self.cluster_of(b):
+                tiles.append(b) # over the border
+            elif a == start:
+                tiles.extend(self.walk(start_from, b)[::-1][1:])
+            elif b == goal:
+                tiles.extend(self.walk(goal_from, a)[1:])
+            else:
+                tiles.extend(self.walk(self.dijkstra(a, self.cluster_of(a), b)[1], b)[::-1][1:])
+                yield
+        return tiles
+
+    @staticmethod
+    def walk(came_from, tile):
+        """tiles from tile back to the root of a Dijkstra tree"""
+        tiles = [tile]
+        while came_from[tiles[-1]] is not None:
+            tiles.append(came_from[tiles[-1]])
+        return tiles
+
+    def remember(self, key, tiles):
+        clusters = {self.cluster_of(tile) for tile in tiles} | {self.cluster_of(key[0]), self.cluster_of(key[1])}
+        self.paths[key] = (tiles, clusters)
+        if len(self.paths) > self.max_paths:
+            self.paths.popitem(last=False)
+
+    def find_path(self, start, goal):
+        """list of tiles from start to goal tile (both included), [] if there is no way. Waits for the search."""
+        key = (start, goal)
+        if key in self.paths:
+            self.paths.move_to_end(key)
+            return self.paths[key][0]
+        search = self.searches.pop(key, None) or self.search(start, goal)
+        while True:
+            try:
+                next(search)
+            except StopIteration as finished:
+                self.remember(key, finished.value)
+                return finished.value
+
+    def request_path(self, start, goal):
+        """like find_path, but never waits: returns the cached path, or None and queues the search for update"""
+        key = (start, goal)
+        if key in self.paths:
+            self.paths.move_to_end(key)
+            return self.paths[key][0]
+        if key not in self.searches:
+            self.searches[key] = self.search(start, goal)
+        return None
+
+    def update(self, budget=0.002, rounds=None):
+        """works on the queued searches and flow fields for about budget seconds, oldest first.
+           A round is a piece of the oldest path search (expansions nodes) and of the oldest flow field
+           (one relaxation of its window). With rounds, exactly that many rounds are done instead,
+           so that paths are ready in the same step in every run of the same game."""
+        end = time.perf_counter() + budget
+        while (self.searches or self.field_searches) and (time.perf_counter() < end if rounds is None else rounds > 0):
+            if rounds is not None:
+                rounds -= 1
+            for queue, done in ((self.searches, self.remember), (self.field_searches, self.remember_field)):
+                if not queue:
+                    continue
+                key, search = next(iter(queue.items()))
+                try:
+                    next(search)
+                except StopIteration as finished:
+                    del queue[key]
+                    done(key, finished.value)
+
+    # ---------- flow fields ----------
+    def remember_field(self, goal, field):
+        self.fields[goal] = field
+        if len(self.fields) > self.max_fields:
+            self.fields.popitem(last=False)
+
+    def flow_field(self, goal):
+        """FlowField towards goal tile, made once and shared. Waits for it"""
+        field = self.request_flow_field(goal)
+        if field is None:
+            search = self.field_searches.pop(goal)
+            while True:
+                try:
+                    next(search)
+                except StopIteration as finished:
+                    field = finished.value
+                    break
+            self.remember_field(goal, field)
+        return field
+
+    def request_flow_field(self, goal):
+        """like flow_field, but never waits: returns the cached field, or None and queues it for update"""
+        field = self.fields.get(goal)
+        if field is not None:
+            self.fields.move_to_end(goal)
+            return field
+        if goal not in self.field_searches:
+            self.field_searches[goal] = self.make_flow_field(goal)
+        return None
+
+    def steps(self, cost):
+        """[ (here, there, step cost) ] for the 8 neighbours in a square cost array:
+           slices of the tiles that have this neighbour, of the neighbours, and the cost between them"""
+        size = cost.shape[0]
+        steps = []
+        for dr, dc, length in self.neighbours:
+            here = (slice(max(0, -dr), size - max(0, dr)), slice(max(0, -dc), size - max(0, dc)))
+            there = (slice(max(0, dr), size - max(0, -dr)), slice(max(0, dc), size - max(0, -dc)))
+            step = length * (cost[here] + cost[there]) * 0.5
+            if dr and dc:
+                # no cutting of blocked corners
+                beside_row = (there[0], here[1])
+                beside_column = (here[0], there[1])
+                step[numpy.isinf(cost[beside_row]) | numpy.isinf(cost[beside_column])] = numpy.inf
+            steps.append((here, there, step))
+        return steps
+
+    @staticmethod
+    def relax(distances, steps):
+        """turns distances (0 at the sources, inf elsewhere; any number of square layers in front)
+           into Dijkstra distances by relaxing all tiles with numpy until nothing changes"""
+        for sweep in PathFinder.relaxing(distances, steps):
+            pass
+
+    @staticmethod
+    def relaxing(distances, steps):
+        """generator for relax: yields after every relaxation of all tiles that changed something"""
+        while True:
+            before = distances.copy()
+            for here, there, step in steps:
+                here = (Ellipsis,) + here
+                numpy.minimum(distances[here], distances[(Ellipsis,) + there] + step, out=distances[here])
+            if numpy.array_equal(before, distances):
+                return
+            yield
+
+    def make_flow_field(self, goal):
+        """generator for one FlowField: Dijkstra distances to goal for the whole window by relaxing
+           all tiles with numpy until nothing changes (yields after each relaxation), then the cheapest
+           neighbour of every tile. Returns the FlowField"""
+        radius = self.flow_radius
+        size = 2 * radius + 1
+        row0, column0 = goal[0] - radius, goal[1] - radius
+        cost = self.tile_costs(row0, row0 + size, column0, column0 + size)
+        cost[radius, radius] = min(cost[radius, radius], 1.0) # the goal itself is always reachable
+        steps = self.steps(cost)
+        distances = numpy.full((size, size), numpy.inf)
+        distances[radius, radius] = 0.0
+        yield from self.relaxing(distances, steps)
+        directions = numpy.full((size, size), -1, dtype=numpy.int8)
+        lowest = numpy.full((size, size), numpy.inf)
+        for index, (here, there, step) in enumerate(steps):
+            candidate = distances[there] + step
+            better = candidate < lowest[here]
+            lowest[here][better] = candidate[better]
+            directions[here][better] = index
+        directions[numpy.isinf(distances)] = -1
+        directions[radius, radius] = -1
+        return FlowField(goal, row0, column0, directions, distances)
+
+    def direction(self, pos, goal_pos):
+        """world direction (Vector2) from pos along the flow field of goal_pos, None if the field
+           does not help or is not made yet (then go straight)"""
+        field = self.request_flow_field(self.tile_of(goal_pos))
+        if field is None:
+            return None
+        step = field.direction_at(self.tile_of(pos))
+        if step is None:
+            return None
+        return pygame.math.Vector2(step[1], -step[0])
+
+    # ---------- changes of the terrain ----------
+    def set_waterheight(self, waterheight):
+        """new water level: forgets everything about tiles between the old and the new level"""
+        if waterheight == self.waterheight:
+            return
+        low, high = sorted((self.waterheight, waterheight))
+        self.waterheight = waterheight
+
+        def touched(field):
+            rows, columns = field.directions.shape
+            block = self.ground.heights[max(field.row0, 0):max(field.row0 + rows, 0),
+                                        max(field.column0, 0):max(field.column0 + columns, 0)]
+            return block.size > 0 and block.min() < high and block.max() >= low
+
+        self.forget({cluster for cluster, (lowest, highest) in self.ranges.items()
+                     if lowest < high and highest >= low}, touched)
+
+    def invalidate(self, row0, row1, column0, column1):
+        """the heights of rows row0..row1-1, columns column0..column1-1 have changed"""
+        # ---- slopes change one tile around the changed tiles ----
+        row0, row1, column0, column1 = row0 - 1, row1 + 1, column0 - 1, column1 + 1
+        size = self.cluster
+        clusters = {(cy, cx) for cy in range(row0 // size, (row1 - 1) // size + 1)
+                    for cx in range(column0 // size, (column1 - 1) // size + 1)}
+
+        def touched(field):
+            rows, columns = field.directions.shape
+            return (field.row0 < row1 and row0 < field.row0 + rows and
+                    field.column0 < column1 and column0 < field.column0 + columns)
+
+        self.forget(clusters, touched)
+
+    def forget(self, clusters, field_touched):
+        """drops the costs, entrances, edges and paths of the clusters and the flow fields for which field_touched is True"""
+        if clusters:
+            # ---- the entrances of the neighbours change too, so their edges must go ----
+            neighbours = set(clusters)
+            for cy, cx in clusters:
+                neighbours.update(((cy - 1, cx), (cy + 1, cx), (cy, cx - 1), (cy, cx + 1)))
+            for cluster in clusters:
+                self.costs.pop(cluster, None)
+                self.ranges.pop(cluster, None)
+                for border in self.borders(cluster):
+                    self.entrances.pop(border, None)
+            for node in [node for node in self.edges if self.cluster_of(node) in neighbours]:
+                del self.edges[node]
+            for key in [key for key, (tiles, crossed) in self.paths.items() if not crossed.isdisjoint(clusters)]:
+                del self.paths[key]
+        for goal in [goal for goal, field in self.fields.items() if field_touched(field)]:
+            del self.fields[goal]
+        # ---- searches and flow fields started with the old terrain begin again ----
+        for key in self.searches:
+            self.searches[key] = self.search(*key)
+        for goal in self.field_searches:
+            self.field_searches[goal] = self.make_flow_field(goal)
+
+
+class Minimap(object):
+    """radar picture of the whole map. The grey base image is made once from the smallest
+       level of the height pyramid that is still at least size pixel big, and scaled to size.
+       Visible area and unit dots are painted over the base when drawn (the base is never copied).
+       The unit dots are collected only every interval seconds."""
+
+    def __init__(self, terrain, size=256, interval=0.25):
+        self.interval = interval
+        self.age = interval # collect the dots at the first update
+        self.dots = []      # [ (Rect in radar pixel, color) ]
+        rows, columns = terrain.heights.shape
+        level = terrain.levels[0]
+        for smaller in terrain.levels:
+            if max(smaller.shape) < size:
+                break
+            level = smaller
+        grey = (numpy.asarray(level, dtype=numpy.uint32) * 255 // terrain.max_height).astype(numpy.uint8)
+        picture = pygame.surfarray.make_surface(numpy.repeat(grey.T[:, :, numpy.newaxis], 3, axis=2))
+        factor = size / max(rows, columns)
+        self.base = pygame.transform.scale(picture, (max(1, int(round(columns * factor))),
+                                                     max(1, int(round(rows * factor)))))
+        self.scale = self.base.get_width() / columns # radar pixel per tile
+
+    def get_size(self):
+        return self.base.get_size()
+
+    def update(self, seconds, groups, tilesize, dotsize=2):
+        """groups: [ (sprite group, color) ]. Returns True when the dots were collected new"""
+        self.age += seconds
+        if self.age < self.interval:
+            return False
+        self.age = 0
+        factor = self.scale / tilesize
+        self.dots = [(pygame.Rect(int(s.pos.x * factor), int(-s.pos.y * factor), dotsize, dotsize), color)
+                     for group, color in groups for s in group]
+        return True
+
+    def draw(self, surface, x, y, offset_x, offset_y, tilesize, width, height):
+        """blits the base at x, y, the visible width x height pixel of the world as frame and the dots.
+           returns the rect of the radar on surface"""
+        area = surface.blit(self.base, (x, y))
+        clip = surface.get_clip()
+        surface.set_clip(area)
+        factor = self.scale / tilesize
+        pygame.draw.rect(surface, (80,255,80), (x - int(offset_x * factor), y - int(offset_y * factor),
+                                                int(width * factor), int(height * factor)), 1)
+        for rect, color in self.dots:
+            surface.fill(color, rect.move(x, y))
+        surface.set_clip(clip)
+        return area
+
+
+class DirtyGroup(pygame.sprite.LayeredDirty):
+    """LayeredDirty group that marks sprites as dirty itself: a sprite is drawn again
+       if its rect or its image changed since the last draw. draw returns the changed
+       screen areas for pygame.display.update. full=True redraws everything (after
+       the background changed, e.g. by scrolling or zooming). With more than max_dirty
+       changed sprites on the screen a full redraw is faster, too."""
+    max_dirty = 100
+
+    def merge_lost_rects(self):
+        """areas from repaint_rect and killed sprites must not overlap, otherwise
+           half transparent sprites are blitted twice there"""
+        merged = []
+        for rect in self.lostsprites:
+            rect = pygame.Rect(rect)
+            i = rect.collidelist(merged)
+            while i > -1:
+                rect.union_ip(merged.pop(i))
+                i = rect.collidelist(merged)
+            merged.append(rect)
+        self.lostsprites[:] = merged
+
+    def draw(self, surface, bgsurf=None, special_flags=None, full=False):
+        screen_rect = surface.get_rect()
+        changed = 0
+        for sprite in self._spritelist:
+            rect = sprite.rect
+            if rect != sprite.drawn_rect or sprite.image is not sprite.drawn_image:
+                # ---- moving outside the screen changes nothing on the screen ----
+                if rect.colliderect(screen_rect) or (sprite.drawn_rect is not None and
+                                                     sprite.drawn_rect.colliderect(screen_rect)):
+                    sprite.dirty = max(1, sprite.dirty)
+                    changed += 1
+                sprite.drawn_rect = rect.copy()
+                sprite.drawn_image = sprite.image
+        if full or changed > self.max_dirty:
+            self._use_update = False # LayeredDirty: draw all sprites, return the whole screen
+        if self._use_update:
+            self.merge_lost_rects()
+        return pygame.sprite.LayeredDirty.draw(self, surface, bgsurf, special_flags)
+
+
+class Profiler(object):
+    """timing of the named phases of a frame (start / stop or scope) and of the update of each sprite class.
+       Keeps the last window frames for averages and p99 and the last trace_frames frames for dump().
+       While disabled, start, stop and scope only check self.enabled."""
+
+    def __init__(self, window=120, trace_frames=10000):
+        self.enabled = False
+        self.window = window
+        self.phases = collections.OrderedDict() # { name: deque of seconds per frame }
+        self.classes = {}                        # { class name: deque of seconds per frame }
+        self.class_counts = {}                   # { class name: sprites updated in the last frame }
+        self.frame_phases = {}                   # { name: seconds in the current frame }
+        self.frame_classes = {}
+        self.frame_counts = {}
+        self.started = {}
+        self.trace = collections.deque(maxlen=trace_frames) # { name: milliseconds } per frame
+        self.frame = 0
+
+    def start(self, name):
+        if self.enabled:
+            self.started[name] = time.perf_counter()
+
+    def stop(self, name):
+        if self.enabled and name in self.started:
+            seconds = time.perf_counter() - self.started.pop(name)
+            self.frame_phases[name] = self.frame_phases.get(name, 0) + seconds
+
+    def scope(self, name):
+        """with profiler.scope("name"): ..."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed_scope(name)
+
+    @contextlib.contextmanager
+    def timed_scope(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def update_group(self, group, seconds):
+        """updates the sprites of group (a sprite group or list). When enabled, the time and number of updated sprites is recorded per class"""
+        if not self.enabled:
+            for sprite in group:
+                sprite.update(seconds)
+            return
+        for sprite in list(group):
+            name = sprite.__class__.__name__
+            start = time.perf_counter()
+            sprite.update(seconds)
+            self.frame_classes[name] = self.frame_classes.get(name, 0) + time.perf_counter() - start
+            self.frame_counts[name] = self.frame_counts.get(name, 0) + 1
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        self.frame += 1
+        for name, seconds in self.frame_phases.items():
+            self.phases.setdefault(name, collections.deque(maxlen=self.window)).append(seconds)
+        for name, seconds in self.frame_classes.items():
+            self.classes.setdefault(name, collections.deque(maxlen=self.window)).append(seconds)
+        self.class_counts = self.frame_counts
+        record = {"frame": self.frame}
+        for name, seconds in self.frame_phases.items():
+            record[name] = seconds * 1000
+        for name, seconds in self.frame_classes.items():
+            record["update " + name] = seconds * 1000
+        self.trace.append(record)
+        self.frame_phases = {}
+        self.frame_classes = {}
+        self.frame_counts = {}
+
+    def summary(self):
+        """returns a list of (name, mean ms, p99 ms, sprite count or None) for phases and sprite classes"""
+        lines = []
+        for name, times in self.phases.items():
+            ms = numpy.array(times) * 1000
+            lines.append((name, float(ms.mean()), float(numpy.percentile(ms, 99)), None))
+        for name in sorted(self.classes, key=lambda n: -sum(self.classes[n])):
+            ms = numpy.array(self.classes[name]) * 1000
+            lines.append(("update " + name, float(ms.mean()), float(numpy.percentile(ms, 99)), self.class_counts.get(name, 0)))
+        return lines
+
+    def dump(self, filename):
+        """writes the trace of the last frames as .csv (one row per frame) or .json (with summary)"""
+        if filename[-4:] == ".csv":
+            names = []
+            for record in self.trace:
+                names.extend(n for n in record if n not in names)
+            with open(filename, "w") as f:
+                f.write(",".join(names) + "\n")
+                for record in self.trace:
+                    f.write(",".join("{}".format(record.get(n, "")) for n in names) + "\n")
+        else:
+            summary = [{"name": n, "mean_ms": mean, "p99_ms": p99, "count": count} for n, mean, p99, count in self.summary()]
+            with open(filename, "w") as f:
+                json.dump({"summary": summary, "frames": list(self.trace)}, f, indent=1)
+
+    def draw(self, surface, x=10, y=10):
+        """paints the summary as overlay"""
+        write(surface, text="{:<28}{:>9}{:>9}{:>7}".format("profiler (F3 off, F4 dump)", "mean ms", "p99 ms", "count"),
+              x=x, y=y, color=(255,255,0), fontsize=14)
+        for line, (name, mean, p99, count) in enumerate(self.summary()):
+            text = "{:<28}{:>9.2f}{:>9.2f}{:>7}".format(name[:28], mean, p99, "" if count is None else count)
+            write(surface, text=text, x=x, y=y+(line+1)*14, color=(255,255,0), fontsize=14)
+
+
+class Job(object):
+    """one piece of work for the JobPool. The job function gets the Job as first argument and
+       may call report() from its worker thread, the main thread reads progress and text."""
+
+    def __init__(self, name, done=None):
+        self.name = name
+        self.done = done      # called with the result, in the main thread
+        self.progress = 0.0   # 0..1
+        self.text = ""        # what the job is doing now
+        self.future = None
+        self.error = None     # exception raised by the job function
+
+    def report(self, progress, text=None):
+        self.progress = progress
+        if text is not None:
+            self.text = text
+
+
+class JobPool(object):
+    """runs slow work (map loading, png conversion, terrain prerendering) in worker threads,
+       so that the main loop keeps its frame rate. Job functions must not touch the display,
+       the sprite groups or other things of the main thread: they return their results, and
+       poll() hands them to the done callbacks in the main thread."""
+
+    def __init__(self, workers=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count() or 1,
+                                                              thread_name_prefix="job")
+        self.jobs = [] # not yet polled, oldest first
+
+    def submit(self, name, function, *args, done=None):
+        """starts function(job, *args) in a worker thread, returns the Job"""
+        job = Job(name, done)
+        job.future = self.executor.submit(function, job, *args)
+        self.jobs.append(job)
+        return job
+
+    def poll(self):
+        """calls the done callbacks of the finished jobs, returns the finished jobs.
+           A job that raised an exception gets it as job.error instead of the callback."""
+        finished = [job for job in self.jobs if job.future.done()]
+        for job in finished:
+            self.jobs.remove(job)
+            try:
+                result = job.future.result()
+            except Exception as error:
+                job.error = error
+                continue
+            if job.done is not None:
+                job.done(result)
+        return finished
+
+    def wait(self):
+        """blocks until all jobs (also jobs submitted by done callbacks) are finished and polled"""
+        while self.jobs:
+            concurrent.futures.wait([job.future for job in self.jobs])
+            self.poll()
+
+    def draw(self, surface, x, y, width=300):
+        """progress bar, name and text of every job, one below the other"""
+        for job in self.jobs:
+            pygame.draw.rect(surface, (255,255,255), (x, y, width, 14), 1)
+            pygame.draw.rect(surface, (0,200,0), (x + 2, y + 2, int((width - 4) * min(1.0, job.progress)), 10))
+            write(surface, text="{} {}".format(job.name, job.text), x=x + width + 10, y=y, fontsize=16, color=(255,255,255))
+            y += 20
+
+    def shutdown(self):
+        """forgets waiting jobs and waits for the running ones: they may still use pygame
+           (image loading, surfaces), so call it before pygame.quit()"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class LockstepServer(object):
+    """meeting point of a lockstep game: waits until players players are connected, sends each
+       one its welcome (that starts the game) and passes every turn on to all other players.
+       It never simulates, so it needs no map. Runs in its own thread.
+       When a player leaves, the others get no more turns and their Lockstep sees the end."""
+
+    def __init__(self, players=2, host="127.0.0.1", port=0, seed=None):
+        self.players = players
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.listener = socket.create_server((host, port))
+        self.port = self.listener.getsockname()[1] # port=0 chooses a free port
+        self.turns = 0 # turns passed on
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        connections = []
+        while len(connections) < self.players:
+            connection, address = self.listener.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connections.append(connection)
+        self.listener.close()
+        for player, connection in enumerate(connections):
+            connection.sendall(LOCKSTEP_WELCOME.pack(player, self.players, self.seed))
+        buffers = {connection: b"" for connection in connections}
+        receivers = list(connections) # players that did not leave
+        ended = False
+        while receivers:
+            for connection in select.select(receivers, [], [])[0]:
+                try:
+                    data = connection.recv(65536)
+                except OSError:
+                    data = b""
+                if not data:
+                    receivers.remove(connection)
+                    if not ended:
+                        # ---- the turns of this player stop: end the game for all, after the turns already sent ----
+                        ended = True
+                        for other in connections:
+                            with contextlib.suppress(OSError):
+                                other.shutdown(socket.SHUT_WR)
+                    continue
+                turns, buffers[connection] = split_turns(buffers[connection] + data)
+                if ended:
+                    continue
+                for turn in turns:
+                    for other in connections:
+                        if other is not connection:
+                            # a player that just left is only noticed at its next recv
+                            with contextlib.suppress(OSError):
+                                other.sendall(turn)
+                self.turns += len(turns)
+        for connection in connections:
+            connection.close()
+
+    def wait(self):
+        """blocks until all players have left"""
+        self.thread.join()
+
+
+class Lockstep(object):
+    """one player of a lockstep game. Every player simulates the whole game, only the commands
+       go over the network: the commands given during tick T are executed by all players at
+       tick T + delay (delay hides the network latency), and a tick is simulated only when the
+       turns of all players for it are there. Every checksum_interval ticks the turns carry a
+       checksum of the game state, different checksums mean the games went apart (desync).
+       A player sends one turn of LOCKSTEP_TURN.size bytes (and LOCKSTEP_COMMAND.size per command)
+       per tick, no matter how many units there are."""
+
+    checksum_interval = 30 # ticks
+
+    def __init__(self, host="127.0.0.1", port=5757, delay=4):
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        welcome = b""
+        while len(welcome) < LOCKSTEP_WELCOME.size: # comes when all players are there
+            data = self.socket.recv(LOCKSTEP_WELCOME.size - len(welcome))
+            if not data:
+                raise ConnectionError("the lockstep server closed the connection")
+            welcome += data
+        self.player, self.players, self.seed = LOCKSTEP_WELCOME.unpack(welcome)
+        self.delay = delay
+        self.tick = 0 # next tick to simulate
+        self.outgoing = [] # commands given since the last turn: (kind, a, b)
+        # ---- nobody can have given commands for the first delay ticks ----
+        self.turns = {tick: {player: [] for player in range(self.players)} for tick in range(delay)} # { tick: { player: commands } }
+        self.checksums = {} # { tick: { player: checksum } } until all players sent theirs
+        self.desync = None # first tick with different checksums
+        self.closed = False
+        self.buffer = b"" # bytes of an unfinished turn
+        self.sent_bytes = 0
+        self.received_bytes = 0
+
+    def command(self, kind, a=0, b=0):
+        """gives a command (see COMMAND_...), all players execute it delay ticks later"""
+        self.outgoing.append((kind, int(a), int(b)))
+
+    def receive(self):
+        """reads the turns that have arrived without waiting. Returns False when the connection is closed"""
+        while not self.closed and select.select([self.socket], [], [], 0)[0]:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                self.closed = True
+                break
+            self.received_bytes += len(data)
+            turns, self.buffer = split_turns(self.buffer + data)
+            for turn in turns:
+                self.add_turn(*decode_turn(turn))
+        return not self.closed
+
+    def add_turn(self, tick, player, checksum, commands):
+        self.turns.setdefault(tick, {})[player] = commands
+        if checksum:
+            checked = tick - self.delay
+            checksums = self.checksums.setdefault(checked, {})
+            checksums[player] = checksum
+            if len(set(checksums.values())) > 1 and self.desync is None:
+                self.desync = checked
+            if len(checksums) == self.players:
+                del self.checksums[checked]
+
+    def ready(self):
+        """True when the turns of all players for the next tick are there"""
+        self.receive()
+        return len(self.turns.get(self.tick, ())) == self.players
+
+    def wait(self):
+        """waits until the next tick can be simulated. Raises ConnectionError when the game has ended"""
+        while not self.ready():
+            if self.closed:
+                raise ConnectionError("lockstep game ended: no turns from the other players")
+            select.select([self.socket], [], [], 1.0)
+
+    def commands(self):
+        """[ (player, kind, a, b) ] of the next tick, in the same order for all players"""
+        turn = self.turns[self.tick]
+        return [(player,) + tuple(command) for player in sorted(turn) for command in turn[player]]
+
+    def advance(self, checksum=0):
+        """the next tick is simulated, checksum is of the state after it (0: not checked).
+           Sends the own turn for tick + delay with the commands given meanwhile (at most 255)."""
+        del self.turns[self.tick]
+        commands, self.outgoing = self.outgoing[:255], self.outgoing[255:]
+        tick = self.tick + self.delay
+        self.add_turn(tick, self.player, checksum, commands)
+        turn = encode_turn(tick, self.player, checksum, commands)
+        if not self.closed:
+            with contextlib.suppress(OSError):
+                self.socket.sendall(turn)
+        self.sent_bytes += len(turn)
+        self.tick += 1
+
+    def close(self):
+        self.socket.close()
+        self.closed = True
+
+
+class ReplayWriter(object):
+    """writes a replay file while the game runs: the start state (map, seed, zoom, ...) and then
+       only what changes the game, each command with its tick, plus the camera moves and every
+       keyframe_interval ticks a keyframe with the checksum of the game state.
+       The records are flushed at each keyframe, so the file of a crashed game plays up to its last keyframe."""
+
+    keyframe_interval = 600 # ticks, at most 65535: the ticks between two records must fit in 2 bytes
+
+    def __init__(self, filename, mapfile, seed, timestep, tilesize, world_zoom, waterheight, width, height, compression=6):
+        mapsize, mapcrc = map_fingerprint(mapfile)
+        name = mapfile.encode("utf-8")
+        self.file = open(filename, "wb")
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, 1 if compression else 0, seed, timestep,
+                                           tilesize, world_zoom, int(waterheight), width, height, mapsize, mapcrc, len(name)))
+        self.file.write(name)
+        self.compressor = zlib.compressobj(compression) if compression else None
+        self.tick = 0 # tick of the last record
+        self.last_view = None
+        self.records = 0
+
+    def write(self, tick, kind, player, values):
+        if tick - self.tick > 65535:
+            raise ValueError("more than 65535 ticks without a record, write keyframes")
+        data = REPLAY_RECORD.pack(tick - self.tick, kind, player) + values
+        self.file.write(data if self.compressor is None else self.compressor.compress(data))
+        self.tick = tick
+        self.records += 1
+
+    def command(self, tick, player, kind, a=0, b=0):
+        self.write(tick, kind, player, REPLAY_VALUES.pack(a, b))
+
+    def view(self, tick, x, y):
+        """the camera is at world offset x, y (written only when it moved)"""
+        if (x, y) != self.last_view:
+            self.write(tick, REPLAY_VIEW, 0, REPLAY_VALUES.pack(x, y))
+            self.last_view = (x, y)
+
+    def keyframe(self, tick, checksum):
+        self.write(tick, REPLAY_KEYFRAME, 0, REPLAY_CHECKSUM.pack(checksum))
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.file.flush()
+
+    def close(self, tick, checksum):
+        """ends the replay with a last keyframe, the replay plays until its tick"""
+        self.keyframe(tick, checksum)
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+        self.file.close()
+
+
+class Replay(object):
+    """a replay file (see ReplayWriter), read completely. records is a list of (tick, kind, player, a, b),
+       for keyframes a is the checksum. keyframes lists (tick, index in records), ticks is the length.
+       The game state is not in the file, seeking goes back to the start and plays again
+       at full speed (Viewer.seek), the keyframes prove that it went the same way."""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            data = f.read()
+        if len(data) < REPLAY_HEADER.size:
+            raise ValueError("{} is too short for a replay header".format(filename))
+        (magic, version, compressed, self.seed, self.timestep, self.tilesize, self.world_zoom, self.waterheight,
+         self.width, self.height, self.mapsize, self.mapcrc, length) = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("{} is not a replay file".format(filename))
+        if version != REPLAY_VERSION:
+            raise ValueError("{}: unsupported replay version {}".format(filename, version))
+        start = REPLAY_HEADER.size + length
+        self.mapfile = data[REPLAY_HEADER.size:start].decode("utf-8")
+        body = data[start:]
+        if compressed:
+            body = zlib.decompressobj().decompress(body) # a cut off stream gives what is there
+        self.records = []
+        self.keyframes = []
+        tick = 0
+        offset = 0
+        while offset + REPLAY_RECORD.size <= len(body):
+            ticks, kind, player = REPLAY_RECORD.unpack_from(body, offset)
+            values = REPLAY_CHECKSUM if kind == REPLAY_KEYFRAME else REPLAY_VALUES
+            end = offset + REPLAY_RECORD.size + values.size
+            if end > len(body):
+                break # unfinished record of a crashed game
+            tick += ticks
+            a, b = (values.unpack_from(body, offset + REPLAY_RECORD.size) + (0,))[:2]
+            if kind == REPLAY_KEYFRAME:
+                self.keyframes.append((tick, len(self.records)))
+            self.records.append((tick, kind, player, a, b))
+            offset = end
+        self.ticks = tick
+
+    def check_map(self):
+        """raises ValueError if the map file is not the one the replay was recorded on"""
+        if not os.path.isfile(self.mapfile) or map_fingerprint(self.mapfile) != (self.mapsize, self.mapcrc):
+            raise ValueError("the replay needs the map {} it was recorded on".format(self.mapfile))
 
-        
-    
-    
 
 class Viewer(object):
     width = 0
@@ -758,32 +3240,99 @@ class Viewer(object):
     cursor = 0
     name = "main"
     fullscreen = False
+    use_motion_store = True # move Javelins, Rocks, Sparks and Flytexts with numpy arrays
+    max_particles = 5000 # sparks of all Explosions together
+    rotation_steps = 64 # directions of rotated sprite images
+    prefill_rotations = False # True: rotate all sprite images at start instead of when needed
+    timestep = 1 / 60 # seconds of game time per simulation step
+    max_frame_time = 0.25 # a slower frame does not try to catch up more simulation steps
+    dirty_rendering = True # False: redraw and flip the whole screen every frame
+    radar_interval = 0.25 # seconds between two updates of the unit dots on the radar
+    pool_size = 500 # killed projectiles, sparks and flytexts kept per class for reuse, 0 = no pools
+    path_budget = 0.002 # seconds per simulation step for waiting path searches
+    stream_ahead = 1.0 # screens of a paged map that are read ahead in the scroll direction
+    far_interval = 8 # on paged maps, sprites over pages not in memory are updated only every far_interval steps
+    path_rounds = 4 # rounds of waiting path searches per step instead of path_budget when the game must be deterministic
 
-    def __init__(self, width=640, height=400, fps=60):
+    def __init__(self, width=640, height=400, fps=60, headless=False, seed=None):
         """Initialize pygame, window, background, font,...
-           default arguments """
-        pygame.mixer.pre_init(44100,-16, 2, 2048)   
-        pygame.init()
+           default arguments.
+           headless=True: no window, no sound, no joysticks (SDL dummy driver), for simulate()
+           seed: start of the random streams of the game (None: a random seed)"""
+        self.headless = headless
+        if headless:
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+            os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+            pygame.font.init()
+        else:
+            pygame.mixer.pre_init(44100,-16, 2, 2048)   
+            pygame.init()
         Viewer.width = width    # make global readable
         Viewer.height = height
-        self.screen = pygame.display.set_mode((self.width, self.height), pygame.DOUBLEBUF)
-        self.background = pygame.Surface(self.screen.get_size()).convert()
+        if headless:
+            self.screen = pygame.Surface((self.width, self.height))
+        else:
+            self.screen = pygame.display.set_mode((self.width, self.height), pygame.DOUBLEBUF)
+        self.background = pygame.Surface(self.screen.get_size())
         self.background.fill((255,255,255)) # fill background white
         self.clock = pygame.time.Clock()
         self.fps = fps
+        self.accumulator = 0.0 # seconds of real time not yet simulated
+        self.backdrop = pygame.Surface(self.screen.get_size()) # terrain + radar + water text, below the sprites
+        self.redraw_all = True  # backdrop must be painted new, whole screen must be updated
+        self.repaint_rects = [] # screen areas to restore from the backdrop in the next frame (particles, overlay)
+        self.profiler = Profiler()
+        self.profiler_overlay = None # Surface with the last painted profiler summary
+        self.steps = 0 # simulation steps done
+        # ---- random streams of this game: same seed and same commands, same game ----
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.rng = random.Random(self.seed) # game rules (units)
+        self.effects_rng = random.Random(self.seed + 1) # sparks of explosions
+        VectorSprite.rng = self.rng
+        Explosion.rng = self.effects_rng
+        self.lockstep = None # Lockstep of a network game
+        self.desync = None # tick of the desync that was shown
+        self.deterministic = False # True: nothing in the simulation depends on time or on the camera
+        self.recorder = None # ReplayWriter while the game is recorded
+        self.record_to = None # file name: run() records the game into this replay file
+        self.replay = None # Replay that is played
+        self.replay_tick = 0 # ticks since the start of the recording or replay
+        self.replay_next = 0 # index of the next record of self.replay
+        self.replay_desync = None # first keyframe tick where the replay went another way
         self.world = None
+        self.mapfile = None # file name of the map in use
         self.playtime = 0.0
-        self.rawmap = []
+        self.rawmap = None # 2d numpy array of heights (rows, columns)
+        self.terrain = None # TerrainCache of rawmap
+        self.ground = None # TerrainQuery of rawmap
+        self.pathfinder = None # PathFinder over rawmap
+        self.pages = None # PagedHeightmap when rawmap is a paged map, else None
+        self.jobs = JobPool() # background work: map loading, png conversion, terrain prerendering
+        self.loading = None # Job of the map that is loading
+        self.prerendering = None # Job rendering terrain chunks ahead
+        self.streaming = None # Job reading pages of a paged map ahead
+        self.scroll_motion = (0, 0) # dx, dy of the last scroll, pages are read ahead in this direction
         self.waterheight = 0
         #Viewer.tilesize = 32
         self.grid = False
         Viewer.menu["set tile size"][-1] = "(The current tile size is: {}x{} pixel)".format(self.tilesize, self.tilesize)
         self.world_offset_x = 0
         self.world_offset_y = 0
+        self.world_origin = (0, 0) # rounded world offset of the picture in self.world
+        self.scroll_speed = 600 # pixel per second when holding a cursor key or touching a window edge
+        self.scroll_delay = 0.25 # seconds to hold a cursor key before smooth scrolling starts
+        self.scroll_hold = 0
+        self.edge_pan_margin = 6 # pixel, 0 = no scrolling with the mouse at the window edges
         self.world_zoom = 1
         self.radarmap_size = 256
         self.radarmap_zoom = 1.0
-        self.radarmap = pygame.surface.Surface((self.radarmap_size, self.radarmap_size))
+        self.minimap = None
+        self.age = 0
+        if headless:
+            self.joysticks = []
+            self.prepare_sprites()
+            self.loadbackground()
+            return
         # -- menu --
         # --- create screen resolution list ---
         li = ["back"]
@@ -811,7 +3360,6 @@ class Viewer(object):
         #except:
         #    print("no folder 'data' or no jpg files in it")
 
-        self.age = 0
         # ------ joysticks ----
         pygame.joystick.init()
         self.joysticks = [pygame.joystick.Joystick(x) for x in range(pygame.joystick.get_count())]
@@ -841,12 +3389,13 @@ class Viewer(object):
     
     def loadbackground(self):
         
-        self.background = pygame.Surface(self.screen.get_size()).convert()
+        self.background = pygame.Surface(self.screen.get_size())
         self.background.fill((0,0,128)) # fill background white
             
         self.background = pygame.transform.scale(self.background,
                           (Viewer.width,Viewer.height))
-        self.background.convert()
+        if not self.headless:
+            self.background = self.background.convert()
         
     
     #def paint_world(self):
@@ -871,13 +3420,16 @@ class Viewer(object):
             """ all sprites that can rotate MUST look to the right. Edit Image files manually if necessary!"""
             print("loading sprites from 'data' folder....")
         
-            Viewer.images["catapult"] = pygame.image.load(os.path.join("data", "catapult1.png")).convert_alpha()
-            Viewer.images["rock"] = pygame.image.load(os.path.join("data", "rock.png")).convert_alpha()
-            Viewer.images["tent"]= pygame.image.load(os.path.join("data", "tent1.png")).convert_alpha()
-            Viewer.images["swordgoblin"]= pygame.image.load(os.path.join("data" , "swordgoblin.png")).convert_alpha()
-            Viewer.images["javelin"] = pygame.image.load(os.path.join("data", "javelin.png")).convert_alpha()
-            Viewer.images["tower"] = pygame.image.load(os.path.join("data", "tower.png")).convert_alpha()
-            Viewer.images["wall"] = pygame.image.load(os.path.join("data", "wall.png")).convert_alpha()
+            Viewer.images["catapult"] = pygame.image.load(os.path.join("data", "catapult1.png"))
+            Viewer.images["rock"] = pygame.image.load(os.path.join("data", "rock.png"))
+            Viewer.images["tent"]= pygame.image.load(os.path.join("data", "tent1.png"))
+            Viewer.images["swordgoblin"]= pygame.image.load(os.path.join("data" , "swordgoblin.png"))
+            Viewer.images["javelin"] = pygame.image.load(os.path.join("data", "javelin.png"))
+            Viewer.images["tower"] = pygame.image.load(os.path.join("data", "tower.png"))
+            Viewer.images["wall"] = pygame.image.load(os.path.join("data", "wall.png"))
+            if not self.headless:
+                for name, image in Viewer.images.items():
+                    Viewer.images[name] = image.convert_alpha()
             
                        
             
@@ -897,7 +3449,10 @@ class Viewer(object):
         """painting on the surface and create sprites"""
         self.load_sprites()
         self.zoom_sprites()
-        self.allgroup =  pygame.sprite.LayeredUpdates() # for drawing
+        VectorSprite.rotations = RotationCache(Viewer.zoom_images, Viewer.rotation_steps)
+        if Viewer.prefill_rotations:
+            VectorSprite.rotations.prefill()
+        self.allgroup =  DirtyGroup() # for drawing
         self.flytextgroup = pygame.sprite.Group()
         #self.mousegroup = pygame.sprite.Group()
         self.worldgroup = pygame.sprite.Group()
@@ -906,6 +3461,10 @@ class Viewer(object):
         self.tentgroup = pygame.sprite.Group()
         self.swordgoblingroup = pygame.sprite.Group()
         VectorSprite.groups = self.allgroup
+        self.particles = ParticleSystem(max_particles=self.max_particles)
+        Explosion.particles = self.particles
+        if Viewer.use_motion_store:
+            VectorSprite.motion = MotionStore()
         #Tile.groups = self.allgroup
         Javelin.groups = self.allgroup, self.worldgroup, self.bulletgroup
         Flytext.groups = self.allgroup, self.flytextgroup
@@ -914,8 +3473,14 @@ class Viewer(object):
         Catapult.groups = self.allgroup, self.worldgroup
         Rock.groups = self.allgroup, self.worldgroup, self.bulletgroup
         Javelin.groups = self.allgroup, self.worldgroup, self.bulletgroup
-        Tent.groups = self.allgroup , self.worldgroup
+        Tent.groups = self.allgroup , self.worldgroup, self.tentgroup
         Swordgoblin.groups = self.allgroup, self.worldgroup, self.swordgoblingroup
+        for c in (Javelin, Rock, Cannonball, Spark, Flytext):
+            c.enable_pool(Viewer.pool_size)
+        # --- spatial hash for all sprites living in the world ---
+        self.spatialhash = SpatialHash(Viewer.tilesize)
+        for c in (Javelin, Rock, Turret, Wall, Catapult, Tent, Swordgoblin):
+            c.spatialhash = self.spatialhash
         #Catapult.groups = self.allgroup,
         
         # --- tile cursor (number 0) ---
@@ -933,10 +3498,10 @@ class Viewer(object):
             Tent(pos=pygame.math.Vector2(x,-y))
         for x in range(250, 801, 50):
             y = 300
-            tz = self.get_z(x,y)
+            tz = self.ground.height_at(x, -y)
             Wall(pos=pygame.math.Vector2(x,-y), z=tz, zoom=1)
         for (x,y) in ((200,300), (800,300), (800, 800), (200,800), (500,550)):
-            tz = self.get_z(x,y)
+            tz = self.ground.height_at(x, -y)
             Turret(pos=pygame.math.Vector2(x,-y), z=tz, zoom = 1)
             Catapult(pos=pygame.math.Vector2(x,-y), z=tz+25, zoom = 1)
             #print("turret z", tz)
@@ -954,8 +3519,10 @@ class Viewer(object):
             #pygame.mixer.music.pause()
             milliseconds = self.clock.tick(self.fps) #
             seconds = milliseconds / 1000
+            self.profiler.end_frame()
             
             # -------- events ------
+            self.profiler.start("menu events")
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     return -1 # running = False
@@ -983,7 +3550,9 @@ class Viewer(object):
                             Viewer.cursor = 0
                             #Viewer.menuselectsound.play()
                         elif text == "resume":
-                            if self.world is None:
+                            if self.loading is not None:
+                                Flytext(text="The map is still loading!", fontsize = 33, color = (200,0,0))
+                            elif self.world is None:
                                 Flytext(text="You need to load a map first!", fontsize = 33, color = (200,0,0))
                             else:
                                 return
@@ -1043,52 +3612,18 @@ class Viewer(object):
                                 Viewer.fullscreen = False
                                 self.set_resolution()
                         if Viewer.name == "set water height":
-                            if text != "back":
-                                self.waterheight = text
+                            if text == "no water":
+                                self.waterheight = 0
                         if Viewer.name == "convert png to map":
                             if text != "back" and text[-4:] == ".png":
-                                name = text[:-4]+".map"
                                 print("i try to open", text)
-                                pic = pygame.image.load(os.path.join("maps", text))
-                                lines = []
-                                for y in range(pic.get_height()):
-                                    line = []
-                                    for x in range(pic.get_width()):
-                                        color = pic.get_at((x,y))
-                                        line.append(color)
-                                        #print("color at ",x,y,"=",color)
-                                        # color is a tuple with r, g, b, and alpha?, all integers 0-255
-                                    lines.append(line)
-                                
-                                with open(os.path.join("maps", name), "w") as f:
-                                    for line in lines:
-                                        textline = ""
-                                        for color in line:
-                                            textline += str(color[0]) + ","
-                                        f.write(textline+"\n")
-                                Flytext(text="png converted into map file", pos=pygame.math.Vector2(400, -400), move=pygame.math.Vector2(0, 10))
+                                self.jobs.submit("converting {}".format(text), lambda job, name: convert_png(name),
+                                                 os.path.join("maps", text), done=self.png_converted)
                                             
                                     
                         if Viewer.name == "load a map":
                             if text[-4:] == ".map":
-                                with open(os.path.join("maps", text), "r") as f:
-                                    lines = f.readlines()
-                                for line in lines:
-                                    row = []
-                                    for number in line.split(","):
-                                        row.append(number)
-                                    self.rawmap.append(row)
-                                Flytext(text="map loaded: {}".format(text), pos=pygame.math.Vector2(300, -100), move=pygame.math.Vector2(0,20))
-                                self.world = True
-                                # ------ create radarmap ------
-                                self.radarmap = pygame.surface.Surface((len(self.rawmap), len(row)))
-                                for y, line in enumerate(self.rawmap):
-                                    for x, number in enumerate(line):
-                                        if number == "\n":
-                                            continue
-                                        #print("number:", number)
-                                        pygame.draw.rect(self.radarmap, (int(number), int(number), int(number)), (x,y,1,1))
-                                self.radarmap.set_colorkey((128,0,128))
+                                self.start_loading_map(os.path.join("maps", text))
                                         
                                 # add exiting chars in rawmap to water high
                                 #mynumbers = []
@@ -1112,16 +3647,22 @@ class Viewer(object):
                                 
                                     
                         
+            self.profiler.stop("menu events")
             # ------delete everything on screen-------
             self.screen.blit(self.background, (0, 0))
             
             
          
             # -------------- UPDATE all sprites -------             
+            self.profiler.start("menu update")
+            self.poll_jobs()
+            self.move_stored_sprites(seconds)
             self.flytextgroup.update(seconds)
+            self.profiler.stop("menu update")
 
             # ----------- clear, draw , update, flip -----------------
-            self.allgroup.draw(self.screen)
+            self.profiler.start("menu draw")
+            self.allgroup.draw(self.screen, full=True)
 
             # --- paint menu ----
             # ---- name of active menu and history ---
@@ -1142,38 +3683,226 @@ class Viewer(object):
                 write(self.screen, text=item, x=200, y=100+y*20, color=(255,255,255))
             # --- cursor ---
             write(self.screen, text="-->", x=100, y=100+ Viewer.cursor * 20, color=(255,255,255))
+            # --- progress of background jobs ---
+            self.jobs.draw(self.screen, 200, Viewer.height - 30 - 20 * len(self.jobs.jobs))
+            self.profiler.stop("menu draw")
                         
                 
             # -------- next frame -------------
+            self.profiler.start("menu flip")
             pygame.display.flip()
+            self.profiler.stop("menu flip")
         #----------------------------------------------------- 
     
+    def load_map(self, filename):
+        """loads a .map file (old text maps are upgraded to the binary format first) and waits for it"""
+        self.use_map(prepare_map(Job("load map"), filename, radar=(self.radarmap_size, Viewer.radar_interval)))
+    
+    def start_loading_map(self, filename):
+        """loads a .map file in the background, the map is used when it is ready"""
+        if self.loading is not None:
+            return
+        view = (self.world_offset_x, self.world_offset_y, Viewer.tilesize, self.grid, Viewer.width, Viewer.height)
+        self.loading = self.jobs.submit("loading {}".format(os.path.basename(filename)), prepare_map,
+                                        filename, view, (self.radarmap_size, Viewer.radar_interval),
+                                        done=self.map_loaded)
+    
+    def png_converted(self, filename):
+        name = os.path.basename(filename)
+        if name not in Viewer.menu["load a map"]:
+            Viewer.menu["load a map"].append(name)
+        Flytext(text="png converted into map file", pos=pygame.math.Vector2(400, -400), move=pygame.math.Vector2(0, 10))
+    
+    def map_loaded(self, prepared):
+        self.loading = None
+        self.use_map(prepared)
+        self.prerender()
+        Flytext(text="map loaded: {}".format(os.path.basename(prepared["filename"])), pos=pygame.math.Vector2(300, -100), move=pygame.math.Vector2(0,20))
+    
+    def use_map(self, prepared):
+        """takes the result of prepare_map"""
+        if prepared["upgraded"]:
+            Flytext(text="upgraded text map {} to binary format".format(os.path.basename(prepared["filename"])), pos=pygame.math.Vector2(300, -150), move=pygame.math.Vector2(0,20))
+        self.mapfile = prepared["filename"]
+        self.rawmap = prepared["rawmap"]
+        self.pages = prepared["pages"]
+        self.streaming = None
+        self.terrain = prepared["terrain"]
+        self.minimap = prepared["minimap"]
+        self.ground = TerrainQuery(self.rawmap, Viewer.tilesize)
+        self.new_pathfinder()
+        self.world = True
+        self.stream()
+    
+    def new_pathfinder(self):
+        """a PathFinder without cached paths for the units"""
+        self.pathfinder = PathFinder(self.ground, self.waterheight)
+        for c in (Ballista, Swordgoblin):
+            c.pathfinder = self.pathfinder
+    
+    def poll_jobs(self):
+        """hands finished background jobs to their callbacks, a failed job becomes a Flytext"""
+        for job in self.jobs.poll():
+            if job.error is not None:
+                if job is self.loading:
+                    self.loading = None
+                if job is self.prerendering:
+                    self.prerendering = None
+                if job is self.streaming:
+                    self.streaming = None
+                Flytext(text="{} failed: {}".format(job.name, job.error), color=(200,0,0), pos=pygame.math.Vector2(300, -200), move=pygame.math.Vector2(0,20))
+    
+    def stream(self):
+        """paged maps: reads the pages of the screen and of stream_ahead screens further in the
+           scroll direction in the background. Pages near the screen center are forgotten last."""
+        if self.pages is None or self.streaming is not None:
+            return
+        # ---- screen in rows and columns of level 0 ----
+        left = -self.world_offset_x / Viewer.tilesize
+        top = -self.world_offset_y / Viewer.tilesize
+        columns = Viewer.width / Viewer.tilesize
+        rows = Viewer.height / Viewer.tilesize
+        self.pages.set_focus(top + rows / 2, left + columns / 2)
+        ahead = pygame.math.Vector2(-self.scroll_motion[0], -self.scroll_motion[1])
+        if ahead.length() > 0:
+            ahead.scale_to_length(Viewer.stream_ahead)
+        row0, row1 = min(top, top + ahead.y * rows), max(top, top + ahead.y * rows) + rows
+        column0, column1 = min(left, left + ahead.x * columns), max(left, left + ahead.x * columns) + columns
+        # ---- pages of the pyramid level that is painted, and of the map itself if they fit into memory ----
+        budget = self.pages.max_bytes // 2 // (self.pages.pagesize ** 2 * self.pages.dtype.itemsize)
+        keys = []
+        for level in sorted({self.terrain.level_for(Viewer.tilesize)[0], 0}, reverse=True):
+            size = 2 ** level
+            more = self.pages.missing(level, int(row0 // size), int(-(-row1 // size)),
+                                      int(column0 // size), int(-(-column1 // size)))
+            if len(keys) + len(more) > budget:
+                break
+            keys.extend(more)
+        if not keys:
+            return
+
+        def read(count):
+            self.streaming = None
+
+        self.streaming = self.jobs.submit("pages", self.pages.read_pages, keys, done=read)
+    
+    def prerender(self):
+        """renders the terrain chunks around the screen and of the next zoom levels in the background"""
+        self.stream()
+        if self.terrain is None or self.prerendering is not None:
+            return
+        screen = pygame.Rect(0, 0, Viewer.width, Viewer.height)
+        keys = self.terrain.missing_chunks(screen.inflate(Viewer.width, Viewer.height), self.world_offset_x,
+                                           self.world_offset_y, Viewer.tilesize, self.grid)
+        for delta, factor in ((1, 2), (-1, 0.5)):
+            if -7 <= self.world_zoom + delta <= 4:
+                keys.extend(self.terrain.missing_chunks(screen, self.world_offset_x, self.world_offset_y,
+                                                        Viewer.tilesize * factor, self.grid))
+        if not keys:
+            return
+        terrain = self.terrain
+        colors = terrain.colors
+
+        def rendered(chunks):
+            self.prerendering = None
+            for key, chunk in chunks:
+                terrain.add_chunk(key, chunk, colors)
+
+        self.prerendering = self.jobs.submit("terrain", terrain.render_chunks, keys, colors, done=rendered)
+    
+    def draw_radar(self, surface):
+        """paints the minimap in the top right corner of surface, returns its rect"""
+        return self.minimap.draw(surface, Viewer.width - self.minimap.get_size()[0], 0,
+                                 self.world_offset_x, self.world_offset_y, self.tilesize,
+                                 Viewer.width, Viewer.height)
+    
+    def update_radar(self, seconds):
+        """collects the unit dots of the minimap (not every frame) and paints them into the backdrop"""
+        if not self.minimap.update(seconds, ((self.radargroup, (0,0,255)), (self.tentgroup, (255,255,0)),
+                                             (self.swordgoblingroup, (255,0,0))), self.tilesize):
+            return
+        if not self.redraw_all:
+            self.allgroup.repaint_rect(self.draw_radar(self.backdrop))
+    
     def make_worldmap(self):
-            print("generating map.....{} x {}".format(len(self.rawmap[1]), len(self.rawmap )))
+            print("generating map.....{} x {}".format(self.rawmap.shape[1], self.rawmap.shape[0]))
             self.screen.fill((255,128,128))
-            # BUG! size limit 16384 for surface width / height ? 
-            #self.world = pygame.surface.Surface((len(self.rawmap[0])*self.tilesize, len(self.rawmap)*self.tilesize))
+            # surfaces can not be bigger than 16384 pixel: only the visible part of the world
+            # is painted, from prerendered chunks (and paged maps are read only where they are painted)
             self.world = pygame.surface.Surface((self.width, self.height))
-            dy = self.world_offset_y / self.tilesize
-            dx = self.world_offset_x / self.tilesize
-            for y, line in enumerate(self.rawmap):
-                for x, number in enumerate(line):
-                    if x < -dx or y < -dy:
-                        continue
-                    if x > self.width / self.tilesize - dx or y > self.height / self.tilesize - dy:
-                        continue
-                    if number == "\n":
-                        continue
-                    number = int(number)
-                    if number <= self.waterheight:
-                        color = (0,0,255) # blue
-                    color = get_height_color(number)
-                    #print("x,dx, y,dy", x, dx, y, dy)
-                    #print("rect start x, rect start y", (x+dx)*self.tilesize, (y+dy) * self.tilesize) 
-                    pygame.draw.rect(self.world, color, ((x+dx) * self.tilesize, (y+dy) * self.tilesize, self.tilesize, self.tilesize))
-                    if self.grid:
-                        pygame.draw.rect(self.world, (255,255,255), ((x+dx) * self.tilesize, (y+dy) * self.tilesize, self.tilesize, self.tilesize), 1)
-                    
+            self.ground.tilesize = self.tilesize # the tile size can change in the menu and by zooming
+            self.terrain.set_waterheight(self.waterheight)
+            self.pathfinder.set_waterheight(self.waterheight)
+            self.terrain.draw(self.world, self.world_offset_x, self.world_offset_y, self.tilesize, self.grid)
+            self.world_origin = (int(round(self.world_offset_x)), int(round(self.world_offset_y)))
+            self.redraw_all = True
+    
+    def scroll_world(self, dx, dy):
+        """moves the world by dx, dy pixel. The picture in self.world is shifted in place
+           and only the newly visible strips at the edges are painted."""
+        self.world_offset_x += dx
+        self.world_offset_y += dy
+        self.scroll_motion = (dx, dy)
+        if self.world is None or self.terrain is None:
+            return
+        ox, oy = int(round(self.world_offset_x)), int(round(self.world_offset_y))
+        shift_x = ox - self.world_origin[0]
+        shift_y = oy - self.world_origin[1]
+        if shift_x == 0 and shift_y == 0:
+            return
+        if abs(shift_x) >= self.width or abs(shift_y) >= self.height:
+            self.make_worldmap()
+            return
+        self.world.scroll(shift_x, shift_y)
+        self.world_origin = (ox, oy)
+        self.prerender()
+        self.redraw_all = True
+        strips = []
+        if shift_x > 0:
+            strips.append(pygame.Rect(0, 0, shift_x, self.height))
+        elif shift_x < 0:
+            strips.append(pygame.Rect(self.width + shift_x, 0, -shift_x, self.height))
+        if shift_y > 0:
+            strips.append(pygame.Rect(0, 0, self.width, shift_y))
+        elif shift_y < 0:
+            strips.append(pygame.Rect(0, self.height + shift_y, self.width, -shift_y))
+        for strip in strips:
+            self.world.set_clip(strip)
+            self.world.fill((0,0,0))
+            self.terrain.draw(self.world, ox, oy, self.tilesize, self.grid)
+        self.world.set_clip(None)
+    
+    def smooth_scroll(self, seconds, pressed_keys):
+        """continuous scrolling while cursor keys are held down or the mouse touches a window edge"""
+        dx, dy = 0, 0
+        if pressed_keys[pygame.K_UP]:
+            dy += 1
+        if pressed_keys[pygame.K_DOWN]:
+            dy -= 1
+        if pressed_keys[pygame.K_LEFT]:
+            dx += 1
+        if pressed_keys[pygame.K_RIGHT]:
+            dx -= 1
+        if dx != 0 or dy != 0:
+            # the key press itself already scrolled one tile
+            self.scroll_hold += seconds
+            if self.scroll_hold < self.scroll_delay:
+                return
+        else:
+            self.scroll_hold = 0
+            # ---- mouse at the window edges ----
+            if self.edge_pan_margin > 0 and pygame.mouse.get_focused():
+                mx, my = pygame.mouse.get_pos()
+                if mx < self.edge_pan_margin:
+                    dx = 1
+                elif mx >= self.width - self.edge_pan_margin:
+                    dx = -1
+                if my < self.edge_pan_margin:
+                    dy = 1
+                elif my >= self.height - self.edge_pan_margin:
+                    dy = -1
+        if dx != 0 or dy != 0:
+            self.scroll_world(dx * self.scroll_speed * seconds, dy * self.scroll_speed * seconds)
     
     
     def display_help(self):
@@ -1181,17 +3910,328 @@ class Viewer(object):
         Flytext(text="zoom map with mouse wheel or with + and - key", pos = pygame.math.Vector2(400,-150))
         Flytext(text="set water level with PgUp key and PgDown key",  pos = pygame.math.Vector2(400,-200))
         Flytext(text="toogle grid with key g", pos = pygame.math.Vector2(400,-250))
+        Flytext(text="profiler with F3, write profiler trace with F4", pos = pygame.math.Vector2(400,-300))
+        Flytext(text="replay: jump 10 seconds back with F5, ahead with F6", pos = pygame.math.Vector2(400,-350))
+    
+    
+    def draw_profiler(self):
+        """profiler overlay, painted new only every half second so that the numbers stay readable.
+           returns the screen rect of the overlay"""
+        if self.profiler_overlay is None or self.profiler.frame % 30 == 0:
+            self.profiler_overlay = pygame.Surface((480, 14 * (len(self.profiler.phases) + len(self.profiler.classes) + 1)))
+            self.profiler_overlay.set_alpha(200)
+            self.profiler.draw(self.profiler_overlay, 0, 0)
+        return self.screen.blit(self.profiler_overlay, (10, 30))
     
+    def paint_backdrop(self):
+        """everything below the sprites: terrain, radar with the visible area, water height"""
+        self.backdrop.blit(self.world, (0, 0))
+        self.draw_radar(self.backdrop)
+        # write text below sprites
+        write(self.backdrop,  text="water: {}".format( self.waterheight ), x=Viewer.width-400, y=10, color=(100,0,200))
     
-    def get_z(self, xpos, ypos):
-         # --- tile coursor -----
-         x = int(xpos / self.tilesize)
-         y = int(ypos / self.tilesize)
-         try:
-             z = int(self.rawmap[-y][x])
-         except:
-             return -1
-         return z
+    def render(self):
+        """draws backdrop, sprites, particles and overlay on the screen and returns the changed rects.
+           Without scrolling or zooming only the areas of moved sprites and particles are painted
+           (restored from self.backdrop); otherwise, or if dirty_rendering is off, the whole screen."""
+        full = self.redraw_all or not self.dirty_rendering
+        if full:
+            self.profiler.start("terrain")
+            self.paint_backdrop()
+            self.profiler.stop("terrain")
+            self.redraw_all = False
+        else:
+            for rect in self.repaint_rects:
+                self.allgroup.repaint_rect(rect)
+        self.profiler.start("draw sprites")
+        rects = self.allgroup.draw(self.screen, self.backdrop, full=full)
+        self.repaint_rects = self.particles.draw(self.screen, self.world_offset_x, self.world_offset_y)
+        rects.extend(self.repaint_rects)
+        self.profiler.stop("draw sprites")
+        if self.profiler.enabled:
+            overlay = self.draw_profiler()
+            self.repaint_rects.append(overlay)
+            rects.append(overlay)
+        return rects
+    
+    def step(self, seconds):
+        """one simulation step of the game world. Makes no display calls."""
+        if not self.headless:
+            # ---- remember positions for drawing between two steps ----
+            for s in self.worldgroup:
+                s.old_pos = pygame.math.Vector2(s.pos.x, s.pos.y)
+        profiler = self.profiler
+        profiler.start("move stored sprites")
+        self.move_stored_sprites(seconds)
+        profiler.stop("move stored sprites")
+        profiler.start("update sprites")
+        self.update_sprites(seconds)
+        profiler.stop("update sprites")
+        profiler.start("particles")
+        self.particles.update(seconds, self.world_offset_x, self.world_offset_y, Viewer.width, Viewer.height)
+        profiler.stop("particles")
+        # ----- collision detection between solid units (only neighbours from the spatial hash) -----
+        profiler.start("collide units")
+        self.collide_units()
+        profiler.stop("collide units")
+        profiler.start("bullets vs terrain")
+        self.bullets_vs_terrain()
+        profiler.stop("bullets vs terrain")
+        if self.pathfinder is not None:
+            profiler.start("path searches")
+            self.pathfinder.update(self.path_budget, Viewer.path_rounds if self.deterministic else None)
+            profiler.stop("path searches")
+        self.steps += 1
+    
+    def update_sprites(self, seconds):
+        """updates all sprites. On paged maps, sprites over pages that are not in memory are
+           simulated with less fidelity: only every far_interval steps (not all in the same step)
+           with far_interval times the seconds, and their bullets fly through the terrain"""
+        interval = Viewer.far_interval
+        if self.pages is None or interval <= 1 or self.deterministic:
+            self.profiler.update_group(self.allgroup, seconds)
+            return
+        sprites = self.allgroup.sprites()
+        near = self.loaded_at(numpy.fromiter((s.pos.x for s in sprites), dtype=numpy.float64, count=len(sprites)),
+                              numpy.fromiter((s.pos.y for s in sprites), dtype=numpy.float64, count=len(sprites)))
+        phase = self.steps % interval
+        self.profiler.update_group([s for s, loaded in zip(sprites, near) if loaded], seconds)
+        self.profiler.update_group([s for s, loaded in zip(sprites, near)
+                                    if not loaded and s.number % interval == phase], seconds * interval)
+    
+    def loaded_at(self, xs, ys):
+        """paged maps: True for each world position (arrays) whose page is in memory"""
+        return self.pages.loaded(numpy.floor(numpy.asarray(ys) / -Viewer.tilesize),
+                                 numpy.floor(numpy.asarray(xs) / Viewer.tilesize))
+    
+    def bullets_vs_terrain(self):
+        # --- is a javelin (from bulletgroup) flown into a mountain ? -----
+        # the whole flight of the last step is tested, so fast bullets can not fly through thin ridges
+        bullets = list(self.bulletgroup)
+        if not bullets or self.ground is None:
+            return
+        count = len(bullets)
+        start_z = numpy.fromiter((bu.start_z for bu in bullets), dtype=numpy.float64, count=count)
+        slots = numpy.fromiter((-1 if bu.slot is None else bu.slot for bu in bullets), dtype=numpy.intp, count=count)
+        stored = slots >= 0
+        starts = numpy.empty((count, 2))
+        ends = numpy.empty((count, 2))
+        if stored.any():
+            starts[stored] = VectorSprite.motion.last_pos[slots[stored]]
+            ends[stored] = VectorSprite.motion.pos[slots[stored]]
+        for i in numpy.flatnonzero(~stored):
+            # bullets outside the motion store: old_pos is only kept when drawing
+            bu = bullets[i]
+            starts[i] = bu.pos if bu.old_pos is None else bu.old_pos
+            ends[i] = bu.pos
+        tested = numpy.arange(count)
+        if self.pages is not None and not self.deterministic:
+            # ---- bullets over pages that are not in memory are not tested, that would read them ----
+            tested = numpy.flatnonzero(self.loaded_at(starts[:, 0], starts[:, 1]) & self.loaded_at(ends[:, 0], ends[:, 1]))
+        hit, hit_xs, hit_ys = self.ground.sweep_hits(starts[tested, 0], starts[tested, 1],
+                                                     ends[tested, 0], ends[tested, 1], start_z[tested])
+        for i in numpy.flatnonzero(hit):
+            # bullet is inside a mountain
+            Explosion(posvector=pygame.math.Vector2(hit_xs[i], hit_ys[i]))
+            bullets[tested[i]].kill()
+    
+    def simulate(self, seconds):
+        """steps the world for seconds of game time, as fast as possible (no drawing; in a
+           lockstep game only waiting for the turns of the other players)"""
+        for i in range(int(round(seconds / self.timestep))):
+            if self.lockstep is not None:
+                self.lockstep.wait()
+            self.tick()
+    
+    def tick(self):
+        """one step of timestep seconds, in a lockstep game with the commands of all players for it,
+           in a replay with the recorded commands"""
+        if self.recorder is not None and self.replay_tick % ReplayWriter.keyframe_interval == 0:
+            self.recorder.keyframe(self.replay_tick, self.checksum())
+        lockstep = self.lockstep
+        if lockstep is not None:
+            for player, kind, a, b in lockstep.commands():
+                self.apply_command(player, kind, a, b)
+        self.step(self.timestep)
+        if lockstep is not None:
+            lockstep.advance(self.checksum() if lockstep.tick % Lockstep.checksum_interval == 0 else 0)
+        self.replay_tick += 1
+        if self.replay is not None:
+            self.play_records()
+    
+    def seed_random(self, seed):
+        """starts all random streams of the game new from seed"""
+        self.seed = seed
+        self.rng.seed(seed)
+        self.effects_rng.seed(seed + 1)
+    
+    def join(self, host="127.0.0.1", port=5757, delay=4):
+        """plays a lockstep game on the LockstepServer at host, port. Waits until all players are
+           there. All players must have loaded the same map and must not have started yet."""
+        self.lockstep = Lockstep(host, port, delay)
+        self.seed_random(self.lockstep.seed)
+        self.deterministic = True
+    
+    def command(self, kind, a=0, b=0):
+        """a command of the own player (see COMMAND_...): in a lockstep game it is sent to all
+           players and executed some ticks later, else at once. Ignored while a replay plays"""
+        if self.replay is not None:
+            return
+        if self.lockstep is not None:
+            self.lockstep.command(kind, a, b)
+        else:
+            self.apply_command(0, kind, int(a), int(b)) # whole numbers like in a lockstep game or a replay
+    
+    def apply_command(self, player, kind, a=0, b=0):
+        """executes a command of player"""
+        if self.recorder is not None:
+            self.recorder.command(self.replay_tick, player, kind, a, b)
+        if kind == COMMAND_CATAPULT:
+            p = pygame.math.Vector2(a, b)
+            Catapult(selected=True, owner=player, pos=p, z=max(0, self.ground.height_at(p.x, p.y)))
+        elif kind == COMMAND_FIRE:
+            for c in self.worldgroup:
+                if isinstance(c, Catapult) and c.selected and c.owner == player:
+                    m = pygame.math.Vector2(200,0)
+                    m.rotate_ip(c.angle)
+                    Cannonball(pos=pygame.math.Vector2(c.pos.x, c.pos.y), move=m, bossnumber=c.number)
+        elif kind == COMMAND_MOVE:
+            for ballista in self.allgroup:
+                if isinstance(ballista, Ballista) and ballista.selected and ballista.owner == player:
+                    ballista.target = pygame.math.Vector2(a, b)
+        elif kind == COMMAND_ZOOM:
+            self.worldzoom(a)
+        elif kind == COMMAND_WATER:
+            self.waterheight = min(max(0, self.waterheight + a), self.terrain.max_height)
+            self.make_worldmap()
+    
+    def checksum(self):
+        """crc32 of the game state all players share: class, position, movement and height (z) of
+           every synced sprite in drawing order, and the water height. Sprite numbers are left out: texts and
+           sparks that exist only on one computer take numbers too. Never 0."""
+        sprites = [s for s in self.allgroup if s.synced]
+        state = numpy.fromiter((v for s in sprites for v in (s.pos.x, s.pos.y, s.move.x, s.move.y, getattr(s, "z", 0) or 0)),
+                               dtype=numpy.float64, count=5 * len(sprites))
+        names = ",".join(s.__class__.__name__ for s in sprites).encode()
+        return zlib.crc32(names + state.tobytes() + struct.pack("<d", self.waterheight)) or 1
+    
+    def record(self, filename, compression=6):
+        """records the game from now on into a replay file (compression: zlib level, 0 = none).
+           Call it before create_sprites: a replay creates the sprites new and restarts the random streams"""
+        if self.mapfile is None:
+            raise ValueError("load a map before recording")
+        self.seed_random(self.seed)
+        self.deterministic = True
+        self.replay_tick = 0
+        self.recorder = ReplayWriter(filename, self.mapfile, self.seed, self.timestep, Viewer.tilesize, self.world_zoom,
+                                     self.waterheight, Viewer.width, Viewer.height, compression)
+        self.recorder.view(0, int(round(self.world_offset_x)), int(round(self.world_offset_y)))
+    
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+        self.recorder.close(self.replay_tick, self.checksum())
+        self.recorder = None
+        self.deterministic = self.lockstep is not None
+    
+    def play(self, replay):
+        """plays replay (a Replay): loads its map and starts the recorded game, tick() then
+           executes the recorded commands. The window must have the size of the recording"""
+        if (Viewer.width, Viewer.height) != (replay.width, replay.height):
+            raise ValueError("the replay was recorded in a {}x{} window".format(replay.width, replay.height))
+        replay.check_map()
+        if self.mapfile != replay.mapfile:
+            self.load_map(replay.mapfile)
+        Viewer.timestep = replay.timestep
+        self.replay = replay
+        self.restart_replay()
+    
+    def restart_replay(self):
+        """puts the game back to the start of the replay"""
+        replay = self.replay
+        for s in list(self.allgroup):
+            if s.synced:
+                s.kill()
+        self.particles.count = 0
+        Viewer.tilesize = replay.tilesize
+        self.world_zoom = replay.world_zoom
+        self.spatialhash.rebuild(Viewer.tilesize)
+        self.measure_solid_radius()
+        self.waterheight = replay.waterheight
+        self.new_pathfinder()
+        self.make_worldmap() # tile size of the ground, water of the terrain and the path finder
+        self.seed_random(replay.seed)
+        self.deterministic = True
+        self.replay_tick = 0
+        self.replay_next = 0
+        self.replay_desync = None
+        self.create_sprites()
+        self.play_records()
+    
+    def play_records(self):
+        """executes the records of the replay up to this tick and compares keyframes. Ends the replay after the last record"""
+        replay = self.replay
+        records = replay.records
+        while self.replay_next < len(records) and records[self.replay_next][0] <= self.replay_tick:
+            tick, kind, player, a, b = records[self.replay_next]
+            self.replay_next += 1
+            if kind == REPLAY_KEYFRAME:
+                if a != self.checksum() and self.replay_desync is None:
+                    self.replay_desync = tick
+                    Flytext(text="replay went another way at tick {}".format(tick), color=(200,0,0), pos=pygame.math.Vector2(300, -250), move=pygame.math.Vector2(0,20))
+            elif kind == REPLAY_VIEW:
+                if self.headless:
+                    self.world_offset_x, self.world_offset_y = a, b
+                else:
+                    self.scroll_world(a - self.world_offset_x, b - self.world_offset_y)
+            else:
+                self.apply_command(player, kind, a, b)
+        if self.replay_next == len(records):
+            # ---- the replay is over, the game goes on with the own commands ----
+            self.replay = None
+            self.deterministic = self.lockstep is not None or self.recorder is not None
+            Flytext(text="replay ended", pos=pygame.math.Vector2(300, -250), move=pygame.math.Vector2(0,20))
+    
+    def seek(self, tick):
+        """jumps to tick of the replay, at full speed without drawing. Going back plays again from the start"""
+        if self.replay is None:
+            return
+        if tick < self.replay_tick:
+            self.restart_replay()
+        while self.replay is not None and self.replay_tick < tick:
+            self.tick()
+    
+    def check_lockstep(self):
+        """tells about a desync and goes on alone when the lockstep game has ended"""
+        lockstep = self.lockstep
+        if lockstep is None:
+            return
+        if lockstep.desync is not None and self.desync is None:
+            self.desync = lockstep.desync
+            Flytext(text="desync at tick {}: the games went apart".format(lockstep.desync), color=(200,0,0), pos=pygame.math.Vector2(300, -250), move=pygame.math.Vector2(0,20))
+        if lockstep.closed and not lockstep.ready():
+            Flytext(text="network game ended", color=(200,0,0), pos=pygame.math.Vector2(300, -250), move=pygame.math.Vector2(0,20))
+            self.lockstep = None
+            self.deterministic = False
+    
+    def move_stored_sprites(self, seconds):
+        """moves all StoredSprites together (they skip the movement part of VectorSprite.update)"""
+        if VectorSprite.motion is not None:
+            for s in VectorSprite.motion.step(seconds, Viewer.width, Viewer.height):
+                s.kill()
+    
+    def measure_solid_radius(self, factor=1):
+        """sets the largest solid radius of the spatial hash anew, for example after zooming
+           (the sprites only note bigger radii). factor: how the radii are about to change"""
+        radius = max((s.radius for s in self.allgroup if s.solid), default=0)
+        self.spatialhash.solid_radius = radius * factor + 1 # +1: the images have whole pixels
+
+    def collide_units(self):
+        """elastic collision for all pairs of solid sprites touching each other"""
+        diameter = 2 * self.spatialhash.solid_radius # two sprites this far apart can still touch
+        for a, b in self.spatialhash.pairs(lambda s: s.solid, diameter):
+            if (a.pos - b.pos).length_squared() < (a.radius + b.radius) ** 2:
+                elastic_collision(a, b)
     
     def worldzoom(self, delta):
         """incrase (delta=1) or decrease (delta=-1) worldzoom"""
@@ -1199,8 +4239,9 @@ class Viewer(object):
             raise ValueError("delta of worldzoom must be 1 or -1 or 0")
         if self.world_zoom + delta > 4:
             return # out of range
-        if self.world_zoom + delta < -3:
-            return # out of range
+        if self.world_zoom + delta < -7:
+            return # out of range (the terrain uses the height pyramid below 1 pixel per tile)
+        sprite_zoom = max(-3, self.world_zoom)
         self.world_zoom += delta
         if delta == 1:
             factor = 2
@@ -1212,8 +4253,15 @@ class Viewer(object):
         for o in self.worldgroup:
             o.pos *= factor
             o.move *= factor
-            o.zoom = self.world_zoom
+            if o.old_pos is not None:
+                o.old_pos *= factor
+            o.zoom = max(-3, self.world_zoom) # smallest zoomed sprite image
+        self.particles.scale(factor)
+        self.spatialhash.rebuild(Viewer.tilesize)
+        # the images (and radii) only change with the sprite zoom, when the sprites recreate them
+        self.measure_solid_radius(factor if max(-3, self.world_zoom) != sprite_zoom else 1)
         self.make_worldmap() 
+        self.prerender()
         
         
         
@@ -1221,18 +4269,28 @@ class Viewer(object):
         """The mainloop"""
         
         running = True
-        self.menu_run()
+        if self.lockstep is None and self.replay is None:
+            # a lockstep game or a replay starts at once, on the map loaded before
+            self.menu_run()
+        if self.loading is not None:
+            # ---- menu left while the map is still loading: the game needs it now ----
+            concurrent.futures.wait([self.loading.future])
+            self.poll_jobs()
         
         pygame.mouse.set_visible(True)
         oldleft, oldmiddle, oldright  = False, False, False
         # --------- blitting rawmap to world ------------
-        if self.rawmap != []:
+        if self.rawmap is not None:
             self.make_worldmap()
         
         x, y, h = "?","?","?"
         self.worldzoom(0)
         
-        self.create_sprites()
+        if self.replay is None:
+            # (a replay has created its sprites)
+            if self.record_to is not None:
+                self.record(self.record_to)
+            self.create_sprites()
         
         while running:
           
@@ -1242,9 +4300,13 @@ class Viewer(object):
             text = "press h for help. FPS: {:8.3} ".format(self.clock.get_fps())
             text += "Worldzoom: {}    world_offset_x: {}     world_offset_y: {}".format(self.world_zoom, self.world_offset_x, self.world_offset_y)
             text += "tile value (x:{} y:{}): {}".format(x,y,h) 
+            if self.replay is not None:
+                text += "    replay: {:.1f} of {:.1f} seconds".format(self.replay_tick * self.timestep, self.replay.ticks * self.timestep)
             pygame.display.set_caption(text)
+            self.profiler.end_frame()
             
             # -------- events ------
+            self.profiler.start("events")
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     running = False
@@ -1253,11 +4315,15 @@ class Viewer(object):
                      if event.button == 4:
                          #Viewer.tilesize += 1
                          #self.make_worldmap()
-                         self.worldzoom(1)
+                         self.command(COMMAND_ZOOM, 1)
                      elif event.button == 5:
                          #Viewer.tilesize -= 1
                          #self.make_worldmap()
-                         self.worldzoom(-1)
+                         self.command(COMMAND_ZOOM, -1)
+                     elif event.button == 3:
+                         # ---- move order for the selected ballistas ----
+                         p = mouseVector()
+                         self.command(COMMAND_MOVE, p.x, p.y)
                          
                          
                 
@@ -1270,7 +4336,8 @@ class Viewer(object):
                         running = False
                     if event.key == pygame.K_c:
                         # ---spawns a catapult ---
-                        Catapult(selected=True, pos = mouseVector())
+                        p = mouseVector()
+                        self.command(COMMAND_CATAPULT, p.x, p.y)
                     #if event.key == pygame.K_RIGHT:
                     #    self.b1.set_angle(self.b1.angle + 5)
                     #    self.c1.set_angle(self.c1.angle + 5)
@@ -1278,59 +4345,49 @@ class Viewer(object):
                     #    self.b1.selected = not self.b1.selected
                     #    self.c1.selected = not self.c1.selected 
                     if event.key == pygame.K_SPACE:
-                        p = pygame.math.Vector2(self.c1.pos.x, self.c1.pos.y)
-                        m = pygame.math.Vector2(200,0)
-                        m.rotate_ip(self.c1.angle)
-                        Cannonball(pos=p, move=m, bossnumber= self.c1.number)
+                        # ---- the selected catapults shoot ----
+                        self.command(COMMAND_FIRE)
                     if event.key == pygame.K_PLUS or event.key == pygame.K_KP_PLUS:
-                        self.worldzoom(1)
+                        self.command(COMMAND_ZOOM, 1)
                     if event.key == pygame.K_MINUS or event.key == pygame.K_KP_MINUS:
-                        self.worldzoom(-1)
+                        self.command(COMMAND_ZOOM, -1)
                     if event.key == pygame.K_h:
                         self.display_help()
+                    if event.key == pygame.K_F3:
+                        self.profiler.enabled = not self.profiler.enabled
+                    if event.key == pygame.K_F4:
+                        self.profiler.dump("profile.json")
+                        self.profiler.dump("profile.csv")
+                        Flytext(text="profiler trace written to profile.json and profile.csv", pos=pygame.math.Vector2(400, -300))
+                    # ----------- replay: jump 10 seconds back / ahead ------
+                    if event.key == pygame.K_F5 and self.replay is not None:
+                        self.seek(max(0, self.replay_tick - int(10 / self.timestep)))
+                    if event.key == pygame.K_F6 and self.replay is not None:
+                        self.seek(self.replay_tick + int(10 / self.timestep))
                     if event.key == pygame.K_g:
                         self.grid = not self.grid
-                        Flytext(x=400,y=400, text="Grid is now: {}".format(self.grid))
+                        Flytext(pos=pygame.math.Vector2(400, -400), text="Grid is now: {}".format(self.grid))
                         self.make_worldmap()
                     # --------------- map scrolling ------------
                     if event.key == pygame.K_UP:
-                        self.world_offset_y += self.tilesize
-                        self.make_worldmap()
-                        #for o in self.worldgroup:
-                            #o.worldpos.y += self.tilesize
-                            #o.pos.y -= self.tilesize
+                        self.scroll_world(0, self.tilesize)
                     if event.key == pygame.K_DOWN: 
-                        self.world_offset_y += -self.tilesize
-                        self.make_worldmap()
-                        #for o in self.worldgroup:
-                            #o.worldpos.y -= self.tilesize
-                            #o.pos.y += self.tilesize
+                        self.scroll_world(0, -self.tilesize)
                     if event.key == pygame.K_LEFT:
-                        self.world_offset_x += self.tilesize
-                        self.make_worldmap()
-                        #for o in self.worldgroup:
-                            #o.worldpos.x += self.tilesize
-                            #o.pos.x += self.tilesize
-                            #print(o.pos)
+                        self.scroll_world(self.tilesize, 0)
                     if event.key == pygame.K_RIGHT: 
-                        self.world_offset_x += -self.tilesize
-                        self.make_worldmap()
-                        #for o in self.worldgroup:
-                            #o.worldpos.x -= self.tilesize
-                            #o.pos.x -= self.tilesize
+                        self.scroll_world(-self.tilesize, 0)
                     # ----------- water raising / lowering ------
                     if event.key == pygame.K_PAGEUP:
-                        self.waterheight += 5
-                        self.waterheight = min(255, self.waterheight)
-                        self.make_worldmap()
+                        self.command(COMMAND_WATER, 5)
                         
                     if event.key == pygame.K_PAGEDOWN:
-                        self.waterheight -= 5
-                        self.waterheight = max(0, self.waterheight)
-                        self.make_worldmap()
+                        self.command(COMMAND_WATER, -5)
                     
             # ------------ pressed keys ------
             pressed_keys = pygame.key.get_pressed()
+            self.smooth_scroll(seconds, pressed_keys)
+            self.profiler.stop("events")
             
           
             # ------- movement keys for player1 -------
@@ -1373,17 +4430,14 @@ class Viewer(object):
                 #           player.strafe_right()                
                 
               
-            # =========== delete everything on screen ==============
-            self.screen.fill((0,0,0))
-            self.screen.blit(self.world, (0,0 ))
             
             # --- tile coursor -----
             x,y = pygame.mouse.get_pos()
             x = int(x / self.tilesize)
             y = int(y / self.tilesize)
-            try:
-                h = self.rawmap[y][x]
-            except:
+            if self.ground.inside(x * self.tilesize, -y * self.tilesize):
+                h = self.ground.height_at(x * self.tilesize, -y * self.tilesize)
+            else:
                 x, y = 0, 0
             VectorSprite.numbers[0].pos.x = x * self.tilesize + self.tilesize // 2
             VectorSprite.numbers[0].pos.y = -y * self.tilesize - self.tilesize // 2
@@ -1392,18 +4446,8 @@ class Viewer(object):
             
             
             
-            #self.screen.blit(self.radarmap, (0,0))
-            # ---- showing currently visible world map borders in radarmap -----
-            radar = self.radarmap.copy()
-            #print("ox, oy, ox+width/tileset, oy+height/tileset", self.world_offset_x, self.world_offset_y , self.world_offset_x + int(Viewer.width / self.tilesize), self.world_offset_y + int(Viewer.height / self.tilesize))
-            pygame.draw.rect(radar, (80,255,80),  (-self.world_offset_x//self.tilesize, -self.world_offset_y//self.tilesize , int(Viewer.width / self.tilesize), int(Viewer.height / self.tilesize)),1)
-            self.screen.blit(radar, (Viewer.width-radar.get_width(),0))
-            
             ##self.paint_world()
                        
-            # write text below sprites
-            write(self.screen,  text="water: {}".format( self.waterheight ), x=Viewer.width-400, y=10, color=(100,0,200))
-            
             # ----- collision detection between player and PowerUp---
             #for p in self.playergroup:
             #    crashgroup=pygame.sprite.spritecollide(p,
@@ -1416,36 +4460,171 @@ class Viewer(object):
             
             
                    
-            # ================ UPDATE all sprites =====================
-            self.allgroup.update(seconds)
+            self.poll_jobs()
+            if self.recorder is not None:
+                self.recorder.view(self.replay_tick, int(round(self.world_offset_x)), int(round(self.world_offset_y)))
+            # ================ UPDATE all sprites (fixed timestep) =====================
+            self.accumulator += min(seconds, self.max_frame_time)
+            while self.accumulator >= self.timestep:
+                if self.lockstep is not None and not self.lockstep.ready():
+                    # ---- waiting for the turns of the other players: the game stands still ----
+                    self.accumulator = min(self.accumulator, self.max_frame_time)
+                    break
+                self.tick()
+                self.accumulator -= self.timestep
+            self.check_lockstep()
+            self.profiler.start("radar")
+            self.update_radar(seconds)
+            self.profiler.stop("radar")
+            # ---- draw sprites between their last two simulated positions ----
+            self.profiler.start("worldrect")
+            alpha = min(1.0, self.accumulator / self.timestep)
             for s in self.worldgroup:
-                s.worldrect(self.world_offset_x, self.world_offset_y, self.worldzoom)
+                s.worldrect(self.world_offset_x, self.world_offset_y, self.worldzoom, alpha)
+            self.profiler.stop("worldrect")
                 
-            
-            # --- is a javelin (from bulletgroup) flown into a mountain ? -----
-            for bu in self.bulletgroup:
-                try:   # somtimes error that z can't be found or is a "\n" char instead value
-                    z = int(self.get_z(bu.pos.x, bu.pos.y))
-                except:
-                    continue 
-                if z > bu.start_z:
-                    # bullet is inside a mountain
-                    Explosion(posvector=bu.pos)
-                    bu.kill() 
-                    # Explosion?
-                    
 
             # ----------- clear, draw , update, flip -----------------
-            self.allgroup.draw(self.screen)
+            rects = self.render()
 
             
            
                 
             # -------- next frame -------------
-            pygame.display.flip()
+            self.profiler.start("flip")
+            pygame.display.update(rects)
+            self.profiler.stop("flip")
         #-----------------------------------------------------
         pygame.mouse.set_visible(True)    
+        self.stop_recording()
+        if self.lockstep is not None:
+            self.lockstep.close()
+        self.jobs.shutdown()
         pygame.quit()
 
 if __name__ == '__main__':
-    Viewer(1430,800).run()
+    import argparse
+    parser = argparse.ArgumentParser(description="pygame rts test project")
+    parser.add_argument("--convert", nargs="*", metavar="PATH",
+                        help="convert png files (or all png files of folders) into .map files without opening a window. Default folder: maps")
+    parser.add_argument("--page", nargs="+", metavar="PATH",
+                        help="MAPFILE [TARGET]: convert a .map file into a paged .map file, for maps bigger than memory")
+    parser.add_argument("--headless", metavar="MAPFILE", nargs="?", const="",
+                        help="simulate the game on MAPFILE without window and sound, as fast as possible (with --replay: no MAPFILE)")
+    parser.add_argument("--seconds", type=float, default=60.0,
+                        help="game time to simulate with --headless (default: 60)")
+    parser.add_argument("--timestep", type=float, default=Viewer.timestep,
+                        help="seconds of game time per simulation step (default: 1/60)")
+    parser.add_argument("--serve", type=int, metavar="PLAYERS",
+                        help="start a lockstep server for PLAYERS players on localhost (alone: wait until the game ends)")
+    parser.add_argument("--join", metavar="HOST",
+                        help="play a lockstep game on the server at HOST, on the map of --headless or --map")
+    parser.add_argument("--port", type=int, default=5757, help="port of the lockstep server (default: 5757)")
+    parser.add_argument("--map", default=os.path.join("maps", "vulkan1.map"),
+                        help="map of a lockstep game in a window (default: maps/vulkan1.map)")
+    parser.add_argument("--bot", action="store_true",
+                        help="with --headless: give a random command every second of game time")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the game (in the window, or with --headless) into a replay file")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="play a replay file in the window, or with --headless as fast as possible")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="with --replay and --headless: write the profiler trace of every step (.json or .csv)")
+    args = parser.parse_args()
+    if args.headless == "" and args.replay is None:
+        parser.error("--headless needs a MAPFILE")
+    if args.serve is not None:
+        server = LockstepServer(args.serve, port=args.port)
+        print("lockstep server for {} players on port {}".format(server.players, server.port))
+        if args.join is None and args.headless is None:
+            server.wait()
+            raise SystemExit
+    if args.convert is not None:
+        for path in args.convert or ["maps"]:
+            if os.path.isdir(path):
+                written = convert_png_folder(path)
+            else:
+                written = [convert_png(path)]
+            for name in written:
+                print("written:", name)
+    elif args.page is not None:
+        print("written:", page_heightmap(*args.page[:2]))
+    elif args.replay is not None and args.headless is not None:
+        replay = Replay(args.replay)
+        viewer = Viewer(replay.width, replay.height, headless=True)
+        if args.profile is not None:
+            viewer.profiler = Profiler(trace_frames=replay.ticks + 1)
+            viewer.profiler.enabled = True
+        viewer.play(replay)
+        steps = [] # (seconds, tick)
+        start = time.perf_counter()
+        while viewer.replay is not None:
+            tick = viewer.replay_tick
+            step_start = time.perf_counter()
+            viewer.tick()
+            steps.append((time.perf_counter() - step_start, tick))
+            viewer.profiler.end_frame()
+        duration = time.perf_counter() - start
+        print("replayed {} steps ({:.1f} seconds game time) in {:.2f} seconds real time, {} sprites alive".format(
+              len(steps), replay.ticks * replay.timestep, duration, len(viewer.allgroup)))
+        print("{} keyframes: {}".format(len(replay.keyframes), "all checksums equal" if viewer.replay_desync is None
+                                        else "the game went another way at tick {}".format(viewer.replay_desync)))
+        for seconds, tick in heapq.nlargest(5, steps):
+            print("slow step: tick {} ({:.1f} seconds game time): {:.2f} ms".format(tick, tick * replay.timestep, seconds * 1000))
+        if args.profile is not None:
+            viewer.profiler.dump(args.profile)
+            print("profiler trace written to", args.profile)
+    elif args.headless is not None:
+        Viewer.timestep = args.timestep
+        viewer = Viewer(1430, 800, headless=True)
+        viewer.load_map(args.headless)
+        if args.serve is not None and args.join is None:
+            args.join = "127.0.0.1"
+        if args.join is not None:
+            print("waiting for the other players...")
+            viewer.join(args.join, args.port)
+        if args.record is not None:
+            viewer.record(args.record)
+        viewer.create_sprites()
+        bot = random.Random() # not a stream of the game: the commands are the input
+        start = time.perf_counter()
+        left = args.seconds
+        while left > 0:
+            if args.bot:
+                kind = bot.choice((COMMAND_CATAPULT, COMMAND_FIRE, COMMAND_ZOOM, COMMAND_WATER))
+                if kind == COMMAND_CATAPULT:
+                    viewer.command(kind, bot.randint(0, Viewer.width), -bot.randint(0, Viewer.height))
+                else:
+                    viewer.command(kind, bot.choice((-1, 1)) * (5 if kind == COMMAND_WATER else 1))
+            viewer.simulate(min(left, 1.0) if args.bot else left)
+            left -= 1.0 if args.bot else left
+        duration = time.perf_counter() - start
+        print("simulated {} steps ({} seconds game time) in {:.2f} seconds real time, {} sprites alive".format(
+              viewer.steps, args.seconds, duration, len(viewer.allgroup)))
+        for name, (hits, misses, free) in sorted(VectorSprite.pool_stats().items()):
+            print("pool {}: {} reused, {} created new, {} waiting".format(name, hits, misses, free))
+        if viewer.lockstep is not None:
+            lockstep = viewer.lockstep
+            print("player {} of {}: checksum {:08x}, desync: {}, {:.0f} bytes per second sent".format(
+                  lockstep.player, lockstep.players, viewer.checksum(),
+                  "no" if lockstep.desync is None else "at tick {}".format(lockstep.desync),
+                  lockstep.sent_bytes / args.seconds))
+            lockstep.close()
+        if viewer.recorder is not None:
+            print("replay written to {}: {} records, checksum {:08x}".format(args.record, viewer.recorder.records + 1, viewer.checksum()))
+            viewer.stop_recording()
+    elif args.replay is not None:
+        replay = Replay(args.replay)
+        viewer = Viewer(replay.width, replay.height)
+        viewer.play(replay)
+        viewer.run()
+    else:
+        viewer = Viewer(1430,800)
+        viewer.record_to = args.record
+        if args.serve is not None and args.join is None:
+            args.join = "127.0.0.1"
+        if args.join is not None:
+            viewer.load_map(args.map)
+            print("waiting for the other players...")
+            viewer.join(args.join, args.port)
+        viewer.run()
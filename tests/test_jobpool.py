@@ -0,0 +1,27 @@
+import os
+import sys
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pygamerts
+
+
+def test_shutdown_waits_for_running_jobs_and_cancels_waiting_ones():
+    pool = pygamerts.JobPool(workers=1)
+    started, release, finished = threading.Event(), threading.Event(), []
+    def slow(job):
+        started.set()
+        release.wait(10)
+        finished.append(job.name)
+    def never(job):
+        finished.append(job.name)
+    running = pool.submit("running", slow)
+    waiting = pool.submit("waiting", never)
+    started.wait(10)
+    threading.Timer(0.2, release.set).start() # the job is still running when shutdown is called
+    pool.shutdown()
+    assert finished == ["running"]
+    assert running.future.done() and not running.future.cancelled()
+    assert waiting.future.cancelled()
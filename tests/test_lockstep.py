@@ -0,0 +1,74 @@
+import os
+import select
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pygamerts
+
+
+def connect(port, count):
+    """count Locksteps on the server at port, in player order"""
+    players = [None] * count
+    def join():
+        lockstep = pygamerts.Lockstep("127.0.0.1", port, delay=2)
+        players[lockstep.player] = lockstep
+    threads = [threading.Thread(target=join) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return players
+
+
+def test_server_ends_cleanly_when_a_player_leaves(monkeypatch):
+    errors = []
+    monkeypatch.setattr(threading, "excepthook", errors.append)
+    # ---- a slow relay: the turns of first and the leaving of second come in the same select round ----
+    relay = []
+    real_select = select.select
+    def slow_select(*args):
+        if threading.current_thread() in relay:
+            time.sleep(0.1)
+        return real_select(*args)
+    monkeypatch.setattr(select, "select", slow_select)
+    server = pygamerts.LockstepServer(2, seed=5)
+    relay.append(server.thread)
+    first, second = connect(server.port, 2)
+    assert first.seed == second.seed == 5
+    first.command(pygamerts.COMMAND_FIRE)
+    first.advance()
+    time.sleep(0.2)
+    # ---- second leaves with an unread turn (the server gets a reset) while first still sends turns for it ----
+    second.close()
+    for i in range(5):
+        first.advance()
+    time.sleep(0.2)
+    first.close()
+    server.thread.join(10)
+    assert not server.thread.is_alive()
+    assert errors == []
+
+
+def test_turns_reach_the_other_player():
+    server = pygamerts.LockstepServer(2)
+    first, second = connect(server.port, 2)
+    first.command(pygamerts.COMMAND_MOVE, 10, -20)
+    first.advance(checksum=7)
+    second.advance(checksum=7)
+    for lockstep in (first, second):
+        while not lockstep.ready():
+            time.sleep(0.01)
+        assert lockstep.commands() == []
+        lockstep.advance()
+    deadline = time.time() + 10
+    while not second.ready() and time.time() < deadline:
+        time.sleep(0.01)
+    assert second.commands() == [(0, pygamerts.COMMAND_MOVE, 10, -20)]
+    assert second.desync is None
+    first.close()
+    second.close()
+    server.wait()
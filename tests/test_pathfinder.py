@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy
+import pygame
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pygamerts
+
+
+def make_pathfinder(**kwargs):
+    heights = numpy.zeros((64, 64), dtype=numpy.uint8)
+    heights[10:50, 30] = 255 # a wall with a way around it
+    return pygamerts.PathFinder(pygamerts.TerrainQuery(heights, 32), **kwargs)
+
+
+def test_flow_fields_are_made_in_update_not_when_asked():
+    finder = make_pathfinder()
+    pos = pygame.math.Vector2(20 * 32, -30 * 32)
+    goal = pygame.math.Vector2(40 * 32, -30 * 32)
+    assert finder.direction(pos, goal) is None # queued, the unit goes straight meanwhile
+    assert not finder.fields
+    rounds = 0
+    while finder.field_searches:
+        finder.update(rounds=1)
+        rounds += 1
+    assert rounds > 1 # made in pieces
+    direction = finder.direction(pos, goal)
+    assert direction is not None
+    assert finder.fields[finder.tile_of(goal)].directions.shape == (65, 65)
+    assert finder.flow_field(finder.tile_of(goal)) is finder.fields[finder.tile_of(goal)]
+
+
+def test_flow_fields_are_capped():
+    finder = make_pathfinder(max_fields=3)
+    for column in range(5):
+        finder.flow_field((5, column))
+    assert list(finder.fields) == [(5, 2), (5, 3), (5, 4)]
@@ -0,0 +1,84 @@
+import os
+import random
+import sys
+
+import numpy
+import pygame
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pygamerts
+
+
+class Dot(object):
+    def __init__(self, x, y):
+        self.pos = pygame.math.Vector2(x, y)
+
+
+def test_pairs_reach_cells_within_distance():
+    grid = pygamerts.SpatialHash(32)
+    a, b, c = Dot(31, -10), Dot(65, -10), Dot(200, -10)
+    for dot in (a, b, c):
+        grid.update(dot)
+    assert {frozenset(p) for p in grid.pairs()} == set() # two cells apart, only neighbours by default
+    assert {frozenset(p) for p in grid.pairs(distance=64)} == {frozenset((a, b))}
+
+
+def scattered_dots(count=300, seed=4):
+    rng = random.Random(seed)
+    grid = pygamerts.SpatialHash(32)
+    dots = [Dot(rng.uniform(-100, 600), rng.uniform(-500, 100)) for i in range(count)]
+    for dot in dots:
+        grid.update(dot)
+    return grid, dots
+
+
+def test_query_radius_matches_brute_force():
+    grid, dots = scattered_dots()
+    for x, y, radius in ((0, 0, 50), (250.5, -200.25, 100), (590, -490, 10), (300, -300, 1000), (-500, 500, 40)):
+        pos = pygame.math.Vector2(x, y)
+        expected = {id(d) for d in dots if (d.pos - pos).length_squared() <= radius * radius}
+        assert {id(d) for d in grid.query_radius(pos, radius)} == expected
+    odd = lambda d: int(d.pos.x) % 2 == 1
+    pos = pygame.math.Vector2(200, -200)
+    assert {id(d) for d in grid.query_radius(pos, 150, odd)} == {
+        id(d) for d in dots if (d.pos - pos).length() <= 150 and odd(d)}
+
+
+def test_nearest_respects_condition_and_max_radius():
+    grid, dots = scattered_dots()
+    pos = pygame.math.Vector2(250, -200)
+    by_distance = sorted(dots, key=lambda d: (d.pos - pos).length_squared())
+    assert grid.nearest(pos, 1000) is by_distance[0]
+    far = [d for d in by_distance if (d.pos - pos).length() > 120]
+    assert grid.nearest(pos, 1000, lambda d: d in far) is far[0]
+    assert grid.nearest(pos, (by_distance[0].pos - pos).length() * 0.99) is None # nothing in range
+    assert grid.nearest(pygame.math.Vector2(5000, 5000), 100) is None
+    assert grid.nearest(pos, 1000, lambda d: False) is None
+
+
+def test_touching_catapults_one_cell_apart_collide(monkeypatch):
+    monkeypatch.chdir(ROOT) # sprite images are loaded from the data folder
+    viewer = pygamerts.Viewer(640, 400, headless=True, seed=1)
+    a = pygamerts.Catapult(pos=pygame.math.Vector2(31, -10), move=pygame.math.Vector2(10, 0))
+    b = pygamerts.Catapult(pos=pygame.math.Vector2(65, -10), move=pygame.math.Vector2(-10, 0))
+    cx_a, cx_b = viewer.spatialhash.sprite_cells[a][0], viewer.spatialhash.sprite_cells[b][0]
+    assert cx_b - cx_a == 2 # one empty cell between them
+    assert (a.pos - b.pos).length() < a.radius + b.radius # they touch
+    viewer.collide_units()
+    assert a.move.x < 0 and b.move.x > 0 # bounced off each other
+    assert viewer.spatialhash.solid_radius == a.radius # kept by the hash, not searched every step
+
+
+def test_solid_radius_follows_zooming(monkeypatch, tmp_path):
+    monkeypatch.chdir(ROOT)
+    viewer = pygamerts.Viewer(640, 400, headless=True, seed=1)
+    pygamerts.save_heightmap(str(tmp_path / "flat.map"), numpy.full((64, 64), 50, dtype=numpy.uint8))
+    viewer.load_map(str(tmp_path / "flat.map"))
+    catapults = [pygamerts.Catapult(pos=pygame.math.Vector2(100 + 50 * i, -100)) for i in range(3)]
+    for delta in (1, 1, -1, -1, -1, -1, -1, -1, -1, 1):
+        viewer.worldzoom(delta)
+        viewer.allgroup.update(0) # the catapults make their zoomed images (before collide_units in step)
+        largest = max(c.radius for c in catapults)
+        assert largest <= viewer.spatialhash.solid_radius <= 2 * largest + 1